@@ -0,0 +1,550 @@
+# End to end throughput of each engine on synthetic workflows
+#
+#   bench-load                                   v1, v2 and v3 on the default shape
+#   bench-load v3 --depth 3 --fan-out 4 --parallel 1 --leaf-kind cpu --leaf-cost 0.0005
+#   bench-load --output load.json                also save the results
+#
+# A workflow is a tree of synthetic_node tasks, depth levels below the top level task with fan_out children
+# per node. Each node runs its children one after the other or all at once, a node is parallel with
+# probability parallel_fraction (decided from the seed and its position, so every workflow has the same
+# shape). Leaves busy loop (cpu) or sleep (io) for leaf_cost seconds and return 1, nodes return the sum of
+# their children, so a workflow's result is its number of leaves.
+#
+# Each engine runs in a fresh process with concurrency workflows in flight, a new one is submitted whenever
+# one finishes. Workflows finishing in the warmup are left out, throughput and completion latency are
+# measured over the duration after it. Replay amplification is how many times task bodies (v3) or state
+# machines (v1/v2) ran per task created, peak RSS is the high water mark of the whole process.
+# NOTE: v1 and v2 only ship state machines for their two fixed workflows, the synthetic node below is a
+# generic one written against their APIs the same way
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import queue
+import resource
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from worker_prototype.v1 import main as v1_main
+from worker_prototype.v2 import db as v2_db
+from worker_prototype.v2 import q as v2_q
+from worker_prototype.v2.task_utils import (
+    enqueue_failure_callback,
+    enqueue_success_callback,
+    validate_task_status,
+)
+from worker_prototype.v3 import db as v3_db
+from worker_prototype.v3.task_wrapper import async_task, run_in_parallel
+from worker_prototype.v3.worker_pool import DEFAULT_NUM_WORKERS, WorkerPool
+
+ENGINES = ("v1", "v2", "v3")
+LEAF_KINDS = ("cpu", "io")
+
+DEFAULT_CONCURRENCY = 50
+DEFAULT_WARMUP = 2.0
+DEFAULT_DURATION = 10.0
+
+
+@dataclass
+class WorkloadSpec:
+    depth: int = 2
+    fan_out: int = 4
+    # share of nodes that run their children in parallel, the rest run them serially
+    parallel_fraction: float = 0.5
+    # seconds of work per leaf
+    leaf_cost: float = 0.001
+    leaf_kind: str = "io"
+    seed: int = 0
+
+    @property
+    def tasks_per_workflow(self):
+        return sum(self.fan_out**level for level in range(self.depth + 1))
+
+    @property
+    def leaves_per_workflow(self):
+        return self.fan_out**self.depth
+
+
+def root_data(workflow, spec):
+    return {
+        "workflow": workflow,
+        "path": "0",
+        "depth": spec.depth,
+        "spec": asdict(spec),
+    }
+
+
+def child_data(data, index):
+    return {
+        "workflow": data["workflow"],
+        "path": f"{data['path']}.{index}",
+        "depth": data["depth"] - 1,
+        "spec": data["spec"],
+    }
+
+
+def is_parallel(path, spec):
+    position = zlib.crc32(f"{spec['seed']}:{path}".encode()) / 0xFFFFFFFF
+    return position < spec["parallel_fraction"]
+
+
+def run_leaf(spec):
+    if spec["leaf_kind"] == "cpu":
+        deadline = time.perf_counter() + spec["leaf_cost"]
+        while time.perf_counter() < deadline:
+            pass
+    else:
+        time.sleep(spec["leaf_cost"])
+    return 1
+
+
+# runs of task bodies and state machines, next() is atomic so threads can share it
+_executions = itertools.count()
+
+
+# (finished at, workflow) of v1/v2 workflows, v3 has finished_top_level_tasks
+_finished = deque()
+
+
+# what a v1/v2 node does next given its children in creation order
+# returns ("success", result), ("fail", error), ("spawn", indexes of children to start) or ("wait", None)
+def advance(data, children):
+    if data["depth"] == 0:
+        return "success", run_leaf(data["spec"])
+    errors = [c.error for c in children if c.status.value == "failed"]
+    if errors:
+        return "fail", "Errors: " + ", ".join(errors)
+    fan_out = data["spec"]["fan_out"]
+    results = [c.result for c in children if c.status.value == "success"]
+    if len(results) == fan_out:
+        return "success", sum(results)
+    if is_parallel(data["path"], data["spec"]):
+        if not children:
+            return "spawn", range(fan_out)
+        return "wait", None
+    if len(results) == len(children):
+        return "spawn", [len(children)]
+    return "wait", None
+
+
+V1_RUNNABLE_STATUSES = [
+    v1_main.TaskStatus.PENDING,
+    v1_main.TaskStatus.RETRYING,
+    v1_main.TaskStatus.CREATED,
+]
+
+
+def v1_synthetic_node(id=None, data=None, callback_id=None, type="synthetic_node"):
+    next(_executions)
+    task = v1_main.get_task(id)
+    with task.lock:
+        if not v1_main.validate_task_status(id, V1_RUNNABLE_STATUSES, no_error=True):
+            return
+        v1_main.set_task_status(id, v1_main.TaskStatus.RUNNING)
+
+        # NOTE: v1 finds children by scanning every task, like its own state machines
+        children = [t for t in list(v1_main.task_db.values()) if t.parent_id == id]
+        action, value = advance(task.data, children)
+
+        match action:
+            case "spawn":
+                for index in value:
+                    subtask_data = child_data(task.data, index)
+                    subtask_id = str(uuid.uuid4())
+                    v1_main.create_task(
+                        id=subtask_id,
+                        type=type,
+                        callback_id=id,
+                        data=subtask_data,
+                        parent_id=id,
+                    )
+                    message = v1_main.create_message(
+                        type=type, id=subtask_id, data=subtask_data, callback_id=id
+                    )
+                    with v1_main.q_lock:
+                        v1_main.q.put(message)
+                v1_main.set_task_status(id, v1_main.TaskStatus.PENDING)
+            case "wait":
+                v1_main.set_task_status(id, v1_main.TaskStatus.PENDING)
+            case "success":
+                v1_main.set_task_result(id, value)
+                if callback_id is None:
+                    _finished.append((time.time(), task.data["workflow"]))
+                v1_main.enqueue_success_callback(id, callback_id)
+            case "fail":
+                v1_main.set_task_error(id, value)
+                if callback_id is None:
+                    _finished.append((time.time(), task.data["workflow"]))
+                v1_main.enqueue_failure_callback(id, callback_id)
+
+
+V2_RUNNABLE_STATUSES = [
+    v2_db.TaskStatus.PENDING,
+    v2_db.TaskStatus.RETRYING,
+    v2_db.TaskStatus.CREATED,
+]
+
+
+def v2_synthetic_node(id):
+    next(_executions)
+    task = v2_db.get_task(id)
+    with task.lock:
+        if not validate_task_status(id, V2_RUNNABLE_STATUSES, no_error=True):
+            return
+        v2_db.set_task_status(id, v2_db.TaskStatus.RUNNING)
+
+        children = [
+            v2_db.get_task(child_id) for child_id in v2_db.children_index.get(id, [])
+        ]
+        action, value = advance(task.data, children)
+
+        match action:
+            case "spawn":
+                for index in value:
+                    subtask = v2_db.create_task(
+                        type=task.type,
+                        callback_id=id,
+                        data=child_data(task.data, index),
+                        parent_id=id,
+                    )
+                    with v2_q.q_lock:
+                        v2_q.q.put(v2_q.create_message(id=subtask.id))
+                v2_db.set_task_status(id, v2_db.TaskStatus.PENDING)
+            case "wait":
+                v2_db.set_task_status(id, v2_db.TaskStatus.PENDING)
+            case "success":
+                v2_db.set_task_result(id, value)
+                if task.callback_id is None:
+                    _finished.append((time.time(), task.data["workflow"]))
+                enqueue_success_callback(id)
+            case "fail":
+                v2_db.set_task_error(id, value)
+                if task.callback_id is None:
+                    _finished.append((time.time(), task.data["workflow"]))
+                enqueue_failure_callback(id)
+
+
+@async_task()
+def synthetic_node(workflow, path, depth, spec):
+    next(_executions)
+    if depth == 0:
+        return run_leaf(spec)
+    calls = [
+        functools.partial(
+            synthetic_node,
+            workflow=workflow,
+            path=f"{path}.{index}",
+            depth=depth - 1,
+            spec=spec,
+        )
+        for index in range(spec["fan_out"])
+    ]
+    if is_parallel(path, spec):
+        return sum(run_in_parallel(calls))
+    # a pending child suspends the body here, the rest are started on later runs
+    return sum(call() for call in calls)
+
+
+# v1 and v2 start a thread per message, like their queue_worker but it waits for more messages
+# instead of returning once the queue is empty
+class ThreadPerMessageDispatcher:
+    def __init__(self, q, q_lock, target):
+        self._q = q
+        self._q_lock = q_lock
+        self._target = target
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._q_lock:
+                try:
+                    message = self._q.get(block=False)
+                except queue.Empty:
+                    message = None
+            if message is None:
+                time.sleep(0.0005)
+                continue
+            threading.Thread(target=self._target, kwargs=message.__dict__).start()
+
+
+def _pop_finished():
+    finished = []
+    while _finished:
+        finished.append(_finished.popleft())
+    return finished
+
+
+class V1Engine:
+    def __init__(self, num_workers):
+        self._dispatcher = ThreadPerMessageDispatcher(
+            v1_main.q, v1_main.q_lock, v1_synthetic_node
+        )
+
+    def start(self):
+        self._dispatcher.start()
+
+    def stop(self):
+        self._dispatcher.stop()
+
+    def submit(self, workflow, spec):
+        data = root_data(workflow, spec)
+        task = v1_main.create_top_level_task(
+            id=str(uuid.uuid4()), type="synthetic_node", data=data
+        )
+        message = v1_main.create_message(
+            type="synthetic_node", id=task.id, data=data, callback_id=None
+        )
+        with v1_main.q_lock:
+            v1_main.q.put(message)
+
+    def pop_finished(self):
+        return _pop_finished()
+
+    def task_count(self):
+        return len(v1_main.task_db)
+
+
+class V2Engine:
+    def __init__(self, num_workers):
+        self._dispatcher = ThreadPerMessageDispatcher(
+            v2_q.q, v2_q.q_lock, v2_synthetic_node
+        )
+
+    def start(self):
+        self._dispatcher.start()
+
+    def stop(self):
+        self._dispatcher.stop()
+
+    def submit(self, workflow, spec):
+        task = v2_db.create_top_level_task(
+            type="synthetic_node", data=root_data(workflow, spec)
+        )
+        with v2_q.q_lock:
+            v2_q.q.put(v2_q.create_message(id=task.id))
+
+    def pop_finished(self):
+        return _pop_finished()
+
+    def task_count(self):
+        return len(v2_db.task_db)
+
+
+class V3Engine:
+    def __init__(self, num_workers):
+        self._pool = WorkerPool(num_workers=num_workers)
+
+    def start(self):
+        self._pool.start()
+
+    def stop(self):
+        self._pool.stop()
+
+    def submit(self, workflow, spec):
+        synthetic_node(**root_data(workflow, spec))
+
+    def pop_finished(self):
+        finished = []
+        while v3_db.finished_top_level_tasks:
+            finished_at, id = v3_db.finished_top_level_tasks.popleft()
+            finished.append((finished_at, v3_db.get_task(id).data["workflow"]))
+        return finished
+
+    def task_count(self):
+        return len(v3_db.task_db)
+
+
+ENGINE_CLASSES = {"v1": V1Engine, "v2": V2Engine, "v3": V3Engine}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# keeps concurrency workflows in flight for warmup + duration seconds
+def drive(engine, spec, concurrency, warmup, duration):
+    workflows = itertools.count()
+    submitted = {}
+
+    def submit():
+        workflow = next(workflows)
+        submitted[workflow] = time.time()
+        engine.submit(workflow, spec)
+
+    engine.start()
+    started = time.time()
+    measure_from = started + warmup
+    measure_until = measure_from + duration
+    latencies = []
+    try:
+        for _ in range(concurrency):
+            submit()
+        while time.time() < measure_until:
+            finished = engine.pop_finished()
+            if not finished:
+                time.sleep(0.001)
+                continue
+            for finished_at, workflow in finished:
+                submitted_at = submitted.pop(workflow)
+                if measure_from <= finished_at < measure_until:
+                    latencies.append(finished_at - submitted_at)
+                submit()
+    finally:
+        engine.stop()
+    return len(latencies), latencies, next(workflows)
+
+
+# runs in a fresh process per engine so peak RSS is the engine's own
+def run_engine(
+    engine_name,
+    spec,
+    concurrency=DEFAULT_CONCURRENCY,
+    warmup=DEFAULT_WARMUP,
+    duration=DEFAULT_DURATION,
+    num_workers=DEFAULT_NUM_WORKERS,
+):
+    logging.disable(logging.CRITICAL)
+    engine = ENGINE_CLASSES[engine_name](num_workers)
+    completed, latencies, submitted = drive(engine, spec, concurrency, warmup, duration)
+    tasks = engine.task_count()
+    executions = next(_executions)
+    return {
+        "engine": engine_name,
+        "workflows_submitted": submitted,
+        "workflows_completed": completed,
+        "workflows_per_second": completed / duration,
+        "tasks_per_second": completed * spec.tasks_per_workflow / duration,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "tasks_created": tasks,
+        "executions": executions,
+        "replay_amplification": executions / tasks if tasks else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def run(engines=ENGINES, spec=None, **options):
+    spec = spec or WorkloadSpec()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for engine_name in engines:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(
+                executor.submit(run_engine, engine_name, spec, **options).result()
+            )
+    return {"spec": asdict(spec), "options": options, "results": results}
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="End to end throughput of each engine on synthetic workflows"
+    )
+    parser.add_argument(
+        "engines", nargs="*", help=f"any of {', '.join(ENGINES)}, all by default"
+    )
+    parser.add_argument("--depth", type=int, default=WorkloadSpec.depth)
+    parser.add_argument("--fan-out", type=int, default=WorkloadSpec.fan_out)
+    parser.add_argument(
+        "--parallel",
+        type=float,
+        default=WorkloadSpec.parallel_fraction,
+        help="share of nodes that run their children in parallel",
+    )
+    parser.add_argument("--leaf-cost", type=float, default=WorkloadSpec.leaf_cost)
+    parser.add_argument(
+        "--leaf-kind", choices=LEAF_KINDS, default=WorkloadSpec.leaf_kind
+    )
+    parser.add_argument("--seed", type=int, default=WorkloadSpec.seed)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="workflows in flight",
+    )
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_NUM_WORKERS,
+        help="v3 worker threads, v1 and v2 start a thread per message",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.engines if name not in ENGINES]
+    if unknown:
+        parser.error(f"unknown engines {', '.join(unknown)}")
+    if args.depth < 0 or args.fan_out < 1:
+        parser.error("depth must be at least 0 and fan-out at least 1")
+
+    spec = WorkloadSpec(
+        depth=args.depth,
+        fan_out=args.fan_out,
+        parallel_fraction=args.parallel,
+        leaf_cost=args.leaf_cost,
+        leaf_kind=args.leaf_kind,
+        seed=args.seed,
+    )
+    results = run(
+        args.engines or ENGINES,
+        spec,
+        concurrency=args.concurrency,
+        warmup=args.warmup,
+        duration=args.duration,
+        num_workers=args.workers,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    print(
+        f"{spec.tasks_per_workflow} tasks per workflow, {args.concurrency} in flight, "
+        f"{args.duration:g}s after {args.warmup:g}s warmup"
+    )
+    print(
+        f"{'engine':<7} {'workflows/s':>11} {'tasks/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'replays':>8} {'peak MB':>8}"
+    )
+    for result in results["results"]:
+        amplification = result["replay_amplification"]
+        print(
+            f"{result['engine']:<7} {result['workflows_per_second']:11.1f} {result['tasks_per_second']:9.0f} "
+            f"{_ms(result['latency_p50']):>8} {_ms(result['latency_p99']):>8} "
+            f"{'-' if amplification is None else f'{amplification:.2f}':>8} "
+            f"{result['peak_rss_bytes'] / 2**20:8.1f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# Bytes per live task record, compares the compact v3 Task with the layout it replaced
+# (a plain dataclass with a __dict__, string statuses, and an eager lock and cache dict per task)
+from dataclasses import dataclass, field
+import gc
+import hashlib
+import logging
+import threading
+import tracemalloc
+
+from worker_prototype.v3 import db
+
+NAME = "worker_prototype.v3.tasks.fetch_value_task.fetch_value_task"
+VERSION = hashlib.sha256(b"version").hexdigest()
+
+
+@dataclass
+class LegacyTask:
+    id: str
+    name: str
+    version: str
+    status: str
+    data: dict = None
+    result: str = None
+    error: str = None
+    parent_id: str = None
+    cache: dict = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+def make_ids(count):
+    return [
+        hashlib.blake2b(str(i).encode(), digest_size=32).hexdigest()
+        for i in range(count)
+    ]
+
+
+# names and versions built per record, like rows loaded from a database or messages off a queue
+def fresh(value):
+    return "".join(list(value))
+
+
+def create_legacy(ids, parent_id):
+    return [
+        LegacyTask(
+            id=id,
+            name=fresh(NAME),
+            version=fresh(VERSION),
+            status="success",
+            data={"key": "v1"},
+            result=1,
+            parent_id=parent_id,
+            cache={},
+        )
+        for id in ids
+    ]
+
+
+def create_compact(ids, parent_id):
+    db.task_db.clear()
+    db.create_top_level_task(name=NAME, version=VERSION, data={}, id=parent_id)
+    for id in ids:
+        db.create_task(
+            name=fresh(NAME),
+            version=fresh(VERSION),
+            data={"key": "v1"},
+            id=id,
+            parent_id=parent_id,
+        )
+        db.set_task_result(id, 1)
+    return db.task_db
+
+
+def bytes_per_task(create, ids, parent_id):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = create(ids, parent_id)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / len(ids)
+
+
+def run(count=100000):
+    ids = make_ids(count)
+    parent_id = "parent"
+    legacy = bytes_per_task(create_legacy, ids, parent_id)
+    compact = bytes_per_task(create_compact, ids, parent_id)
+    report = db.memory_report()
+    db.task_db.clear()
+    return {"tasks": count, "legacy": legacy, "compact": compact, "report": report}
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    results = run()
+    print(f"tasks           {results['tasks']}")
+    print(f"legacy          {results['legacy']:8.1f} bytes/task")
+    print(
+        f"compact         {results['compact']:8.1f} bytes/task  {results['legacy'] / results['compact']:.1f}x smaller"
+    )
+    for key, value in results["report"].items():
+        print(f"  {key:<14} {value}")
+
+
+if __name__ == "__main__":
+    main()
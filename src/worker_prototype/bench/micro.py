@@ -0,0 +1,324 @@
+# Per-operation cost of the v3 hot paths
+#
+#   bench-micro                                  print the timings
+#   bench-micro --output results.json            also save them
+#   bench-micro --baseline results.json          compare against a saved run, exits with 1 on a regression
+#
+# Every benchmark runs its operation `number` times per repeat and keeps the median and the best repeat,
+# the comparison uses the median. Results depend on the machine, only compare runs from the same one.
+# Runs made with a different --scale (so a different number) are refused, the per-operation cost of e.g.
+# create_task depends on how many tasks are in the store. How much a benchmark is allowed to slow down grows
+# with how noisy its repeats were in either run, see compare.
+import argparse
+import itertools
+import json
+import logging
+import platform
+import statistics
+import sys
+import threading
+import time
+
+from worker_prototype.v3.db import (
+    Task,
+    TaskStatus,
+    TaskStore,
+    create_task,
+    finished_top_level_tasks,
+    get_task,
+    task_db,
+)
+from worker_prototype.v3.q import TaskQueue, enqueue_id, get_queue, set_queue
+from worker_prototype.v3.task_registry import function_runner
+from worker_prototype.v3.task_wrapper import (
+    async_task,
+    generate_task_id,
+    hash_values,
+)
+
+NAME = "worker_prototype.v3.tasks.fetch_value_task.fetch_value_task"
+VERSION = "0" * 64
+PARENT_TASK_ID = "1" * 64
+KWARGS = {"key": "v1", "ids": list(range(10))}
+
+# the contended store benchmarks run this many threads, each inserting this many tasks per operation
+STORE_THREADS = 8
+STORE_INSERTS_PER_THREAD = 2000
+
+DEFAULT_REPEAT = 5
+# a median slower than the baseline's by more than this (plus the noise, see compare) is a regression
+DEFAULT_THRESHOLD = 0.15
+# how many times the noise of the two runs is added to the threshold
+NOISE_MULTIPLIER = 2
+
+
+@async_task()
+def bench_noop_task(i):
+    return i
+
+
+@async_task()
+def bench_child_task(i):
+    return i
+
+
+@async_task()
+def bench_parent_task(i):
+    return bench_child_task(i=i) + 1
+
+
+# runs every queued message like a worker would, until the queue is empty
+def drain(queue):
+    while True:
+        message = queue.get(timeout=0)
+        if message is None:
+            return
+        function_runner(id=message.id)
+        queue.task_done(message.id)
+
+
+def reset_store():
+    task_db.clear()
+    finished_top_level_tasks.clear()
+
+
+# each benchmark returns (operation, number of times to run it per repeat)
+def bench_hash_values():
+    return lambda: hash_values(NAME, VERSION, PARENT_TASK_ID, KWARGS), 20000
+
+
+def bench_generate_task_id():
+    return (
+        lambda: generate_task_id(None, NAME, VERSION, PARENT_TASK_ID, KWARGS),
+        20000,
+    )
+
+
+def bench_create_task():
+    ids = (f"create-{i}" for i in itertools.count())
+    return lambda: create_task(NAME, VERSION, KWARGS, id=next(ids)), 20000
+
+
+def bench_get_task():
+    ids = [create_task(NAME, VERSION, KWARGS).id for _ in range(1000)]
+    cycle = itertools.cycle(ids)
+    return lambda: get_task(next(cycle)), 100000
+
+
+def bench_enqueue_dequeue():
+    queue = get_queue()
+    ids = itertools.cycle([f"queued-{i}" for i in range(1000)])
+
+    def operation():
+        enqueue_id(next(ids))
+        message = queue.get(timeout=0)
+        queue.task_done(message.id)
+
+    return operation, 20000
+
+
+# a worker picking up a top level task with no children and running it to success
+def bench_function_runner():
+    counter = itertools.count()
+
+    def operation():
+        bench_noop_task(i=next(counter))
+        message = get_queue().get(timeout=0)
+        function_runner(id=message.id)
+        get_queue().task_done(message.id)
+
+    return operation, 5000
+
+
+# submit a parent, run it until it suspends on its child, run the child, resume the parent to success
+def bench_suspend_resume():
+    counter = itertools.count()
+
+    def operation():
+        bench_parent_task(i=next(counter))
+        drain(get_queue())
+
+    return operation, 2000
+
+
+# STORE_THREADS threads at once, each inserting tasks and looking up the last few it inserted, like workers
+# creating children and claiming them, an operation is one whole round on a fresh store
+def bench_contended_store():
+    rounds = itertools.count()
+
+    def operation():
+        store = TaskStore()
+        round = next(rounds)
+        start = threading.Barrier(STORE_THREADS)
+
+        def work(thread):
+            ids = [f"{round}-{thread}-{i}" for i in range(STORE_INSERTS_PER_THREAD)]
+            start.wait()
+            for i, id in enumerate(ids):
+                store.insert(
+                    Task(id=id, name=NAME, version=VERSION, status=TaskStatus.CREATED)
+                )
+                for lookup in ids[max(i - 3, 0) : i + 1]:
+                    store.get(lookup)
+
+        threads = [
+            threading.Thread(target=work, args=(thread,))
+            for thread in range(STORE_THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return operation, 10
+
+
+BENCHMARKS = {
+    "hash_values": bench_hash_values,
+    "generate_task_id": bench_generate_task_id,
+    "create_task": bench_create_task,
+    "get_task": bench_get_task,
+    "enqueue_dequeue": bench_enqueue_dequeue,
+    "function_runner": bench_function_runner,
+    "suspend_resume": bench_suspend_resume,
+    "contended_store": bench_contended_store,
+}
+
+
+def run_benchmark(name, repeat=DEFAULT_REPEAT, scale=1.0):
+    reset_store()
+    previous_queue = get_queue()
+    set_queue(TaskQueue())
+    try:
+        operation, number = BENCHMARKS[name]()
+        number = max(int(number * scale), 1)
+        # first use computes function versions, builds hashers etc.
+        operation()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                operation()
+            timings.append((time.perf_counter() - started) / number)
+    finally:
+        set_queue(previous_queue)
+        reset_store()
+    median = statistics.median(timings)
+    return {
+        "number": number,
+        "repeat": repeat,
+        "median_ns": median * 1e9,
+        "min_ns": min(timings) * 1e9,
+        # relative median absolute deviation of the repeats, a single slow repeat doesn't move it much
+        "noise": statistics.median(abs(timing - median) for timing in timings) / median,
+    }
+
+
+def run(names=None, repeat=DEFAULT_REPEAT, scale=1.0):
+    results = {}
+    for name in names or BENCHMARKS:
+        results[name] = run_benchmark(name, repeat=repeat, scale=scale)
+    return {
+        "meta": {
+            "scale": scale,
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.time(),
+        },
+        "results": results,
+    }
+
+
+# names of the benchmarks in both runs that ran a different number of operations per repeat
+def mismatched(baseline, current):
+    return [
+        name
+        for name, result in current["results"].items()
+        if name in baseline["results"]
+        and baseline["results"][name]["number"] != result["number"]
+    ]
+
+
+# {name: (baseline median, median, ratio, allowed ratio, regressed)} for benchmarks in both runs
+# a benchmark whose repeats vary by 5% in either run gets 2 * (5% + its noise in the other run) on top of
+# the threshold, so a noisy benchmark doesn't flag a regression that is within its own variance
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    comparison = {}
+    for name, result in current["results"].items():
+        baseline_result = baseline["results"].get(name)
+        if baseline_result is None:
+            continue
+        ratio = result["median_ns"] / baseline_result["median_ns"]
+        # baselines saved before the noise was recorded count as noiseless
+        noise = baseline_result.get("noise", 0.0) + result["noise"]
+        allowed = 1 + threshold + NOISE_MULTIPLIER * noise
+        comparison[name] = (
+            baseline_result["median_ns"],
+            result["median_ns"],
+            ratio,
+            allowed,
+            ratio > allowed,
+        )
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Per-operation cost of the v3 hot paths"
+    )
+    parser.add_argument(
+        "benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)}, all by default"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved earlier")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiplies the operations per repeat"
+    )
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(unknown)}")
+
+    logging.disable(logging.CRITICAL)
+    current = run(args.benchmarks, repeat=args.repeat, scale=args.scale)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+
+    if not args.baseline:
+        for name, result in current["results"].items():
+            print(
+                f"{name:<28} {result['median_ns']:10.0f} ns/op  (best {result['min_ns']:.0f})"
+            )
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    different = mismatched(baseline, current)
+    if different:
+        print(
+            f"Can't compare, {', '.join(different)} ran a different number of operations than in the "
+            f"baseline, run with the same --scale (the baseline used {baseline['meta'].get('scale', 1.0)})"
+        )
+        return 2
+    regressed = []
+    for name, (before, after, ratio, allowed, is_regression) in compare(
+        baseline, current, args.threshold
+    ).items():
+        flag = "REGRESSION" if is_regression else ""
+        print(
+            f"{name:<28} {before:10.0f} -> {after:10.0f} ns/op  {ratio:5.2f}x  (allowed {allowed:.2f}x)  {flag}"
+        )
+        if is_regression:
+            regressed.append(name)
+    if regressed:
+        print(f"{len(regressed)} regressed by more than their threshold")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# Throughput of RedisTaskQueue, messages per second through put and through get + task_done
+#
+#   bench-redis-queue                                  against REDIS_URL (redis://localhost:6379/0)
+#   bench-redis-queue --workers 16 --messages 100000
+#   bench-redis-queue --fake                           in-process fakeredis, only checks the benchmark runs
+#
+# Every worker is a thread with a RedisTaskQueue of its own (so its own processing list and heartbeat),
+# sharing the connection pool like the workers of one process do. Uses a queue name of its own and
+# deletes it afterwards.
+# NOTE: most of the time is round trips, so the numbers mostly depend on the latency to the server
+import argparse
+import logging
+import threading
+import time
+import uuid
+
+from worker_prototype.v0.queue.redis_queue import DEFAULT_REDIS_URL, get_connection
+from worker_prototype.v3.q import create_message
+from worker_prototype.v3.redis_q import RedisTaskQueue
+
+DEFAULT_MESSAGES = 20000
+DEFAULT_WORKERS = 8
+# messages per put_many, 1 puts them one by one
+DEFAULT_BATCH_SIZE = 100
+
+
+def run(connection, messages, workers, batch_size):
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    producer = RedisTaskQueue(name=name, connection=connection)
+    consumers = [
+        RedisTaskQueue(name=name, connection=connection, block_timeout=0.1)
+        for _ in range(workers)
+    ]
+    ids = [str(i) for i in range(messages)]
+    try:
+        started = time.perf_counter()
+        for i in range(0, messages, batch_size):
+            producer.put_many([create_message(id) for id in ids[i : i + batch_size]])
+        put_seconds = time.perf_counter() - started
+
+        consumed = [0] * workers
+        # when each worker finished its last message
+        finished = [0.0] * workers
+
+        def consume(i):
+            queue = consumers[i]
+            while True:
+                message = queue.get(timeout=0.5)
+                if message is None:
+                    return
+                queue.task_done(message.id)
+                consumed[i] += 1
+                finished[i] = time.perf_counter()
+
+        threads = [threading.Thread(target=consume, args=(i,)) for i in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        get_seconds = max(finished) - started
+    finally:
+        for queue in consumers:
+            queue.close()
+        producer.clear()
+    if sum(consumed) != messages:
+        raise RuntimeError(f"put {messages} messages but got {sum(consumed)} back")
+    return {
+        "put_per_second": messages / put_seconds,
+        "get_per_second": messages / get_seconds,
+    }
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=DEFAULT_REDIS_URL)
+    parser.add_argument("--fake", action="store_true", help="use fakeredis")
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.fake:
+        import fakeredis
+
+        connection = fakeredis.FakeRedis()
+    else:
+        connection = get_connection(args.url)
+    results = run(connection, args.messages, args.workers, args.batch_size)
+    print(
+        f"{args.messages} messages, {args.workers} workers, batches of {args.batch_size}"
+    )
+    print(f"put            {results['put_per_second']:10.0f} messages/s")
+    print(f"get+task_done  {results['get_per_second']:10.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
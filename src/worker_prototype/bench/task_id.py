@@ -0,0 +1,72 @@
+# Per-call cost of generating a child task id, compares the original approach
+# (json.dumps to validate + json.dumps(default=str) of every value + sha256)
+# with the single canonical encoding and the precomputed (name, version) prefix
+import hashlib
+import json
+import logging
+import timeit
+
+from worker_prototype.v3.task_wrapper import (
+    TaskIdHasher,
+    encode_kwargs,
+    generate_task_id,
+)
+
+NAME = "worker_prototype.v3.tasks.fetch_value_task.fetch_value_task"
+VERSION = hashlib.sha256(b"version").hexdigest()
+PARENT_TASK_ID = hashlib.sha256(b"parent").hexdigest()
+
+KWARGS_CASES = {
+    "small": {"key": "v1"},
+    "medium": {"key": "v1", "ids": list(range(20)), "options": {"a": 1, "b": "two"}},
+    "large": {"items": [{"id": i, "name": f"item {i}"} for i in range(200)]},
+}
+
+
+def legacy_task_id(name, version, parent_task_id, kwargs):
+    json.dumps(kwargs)
+    hash_obj = hashlib.sha256()
+    serialized_value = json.dumps(
+        (name, version, parent_task_id, kwargs), sort_keys=True, default=str
+    )
+    hash_obj.update(serialized_value.encode())
+    return hash_obj.hexdigest()
+
+
+def time_per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def run(number=20000):
+    hasher = TaskIdHasher(NAME, VERSION)
+    results = {}
+    for case, kwargs in KWARGS_CASES.items():
+        calls = max(number // (len(json.dumps(kwargs)) // 16 + 1), 100)
+        results[case] = {
+            "legacy": time_per_call(
+                lambda: legacy_task_id(NAME, VERSION, PARENT_TASK_ID, kwargs), calls
+            ),
+            "generate_task_id": time_per_call(
+                lambda: generate_task_id(None, NAME, VERSION, PARENT_TASK_ID, kwargs),
+                calls,
+            ),
+            # what wrapper_task does per call
+            "precomputed_prefix": time_per_call(
+                lambda: hasher.task_id(PARENT_TASK_ID, encode_kwargs(kwargs)), calls
+            ),
+        }
+    return results
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    for case, timings in run().items():
+        legacy = timings["legacy"]
+        for label, seconds in timings.items():
+            print(
+                f"{case:<8} {label:<20} {seconds * 1e6:8.2f} us/call  {legacy / seconds:5.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
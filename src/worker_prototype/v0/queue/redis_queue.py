@@ -1,42 +1,198 @@
+import os
+import threading
+import uuid
+
 import redis
 
+DEFAULT_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(url=DEFAULT_REDIS_URL):
+    """
+    Return the connection pool for the url, every queue in the process shares it.
+    """
+    with _connection_pools_lock:
+        if url not in _connection_pools:
+            _connection_pools[url] = redis.ConnectionPool.from_url(url)
+        return _connection_pools[url]
+
+
+def get_connection(url=DEFAULT_REDIS_URL):
+    return redis.Redis(connection_pool=get_connection_pool(url))
+
+
 class SimpleQueue:
-    def __init__(self, name, namespace='queue'):
+    def __init__(self, name, namespace='queue', connection=None):
         """
         The key name in Redis will be namespace:name.
+        Pass a connection (e.g. fakeredis.FakeRedis()) to use something other than the shared pool.
         """
-        self.__db = redis.Redis()
+        self._db = connection if connection is not None else get_connection()
         self.key = f"{namespace}:{name}"
 
     def enqueue(self, item):
         """
         Add an item to the end of the queue.
         """
-        self.__db.rpush(self.key, item)
+        self._db.rpush(self.key, item)
 
     def dequeue(self):
         """
         Remove and return an item from the front of the queue.
         """
-        return self.__db.lpop(self.key)
+        return self._db.lpop(self.key)
 
     def size(self):
         """
         Return the number of items in the queue.
         """
-        return self.__db.llen(self.key)
+        return self._db.llen(self.key)
 
     def peek(self):
         """
         Return the next item from the front of the queue without removing it.
         """
-        return self.__db.lindex(self.key, 0)
+        return self._db.lindex(self.key, 0)
 
     def clear(self):
         """
         Remove all items from the queue.
         """
-        self.__db.delete(self.key)
+        self._db.delete(self.key)
+
+
+class ReliableQueue(SimpleQueue):
+    """
+    A queue where a dequeued item is atomically moved into a processing list owned by the worker
+    (namespace:name:processing:worker_id) and stays there until it's acked.
+    If the worker dies the item isn't lost, requeue_orphans moves it back onto the queue once the worker's
+    heartbeat has expired.
+    """
+
+    # number of items sent per RPUSH when enqueueing in bulk
+    batch_size = 1000
+
+    def __init__(
+        self,
+        name,
+        namespace='queue',
+        worker_id=None,
+        connection=None,
+        heartbeat_ttl=30,
+    ):
+        super().__init__(name, namespace=namespace, connection=connection)
+        self.worker_id = worker_id if worker_id is not None else str(uuid.uuid4())
+        self.heartbeat_ttl = heartbeat_ttl
+        self.workers_key = f"{self.key}:workers"
+        self.processing_key = self._processing_key(self.worker_id)
+        self._registered = False
+
+    def _processing_key(self, worker_id):
+        return f"{self.key}:processing:{worker_id}"
+
+    def _heartbeat_key(self, worker_id):
+        return f"{self.key}:heartbeat:{worker_id}"
+
+    def heartbeat(self):
+        """
+        Mark this worker as alive for heartbeat_ttl seconds.
+        """
+        pipe = self._db.pipeline(transaction=False)
+        pipe.sadd(self.workers_key, self.worker_id)
+        pipe.set(self._heartbeat_key(self.worker_id), 1, ex=self.heartbeat_ttl)
+        pipe.execute()
+        self._registered = True
+
+    def enqueue_many(self, items):
+        """
+        Add items to the end of the queue, pipelined in batches so it's one round trip.
+        """
+        items = list(items)
+        if not items:
+            return
+        pipe = self._db.pipeline(transaction=False)
+        for i in range(0, len(items), self.batch_size):
+            pipe.rpush(self.key, *items[i : i + self.batch_size])
+        pipe.execute()
+
+    def dequeue(self, timeout=1):
+        """
+        Move the item at the front of the queue into this worker's processing list and return it.
+        Blocks for up to timeout seconds (0 blocks forever), returns None if nothing arrived.
+        """
+        if not self._registered:
+            self.heartbeat()
+        return self._db.blmove(self.key, self.processing_key, timeout, 'LEFT', 'RIGHT')
+
+    def ack(self, item):
+        """
+        Remove a finished item from this worker's processing list.
+        """
+        self._db.lrem(self.processing_key, 1, item)
+
+    def requeue(self, item):
+        """
+        Put an item this worker couldn't finish back at the front of the queue.
+        """
+        pipe = self._db.pipeline(transaction=True)
+        pipe.lrem(self.processing_key, 1, item)
+        pipe.lpush(self.key, item)
+        pipe.execute()
+
+    def processing(self):
+        """
+        Return the items this worker has dequeued but not acked.
+        """
+        return self._db.lrange(self.processing_key, 0, -1)
+
+    def requeue_orphans(self, queued_key=None):
+        """
+        Move items held by workers whose heartbeat expired back to the front of the queue.
+        If queued_key is given each item is also added to that set, in the same transaction as the move.
+        Returns the requeued items.
+        """
+        requeued = []
+        for worker_id in self._db.smembers(self.workers_key):
+            if isinstance(worker_id, bytes):
+                worker_id = worker_id.decode()
+            if self._db.exists(self._heartbeat_key(worker_id)):
+                continue
+            processing_key = self._processing_key(worker_id)
+            # one transaction per item so nothing is lost or duplicated if two workers recover the same list
+            while True:
+                item = self._move_last(processing_key, queued_key)
+                if item is None:
+                    break
+                requeued.append(item)
+            self._db.srem(self.workers_key, worker_id)
+        return requeued
+
+    def _move_last(self, processing_key, queued_key):
+        with self._db.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(processing_key)
+                    item = pipe.lindex(processing_key, -1)
+                    if item is None:
+                        pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    pipe.lmove(processing_key, self.key, 'RIGHT', 'LEFT')
+                    if queued_key is not None:
+                        pipe.sadd(queued_key, item)
+                    pipe.execute()
+                    return item
+                except redis.WatchError:
+                    continue
+
+    def clear(self):
+        """
+        Remove all items from the queue and from this worker's processing list.
+        """
+        self._db.delete(self.key, self.processing_key)
 
 
 if __name__ == '__main__':
@@ -50,6 +206,3 @@ if __name__ == '__main__':
     # Dequeue items
     print(queue.dequeue())  # Message 1
     print(queue.dequeue())  # Message 2
-
-
-
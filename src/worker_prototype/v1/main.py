@@ -1,5 +1,6 @@
 import queue
 import threading
+import time
 import random
 import uuid
 from enum import Enum
@@ -543,17 +544,31 @@ task_map = {
 }
 
 
-def queue_worker():
+# runs until nothing is left to do: the queue is empty and no task thread is still running
+# NOTE: an empty queue alone isn't enough, a running task re-enqueues its parent when it finishes
+def queue_worker(poll_interval=0.001):
+    threads = []
     while True:
         message = None
         with q_lock:
             try:
                 message = q.get(block=False)
             except queue.Empty:
-                logging.debug("Queue is empty, done processing")
+                pass
+        if message is None:
+            threads = [thread for thread in threads if thread.is_alive()]
+            # threads enqueue before they exit, so the queue is checked after they are all done
+            if not threads and q.empty():
+                logging.debug(
+                    "Queue is empty and no tasks are running, done processing"
+                )
                 return
+            time.sleep(poll_interval)
+            continue
         type = message.type
-        threading.Thread(target=task_map[type], kwargs=message.__dict__).start()
+        thread = threading.Thread(target=task_map[type], kwargs=message.__dict__)
+        thread.start()
+        threads.append(thread)
 
 
 def main():
@@ -32,6 +32,8 @@ class Task:
 
 
 task_db: dict[str, Task] = {}
+# parent_id -> ids of its child tasks in creation order, so state machines don't scan the whole task_db
+children_index: dict[str, list[str]] = {}
 
 mock_info_store = {
     "v1": 1,
@@ -58,6 +60,8 @@ def create_task(type, callback_id, data, id=None, parent_id=None):
             data=data,
             parent_id=parent_id,
         )
+        if parent_id is not None:
+            children_index.setdefault(parent_id, []).append(id)
     return task_db[id]
 
 
@@ -90,6 +94,10 @@ def get_task(id):
         raise InvalidTaskIdError(f"Task {id} not found")
 
 
+def get_children(id):
+    return [task_db[child_id] for child_id in children_index.get(id, [])]
+
+
 def set_task_status(id, status):
     task = get_task(id)
     task.status = status
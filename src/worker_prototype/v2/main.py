@@ -8,6 +8,7 @@ from worker_prototype.v2.q import create_message, q, q_lock
 import threading
 import queue
 import logging
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -19,17 +20,31 @@ task_map = {
 }
 
 
-def queue_worker():
+# runs until nothing is left to do: the queue is empty and no task thread is still running
+# NOTE: an empty queue alone isn't enough, a running task re-enqueues its parent when it finishes
+def queue_worker(poll_interval=0.001):
+    threads = []
     while True:
         message = None
         with q_lock:
             try:
                 message = q.get(block=False)
             except queue.Empty:
-                logging.debug("Queue is empty, done processing")
+                pass
+        if message is None:
+            threads = [thread for thread in threads if thread.is_alive()]
+            # threads enqueue before they exit, so the queue is checked after they are all done
+            if not threads and q.empty():
+                logging.debug(
+                    "Queue is empty and no tasks are running, done processing"
+                )
                 return
+            time.sleep(poll_interval)
+            continue
         type = task_db[message.id].type
-        threading.Thread(target=task_map[type], kwargs=message.__dict__).start()
+        thread = threading.Thread(target=task_map[type], kwargs=message.__dict__)
+        thread.start()
+        threads.append(thread)
 
 
 def main():
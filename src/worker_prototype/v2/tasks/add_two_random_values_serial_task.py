@@ -1,11 +1,11 @@
 from worker_prototype.v2.db import (
     TaskStatus,
     create_task,
+    get_children,
     get_task,
     set_task_error,
     set_task_result,
     set_task_status,
-    task_db,
     mock_info_store,
 )
 from worker_prototype.v2.errors import InvalidTaskStateError
@@ -41,7 +41,7 @@ def add_two_random_values_serial_task(id):
         set_task_status(id, TaskStatus.RUNNING)
 
         # find child tasks
-        child_tasks = [t for t in task_db.values() if t.parent_id == id]
+        child_tasks = get_children(id)
 
         # determine state
         if len(child_tasks) == 0:
@@ -0,0 +1,121 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+import threading
+
+from worker_prototype.v3.metrics import metrics_registry
+from worker_prototype.v3.q import get_queue
+from worker_prototype.v3.task_registry import function_registry, function_runner
+from worker_prototype.v3.errors import InvalidTaskIdError
+from worker_prototype.v3.store import get_store
+from worker_prototype.v3.thread_util import set_parent_task_id, set_task_id
+
+logging.basicConfig(level=logging.DEBUG)
+
+DEFAULT_MAX_CONCURRENCY = 1000
+
+async_tasks_in_flight = metrics_registry.gauge(
+    "v3_async_tasks_in_flight", "Tasks running on async workers' event loops"
+)
+
+
+async def async_function_runner(id):
+    try:
+        task = get_store().get_task(id)
+    except InvalidTaskIdError:
+        logging.debug(f"Task {id} not found, skipping")
+        return
+    func = function_registry.get(task.name, task.version)
+    if not getattr(func, "is_async", inspect.iscoroutinefunction(func)):
+        # synchronous bodies would block the loop, run them on a thread like the worker pool does
+        await asyncio.to_thread(function_runner, id)
+        return
+    # every message runs as its own asyncio task, with its own copy of the context
+    set_parent_task_id(None)
+    set_task_id(id)
+    await func(**task.data)
+
+
+# Runs tasks as asyncio tasks on a single event loop, for async def task bodies.
+# A task waiting on I/O only holds a coroutine instead of a worker thread, so one process can keep
+# thousands of them in flight. Synchronous tasks from the same queue are handed to a thread.
+class AsyncWorker:
+    def __init__(
+        self,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        runner=async_function_runner,
+        task_queue=None,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self._runner = runner
+        self._queue = task_queue if task_queue is not None else get_queue()
+        self._in_flight = set()
+        self._thread = None
+
+    # number of tasks currently running on the loop
+    @property
+    def busy_count(self):
+        return len(self._in_flight)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def task_queue(self):
+        return self._queue
+
+    # runs until the queue is closed, then waits for the running tasks to finish
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_concurrency)
+        # NOTE: the queue blocks, so a dedicated thread waits on it for the loop
+        with ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="v3-async-get"
+        ) as getter:
+            while True:
+                await slots.acquire()
+                message = await loop.run_in_executor(getter, self._queue.get)
+                if message is None:
+                    slots.release()
+                    break
+                task = asyncio.create_task(self._run_message(message.id, slots))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+        if self._in_flight:
+            await asyncio.wait(list(self._in_flight))
+
+    async def _run_message(self, id, slots):
+        async_tasks_in_flight.inc()
+        try:
+            await self._runner(id=id)
+        except Exception:
+            # a broken task shouldn't take the worker down with it
+            logging.exception(f"Worker failed to run task {id}")
+        finally:
+            self._queue.task_done(id)
+            slots.release()
+            async_tasks_in_flight.dec()
+
+    # runs the event loop on a thread of its own
+    def start(self):
+        if self.is_running:
+            raise RuntimeError("Async worker is already running")
+        self._queue.open()
+        self._thread = threading.Thread(
+            target=lambda: asyncio.run(self.run()), name="v3-async-worker"
+        )
+        self._thread.start()
+        logging.debug(
+            f"Started async worker with up to {self.max_concurrency} concurrent tasks"
+        )
+
+    # NOTE: this closes the queue, so workers sharing a queue are stopped together
+    def stop(self, wait=True, timeout=None):
+        self._queue.close()
+        if wait and self._thread is not None:
+            self._thread.join(timeout)
+        logging.debug("Stopped async worker")
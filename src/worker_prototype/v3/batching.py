@@ -0,0 +1,162 @@
+# Batched leaf tasks (@batched_task), like a DataLoader
+#
+# A batched task is written as a function that takes a list of calls (the kwargs of each call) and returns
+# a list with one result per call, in the same order. An item that is an exception fails that call only.
+# Callers use it like any other task, fetch_values(key="v1"), and every call still gets its own child task
+# with its own result or error. What changes is how the children run: instead of a queue message and an
+# execution each, new children are collected into a batch that runs as a single invocation once it has
+# max_batch_size calls or batch_window seconds after its first call, whichever comes first.
+#
+# A batch is a top level task of its own (named "<task name>:batch") holding the ids of its calls, so it
+# goes through the queue, workers and retention like everything else.
+# NOTE: batch functions are leaves, they can't call other tasks
+# NOTE: children of bodies running in a worker process, or a batched task called outside of a task, run as
+# batches of one
+import functools
+import logging
+import threading
+import uuid
+
+from worker_prototype.v3.q import enqueue_id
+from worker_prototype.v3.store import get_store
+from worker_prototype.v3.task_registry import function_registry
+from worker_prototype.v3.task_wrapper import async_task, get_func_name, notify_parent
+from worker_prototype.v3.thread_util import get_task_id
+
+logging.basicConfig(level=logging.DEBUG)
+
+DEFAULT_MAX_BATCH_SIZE = 100
+DEFAULT_BATCH_WINDOW = 0.01
+
+# batches run the same way whatever the batched function is
+BATCH_VERSION = "1"
+
+
+# runs the batch function, returns one result or exception per call
+def call_batch_function(batch_func, calls):
+    try:
+        outcomes = list(batch_func(calls))
+    except Exception as e:
+        return [e] * len(calls)
+    if len(outcomes) != len(calls):
+        error = ValueError(
+            f"Batch function returned {len(outcomes)} results for {len(calls)} calls"
+        )
+        return [error] * len(calls)
+    return outcomes
+
+
+# collects new children of a batched task into the open batch
+class Batcher:
+    def __init__(self, name, batch_func, max_batch_size, batch_window):
+        self.name = f"{name}:batch"
+        self._batch_func = batch_func
+        self._max_batch_size = max_batch_size
+        self._batch_window = batch_window
+        self._lock = threading.Lock()
+        self._batch_id = None
+        self._ids = None
+        self.batch_count = 0
+        function_registry.register(self.run_batch, self.name, BATCH_VERSION)
+
+    # used as enqueue_child of the task, the open batch is queued with a delay of batch_window when it's
+    # opened and queued right away once it's full
+    def add(self, id, priority):
+        full_batch_id = None
+        with self._lock:
+            if self._batch_id is None:
+                self._batch_id = str(uuid.uuid4())
+                self._ids = []
+                get_store().create_top_level_task(
+                    name=self.name,
+                    version=BATCH_VERSION,
+                    data={"ids": self._ids},
+                    id=self._batch_id,
+                    priority=priority,
+                )
+                self.batch_count += 1
+                enqueue_id(self._batch_id, priority, delay=self._batch_window)
+            self._ids.append(id)
+            if len(self._ids) >= self._max_batch_size:
+                full_batch_id = self._batch_id
+                self._close(full_batch_id)
+        if full_batch_id is not None:
+            enqueue_id(full_batch_id, priority)
+
+    def _close(self, batch_id):
+        if self._batch_id == batch_id:
+            self._batch_id = None
+            self._ids = None
+
+    # run by a worker like any task body, the id of the batch task is in the thread context
+    def run_batch(self, ids):
+        batch_id = get_task_id()
+        # nothing can join the batch once it started running
+        with self._lock:
+            self._close(batch_id)
+
+        store = get_store()
+        # NOTE: a full batch is queued twice, the second message finds it running or finished
+        batch = store.claim_task(batch_id)
+        if batch is None:
+            return
+
+        claimed = []
+        for id in store.get_tasks(ids):
+            task = store.claim_task(id)
+            if task is not None:
+                claimed.append(task)
+
+        outcomes = call_batch_function(
+            self._batch_func, [task.data for task in claimed]
+        )
+
+        for task, outcome in zip(claimed, outcomes):
+            failed = isinstance(outcome, Exception)
+            with task.lock:
+                if failed:
+                    store.set_task_error(
+                        task.id, error=f"Task {task.id} failed with error {outcome}"
+                    )
+                else:
+                    store.set_task_result(task.id, result=outcome)
+            notify_parent(task, failed=failed)
+
+        with batch.lock:
+            store.set_task_result(batch_id, result=len(claimed))
+        logging.debug(f"Ran batch {batch_id} of {len(claimed)} {self.name} calls")
+
+
+# like async_task for a function that takes a list of calls and returns their results, see above
+def batched_task(
+    max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+    batch_window=DEFAULT_BATCH_WINDOW,
+    name=None,
+    version=None,
+    priority=None,
+):
+    if max_batch_size < 1:
+        raise ValueError("max_batch_size must be at least 1")
+
+    def decorator_batched_task(batch_func):
+        function_name = get_func_name(batch_func, name)
+        batcher = Batcher(function_name, batch_func, max_batch_size, batch_window)
+
+        # runs a single call, when the task is run on its own instead of in a batch
+        @functools.wraps(batch_func)
+        def run_one(**kwargs):
+            [outcome] = call_batch_function(batch_func, [kwargs])
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        wrapper_task = async_task(
+            name=function_name,
+            version=version,
+            priority=priority,
+            enqueue_child=batcher.add,
+        )(run_one)
+        wrapper_task.batcher = batcher
+        return wrapper_task
+
+    return decorator_batched_task
@@ -1,28 +1,45 @@
-from dataclasses import dataclass, field
-from enum import Enum
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum, IntEnum
+import sys
 import threading
+import time
 import uuid
 
 from worker_prototype.v3.errors import InvalidTaskIdError
+from worker_prototype.v3.q import DEFAULT_PRIORITY
 
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
 
-# task status enum
-class TaskStatus(Enum):
-    CREATED = "created"
-    RUNNING = "running"
-    PENDING = "pending"
-    RETRYING = "retrying"
-    SUCCESS = "success"
-    FAILED = "failed"
+# task status enum, stored as a small int
+class TaskStatus(IntEnum):
+    CREATED = 0
+    RUNNING = 1
+    PENDING = 2
+    RETRYING = 3
+    SUCCESS = 4
+    FAILED = 5
+
+    # keep log messages readable, IntEnum would print the number
+    __str__ = Enum.__str__
+
+
+# decides when a parent is woken up by its children
+# ALL - only once every outstanding child has finished
+# FAIL_FAST - once every outstanding child has finished or as soon as one of them fails
+class JoinPolicy(Enum):
+    ALL = "all"
+    FAIL_FAST = "fail_fast"
 
 
 # NOTE: currently there's no way to get the progress of a task
 # this could be stored in the DB but that might make it more difficult to use external services
-@dataclass
+# NOTE: there can be millions of these so they use __slots__, intern name/version (see create_task) and only
+# allocate the cache and journal once they are used, locks are shared through a striped lock table
+@dataclass(slots=True)
 class Task:
     id: str
     name: str
@@ -32,11 +49,112 @@ class Task:
     result: str = None
     error: str = None
     parent_id: str = None
+    # for locally generated values, created on first use
     cache: dict = None
-    lock: threading.Lock = field(default_factory=threading.Lock)
+    join_policy: JoinPolicy = JoinPolicy.FAIL_FAST
+    # number of children that were created but haven't succeeded or failed yet
+    outstanding_children: int = 0
+    # call index -> JournalEntry, created on first use
+    journal: dict = None
+    # ids of the tasks created by this one, created on first use
+    children: list = None
+    # set when a worker tried to run the task while it was already running
+    rerun: bool = False
+    # queue priority level, see worker_prototype.v3.q
+    priority: int = DEFAULT_PRIORITY
+    # id of the top level task of the workflow, set once when the task is created, None for top level tasks
+    root_id: str = None
+
+    # NOTE: tasks share locks, only hold it for short status changes and never take another task's lock while holding it
+    @property
+    def lock(self):
+        return task_locks.get(self.id)
+
+
+# result of a finished child call, recorded by the parent at the position the call was made in its body
+# so a replay can answer it without regenerating the child id and looking the child up
+@dataclass(slots=True)
+class JournalEntry:
+    name: str
+    kwargs: dict
+    child_id: str
+    result: str = None
+    error: str = None
+
+
+# fixed table of locks picked by hashing the task id, instead of a lock per task
+class LockStripes:
+    def __init__(self, num_stripes=1024):
+        self._locks = [threading.Lock() for _ in range(num_stripes)]
+
+    def get(self, id):
+        return self._locks[hash(id) % len(self._locks)]
+
+
+# task store, a dict with a lock for writes
+# NOTE: single key reads don't take the lock, dict reads are atomic
+# NOTE: it was sharded by id hash with a lock per shard for a while, under the GIL that was ~20% slower with
+# 8 threads inserting (bench-micro contended_store) and there's no win to show without free-threading, so
+# only the task and join locks are striped
+class TaskStore:
+    def __init__(self):
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, id):
+        return id in self._tasks
+
+    def __getitem__(self, id):
+        return self._tasks[id]
 
+    def get(self, id, default=None):
+        return self._tasks.get(id, default)
 
-task_db: dict[str, Task] = {}
+    def __len__(self):
+        return len(self._tasks)
+
+    # adds the task, raises if a task with the same id already exists
+    def insert(self, task):
+        with self._lock:
+            if task.id in self._tasks:
+                raise ValueError(f"Task with id {task.id} already exists")
+            self._tasks[task.id] = task
+
+    def pop(self, id, default=None):
+        with self._lock:
+            return self._tasks.pop(id, default)
+
+    def get_many(self, ids):
+        tasks = self._tasks
+        return {id: tasks[id] for id in ids if id in tasks}
+
+    def pop_many(self, ids):
+        popped = []
+        with self._lock:
+            for id in ids:
+                task = self._tasks.pop(id, None)
+                if task is not None:
+                    popped.append(task)
+        return popped
+
+    # snapshot of every task
+    def values(self):
+        with self._lock:
+            return list(self._tasks.values())
+
+    def clear(self):
+        with self._lock:
+            self._tasks.clear()
+
+
+task_db = TaskStore()
+task_locks = LockStripes()
+# NOTE: child counters are updated while a task lock may be held so they get their own stripes
+join_locks = LockStripes(num_stripes=256)
+
+# (finished at, id) of top level tasks in the order they succeeded or failed
+# NOTE: the retention sweeper drains this, if it isn't running nothing is ever removed from the store
+finished_top_level_tasks = deque()
 
 mock_info_store = {
     "v1": 1,
@@ -49,27 +167,44 @@ def task_exists(id):
     return id in task_db
 
 
-def create_task(name, version, data, id=None, parent_id=None):
+def create_task(
+    name,
+    version,
+    data,
+    id=None,
+    parent_id=None,
+    join_policy=JoinPolicy.FAIL_FAST,
+    priority=DEFAULT_PRIORITY,
+):
     if id is None:
         id = str(uuid.uuid4())
     if name is None:
         raise ValueError("type must be specified")
     if version is None:
         raise ValueError("version must be specified")
-    if id in task_db:
-        raise ValueError(f"Task with id {id} already exists")
-    if id not in task_db:
-        task_db[id] = Task(
-            id=id,
-            name=name,
-            version=version,
-            status=TaskStatus.CREATED,
-            data=data,
-            parent_id=parent_id,
-            cache={},  # for locally generated values
-        )
+    task = Task(
+        id=id,
+        name=sys.intern(name),
+        version=sys.intern(version),
+        status=TaskStatus.CREATED,
+        data=data,
+        parent_id=parent_id,
+        join_policy=join_policy,
+        priority=priority,
+    )
+    if parent_id is not None:
+        parent_task = get_task(parent_id)
+        task.root_id = parent_task.root_id or parent_id
+        task_db.insert(task)
+        with join_locks.get(parent_id):
+            parent_task.outstanding_children += 1
+            if parent_task.children is None:
+                parent_task.children = []
+            parent_task.children.append(id)
+    else:
+        task_db.insert(task)
     logging.debug(f"Created task {id}, {name}")
-    return task_db[id]
+    return task
 
 
 def create_top_level_task(
@@ -77,6 +212,8 @@ def create_top_level_task(
     version,
     data,
     id=None,
+    join_policy=JoinPolicy.FAIL_FAST,
+    priority=DEFAULT_PRIORITY,
 ):
     if id is None:
         id = str(uuid.uuid4())
@@ -84,27 +221,31 @@ def create_top_level_task(
         raise ValueError("name must be specified")
     if version is None:
         raise ValueError("version must be specified")
-    if id in task_db:
-        raise ValueError(f"Task with id {id} already exists")
-    if id not in task_db:
-        task_db[id] = Task(
-            id=id,
-            name=name,
-            version=version,
-            status=TaskStatus.CREATED,
-            data=data,
-            parent_id=None,
-            cache={},  # for locally generated values
-        )
+    task = Task(
+        id=id,
+        name=sys.intern(name),
+        version=sys.intern(version),
+        status=TaskStatus.CREATED,
+        data=data,
+        parent_id=None,
+        join_policy=join_policy,
+        priority=priority,
+    )
+    task_db.insert(task)
     logging.debug(f"Created task {id}, {name}")
-    return task_db[id]
+    return task
 
 
 def get_task(id):
-    try:
-        return task_db[id]
-    except KeyError:
+    task = task_db.get(id)
+    if task is None:
         raise InvalidTaskIdError(f"Task {id} not found")
+    return task
+
+
+# looks up many tasks at once, ids that don't exist are left out
+def get_tasks(ids):
+    return task_db.get_many(ids)
 
 
 def set_task_status(id, status):
@@ -117,6 +258,8 @@ def set_task_result(id, result):
     task = get_task(id)
     task.result = result
     task.status = TaskStatus.SUCCESS
+    if task.parent_id is None:
+        finished_top_level_tasks.append((time.time(), id))
     logging.debug(f"Set task {id} result to {result}")
 
 
@@ -124,20 +267,175 @@ def set_task_error(id, error):
     task = get_task(id)
     task.error = error
     task.status = TaskStatus.FAILED
+    if task.parent_id is None:
+        finished_top_level_tasks.append((time.time(), id))
     logging.debug(f"Set task {id} error to {error}")
 
 
+RUNNABLE_STATUSES = (TaskStatus.PENDING, TaskStatus.RETRYING, TaskStatus.CREATED)
+
+
+# moves a task that can run to RUNNING and returns it, for the worker that is about to run its body
+# returns None if it already finished, or if it's RUNNING, then it's marked to run again once suspend_task
+# is called for the current run
+def claim_task(id):
+    task = get_task(id)
+    with task.lock:
+        if task.status == TaskStatus.RUNNING:
+            task.rerun = True
+            return None
+        if task.status not in RUNNABLE_STATUSES:
+            return None
+        task.status = TaskStatus.RUNNING
+    logging.debug(f"Claimed task {id}")
+    return task
+
+
+# moves a RUNNING task back to PENDING once its body suspended (or couldn't start)
+# returns whether something tried to run it in the meantime, the caller should queue it again
+def suspend_task(id):
+    task = get_task(id)
+    with task.lock:
+        task.status = TaskStatus.PENDING
+        rerun = task.rerun
+        task.rerun = False
+    logging.debug(f"Suspended task {id}")
+    return rerun
+
+
+# records that a child of the task finished and returns whether the task should be woken up
+# NOTE: a parent that was already evicted (e.g. a failed top level task) has nobody left to wake up
+def complete_child(id, failed=False):
+    task = task_db.get(id)
+    if task is None:
+        logging.debug(f"Task {id} not found, its finished child has nobody to notify")
+        return False
+    with join_locks.get(id):
+        task.outstanding_children -= 1
+        outstanding_children = task.outstanding_children
+    if outstanding_children < 0:
+        logging.warning(f"Task {id} has more completed children than it created")
+    if failed and task.join_policy == JoinPolicy.FAIL_FAST:
+        return True
+    return outstanding_children <= 0
+
+
+def record_journal_entry(id, index, entry):
+    task = get_task(id)
+    if task.journal is None:
+        task.journal = {}
+    task.journal[index] = entry
+
+
+def get_journal_entry(id, index):
+    task = get_task(id)
+    if task.journal is None:
+        return None
+    return task.journal.get(index)
+
+
 def set_task_cache(id, key, value):
     task = get_task(id)
+    if task.cache is None:
+        task.cache = {}
     task.cache[key] = value
     logging.debug(f"Set task {id} cache key {key} to {value}")
 
 
 def get_task_cache(id, key):
     task = get_task(id)
+    if task.cache is None:
+        raise KeyError(key)
     return task.cache[key]
 
 
 def check_exists_task_cache(id, key):
     task = get_task(id)
-    return key in task.cache
+    return task.cache is not None and key in task.cache
+
+
+def is_finished(task):
+    return task.status in (TaskStatus.SUCCESS, TaskStatus.FAILED)
+
+
+def get_children(id):
+    task = get_task(id)
+    with join_locks.get(id):
+        child_ids = list(task.children) if task.children is not None else []
+    return [task_db[child_id] for child_id in child_ids if child_id in task_db]
+
+
+# ids of every task below the task, None if any of them hasn't finished yet
+# or if any task in the tree (including this one) has a finished child that hasn't notified it yet
+def get_finished_descendant_ids(id):
+    descendant_ids = []
+    stack = [id]
+    while stack:
+        task = task_db.get(stack.pop())
+        if task is None:
+            continue
+        if task.outstanding_children > 0:
+            return None
+        if task.children is None:
+            continue
+        for child_id in list(task.children):
+            child = task_db.get(child_id)
+            if child is None:
+                continue
+            if not is_finished(child):
+                return None
+            descendant_ids.append(child_id)
+            stack.append(child_id)
+    return descendant_ids
+
+
+# removes tasks from the store, returns how many were removed
+def evict_tasks(ids):
+    return len(task_db.pop_many(ids))
+
+
+def _deep_sizeof(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_deep_sizeof(v) for v in value)
+    return size
+
+
+# approximate memory used by the task store, broken down by status
+# NOTE: walks every task so it's meant for debugging and benchmarks, not for the hot path
+def memory_report():
+    interned = set()
+    report = {
+        "tasks": 0,
+        "record_bytes": 0,
+        "data_bytes": 0,
+        "result_bytes": 0,
+        "cache_bytes": 0,
+        "journal_bytes": 0,
+        "by_status": {status.name: 0 for status in TaskStatus},
+    }
+    for task in task_db.values():
+        report["tasks"] += 1
+        report["by_status"][task.status.name] += 1
+        report["record_bytes"] += sys.getsizeof(task) + sys.getsizeof(task.id)
+        if task.children is not None:
+            report["record_bytes"] += sys.getsizeof(task.children)
+        # shared strings only count once
+        for value in (task.name, task.version):
+            if id(value) not in interned:
+                interned.add(id(value))
+                report["record_bytes"] += sys.getsizeof(value)
+        report["data_bytes"] += _deep_sizeof(task.data)
+        report["result_bytes"] += _deep_sizeof(task.result) + _deep_sizeof(task.error)
+        if task.cache is not None:
+            report["cache_bytes"] += _deep_sizeof(task.cache)
+        if task.journal is not None:
+            report["journal_bytes"] += sys.getsizeof(task.journal) + sum(
+                sys.getsizeof(entry) for entry in task.journal.values()
+            )
+    report["total_bytes"] = sum(
+        value for key, value in report.items() if key.endswith("_bytes")
+    )
+    return report
@@ -4,3 +4,8 @@ class InvalidTaskStatusError(Exception):
 
 class InvalidTaskIdError(Exception):
     pass
+
+
+# nothing is queued, running or scheduled but some tasks never finished, so they never will
+class StalledTasksError(Exception):
+    pass
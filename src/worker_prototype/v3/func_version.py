@@ -0,0 +1,149 @@
+# Versions for functions decorated without an explicit version
+# The version is a hash of the pickled function. Pickling every function when its module is imported makes
+# worker startup slow, so versions are only computed the first time they're needed and are cached on disk.
+# The disk cache is keyed by where the code object comes from and the mtime/size of its module file, if the
+# file changes the version is recomputed.
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import cloudpickle
+
+logging.basicConfig(level=logging.DEBUG)
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "WORKER_PROTOTYPE_VERSION_CACHE",
+    os.path.join(
+        os.path.expanduser("~"), ".cache", "worker_prototype", "func_versions.json"
+    ),
+)
+
+UNKNOWN_VERSION = "unknown"
+
+
+class VersionCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compute_seconds = 0.0
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            return self._entries.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._load()
+            self._entries[key] = value
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # write then rename so a crash or a concurrent worker never sees a half written file
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self._entries, f)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except OSError as e:
+                logging.debug(f"Could not save function version cache: {e}")
+
+    def stats(self):
+        return {
+            "cache_hits": self.hits,
+            "computed": self.misses,
+            "compute_seconds": self.compute_seconds,
+        }
+
+
+version_cache = VersionCache()
+atexit.register(version_cache.save)
+
+
+# identifies the code of a function across processes, None if it can't be cached (e.g. defined in a REPL)
+def code_cache_key(func):
+    code = getattr(func, "__code__", None)
+    module = sys.modules.get(func.__module__)
+    path = getattr(module, "__file__", None)
+    if code is None or path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return "|".join(
+        [
+            func.__module__,
+            func.__qualname__,
+            str(code.co_firstlineno),
+            path,
+            str(stat.st_mtime_ns),
+            str(stat.st_size),
+            # pickles aren't comparable between python or cloudpickle versions
+            sys.version,
+            cloudpickle.__version__,
+        ]
+    )
+
+
+def compute_func_version(func, cache=version_cache):
+    key = code_cache_key(func)
+    if key is not None:
+        version = cache.get(key)
+        if version is not None:
+            cache.hits += 1
+            return version
+
+    started = time.perf_counter()
+    try:
+        version = hashlib.sha256(cloudpickle.dumps(func)).hexdigest()
+    except Exception:
+        version = UNKNOWN_VERSION
+    cache.compute_seconds += time.perf_counter() - started
+    cache.misses += 1
+
+    if key is not None and version != UNKNOWN_VERSION:
+        cache.set(key, version)
+    return version
+
+
+# the version of a function, computed on first use if it wasn't given explicitly
+class LazyFuncVersion:
+    def __init__(self, func, version=None):
+        self._func = func
+        self._version = version
+        self._lock = threading.Lock()
+
+    @property
+    def resolved(self):
+        return self._version is not None
+
+    def get(self):
+        if self._version is None:
+            with self._lock:
+                if self._version is None:
+                    self._version = compute_func_version(self._func)
+        return self._version
@@ -0,0 +1,120 @@
+from collections import deque
+import logging
+import re
+import threading
+import time
+
+from worker_prototype.v3.q import enqueue_id
+
+logging.basicConfig(level=logging.DEBUG)
+
+_RATE_PERIODS = {"s": 1, "m": 60, "h": 3600}
+
+
+# "100/s", "20/m" or "1000/h" -> (count, period in seconds)
+def parse_rate(rate):
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*/\s*([smh])\s*", rate)
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError(
+            f"rate must look like '100/s', '20/m' or '1000/h', got {rate!r}"
+        )
+    return float(match.group(1)), _RATE_PERIODS[match.group(2)]
+
+
+# Token bucket that hands out future tokens instead of refusing.
+# A caller that is over the rate gets the number of seconds until its token is available and the bucket
+# goes into debt, so callers that are deferred together come back spread out at the rate instead of all
+# at once.
+# NOTE: it holds a single token so starts are evenly spaced, a full second's worth of burst on top of the
+# refill could go over the limit of an API that counts requests in a sliding window
+class TokenBucket:
+    def __init__(self, count, period):
+        self.rate = count / period
+        self.capacity = 1.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    # takes a token, returns how long the caller has to wait before using it
+    # NOTE: not thread safe, TaskLimiter holds its lock around this
+    def reserve(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+
+# Limits how many bodies of a task run at once and how often they start (async_task(max_concurrency=...,
+# rate="100/s")). It's checked when a worker claims a task, a task over the limit isn't run and the
+# worker moves on to the next message:
+# - over max_concurrency the task waits in a FIFO and is queued again when a running one finishes
+# - over the rate it gets a token from the future and is queued again with a delay until then
+# Neither blocks a worker or polls.
+# NOTE: the limits are per process, workers in different processes each get the full limit
+class TaskLimiter:
+    def __init__(self, max_concurrency=None, rate=None):
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self._bucket = TokenBucket(*parse_rate(rate)) if rate is not None else None
+        self._lock = threading.Lock()
+        self._running = 0
+        # (id, priority) of tasks waiting for a concurrency slot
+        self._waiting = deque()
+        # id -> time.monotonic() its token is due, for ids holding a token they were told to wait for
+        self._reserved = {}
+        # ids queued again because a slot freed up
+        self._woken = set()
+        self.deferred_count = 0
+
+    @property
+    def running_count(self):
+        return self._running
+
+    # returns whether the task can run now, if not it has been deferred
+    def try_acquire(self, id, priority):
+        with self._lock:
+            if (
+                self.max_concurrency is not None
+                and self._running >= self.max_concurrency
+            ):
+                # tasks that already waited, for a token or a slot, go back to the front of the line
+                if id in self._reserved or id in self._woken:
+                    self._waiting.appendleft((id, priority))
+                else:
+                    self._waiting.append((id, priority))
+                self.deferred_count += 1
+                return False
+            if self._bucket is not None:
+                now = time.monotonic()
+                due = self._reserved.get(id)
+                if due is None:
+                    wait = self._bucket.reserve()
+                    if wait > 0:
+                        self._reserved[id] = now + wait
+                        self.deferred_count += 1
+                        enqueue_id(id, priority, delay=wait)
+                        return False
+                elif due > now:
+                    # woken up early, e.g. by a child that finished, it keeps its token and waits for it
+                    self.deferred_count += 1
+                    enqueue_id(id, priority, delay=due - now)
+                    return False
+            self._reserved.pop(id, None)
+            self._woken.discard(id)
+            self._running += 1
+            return True
+
+    # called when a body that acquired a slot stops running, whatever the outcome
+    def release(self):
+        with self._lock:
+            self._running -= 1
+            next_task = self._waiting.popleft() if self._waiting else None
+            if next_task is not None:
+                self._woken.add(next_task[0])
+        if next_task is not None:
+            enqueue_id(*next_task)
@@ -1,47 +1,67 @@
-from worker_prototype.v3.db import create_top_level_task, get_task
+import time
+
+# NOTE: taken before the task modules are imported so the startup report includes import time
+_import_started = time.perf_counter()
+
 from worker_prototype.v3.tasks import (
     add_two_random_values_serial_task,
     add_two_random_values_parallel_task,
 )
-from worker_prototype.v3.q import enqueue_id, q, q_lock
-import threading
-import queue
+from worker_prototype.v3.func_version import version_cache
+from worker_prototype.v3.retention import RetentionPolicy, TaskSweeper
+from worker_prototype.v3.worker_pool import (
+    DEFAULT_NUM_WORKERS,
+    WorkerPool,
+    run_until_complete,
+)
 import logging
-from worker_prototype.v3.task_registry import function_runner
 
 logging.basicConfig(level=logging.DEBUG)
 
+_tasks_imported = time.perf_counter()
 
-def queue_worker():
-    # NOTE: currently runs forever
-    while True:
-        message = None
-        with q_lock:
-            try:
-                message = q.get(block=False)
-            except queue.Empty:
-                # NOTE: we should be able to get rid of this by using the queue correctly but it's not the way it will really be run
-                import time
+# finished workflows are kept for an hour, and the store is capped at a million tasks
+DEFAULT_RETENTION_POLICY = RetentionPolicy(ttl=3600, max_entries=1_000_000)
 
-                time.sleep(0.001)
-                continue
-                # logging.debug("Queue is empty, done processing")
-                # return
 
-        threading.Thread(target=function_runner, kwargs={"id": message.id}).start()
+def startup_report(started, imported, ready):
+    stats = version_cache.stats()
+    return (
+        f"Startup: imported tasks in {(imported - started) * 1000:.1f}ms, "
+        f"ready in {(ready - started) * 1000:.1f}ms, "
+        f"{stats['computed']} function versions computed in {stats['compute_seconds'] * 1000:.1f}ms, "
+        f"{stats['cache_hits']} loaded from cache"
+    )
 
 
-def main():
+# until_complete returns {id: result} of the workflows once they all finished, with the workers shut down
+def main(
+    num_workers=DEFAULT_NUM_WORKERS,
+    retention_policy=DEFAULT_RETENTION_POLICY,
+    until_complete=False,
+):
+    ids = []
     for i in range(100):
         # NOTE: clean up file structure...
-        add_two_random_values_serial_task.add_two_random_values_serial_task()
+        ids.append(
+            add_two_random_values_serial_task.add_two_random_values_serial_task()
+        )
 
     for i in range(100):
-        add_two_random_values_parallel_task.add_two_random_values_parallel_task()
-
-    thread = threading.Thread(target=queue_worker)
+        ids.append(
+            add_two_random_values_parallel_task.add_two_random_values_parallel_task()
+        )
 
-    thread.start()
+    # NOTE: otherwise runs forever, call pool.stop() to shut the workers down
+    pool = WorkerPool(num_workers=num_workers)
+    pool.start()
+    if retention_policy is not None:
+        TaskSweeper(retention_policy).start()
+    logging.info(startup_report(_import_started, _tasks_imported, time.perf_counter()))
+    version_cache.save()
+    if until_complete:
+        return run_until_complete(ids, pool)
+    return pool
 
 
 if __name__ == "__main__":
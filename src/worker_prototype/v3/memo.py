@@ -0,0 +1,207 @@
+# Results of pure tasks (@async_task(pure=True)) shared across workflows
+#
+# Task ids include the parent id, so the same call made by two workflows is two tasks and runs twice. A pure
+# task's result only depends on its name, version and arguments, so successful results are cached under a
+# hash of those and any later call, from any parent, is answered from the cache without creating, queuing
+# or waiting on a child task.
+#
+# The cache is an LRU in memory, entries can also expire after a ttl. If it's given a path (or the
+# WORKER_PROTOTYPE_RESULT_CACHE environment variable is set) results are also written to a sqlite file that
+# is checked on a memory miss, so they survive restarts and are shared by worker processes on one machine.
+# NOTE: only JSON serializable results are written to disk, others are only kept in memory
+#
+# Calls are single-flight: while the first call of a key that isn't cached is computing it, later calls with
+# the same key wait for its result instead of computing it again (see lead_or_wait).
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logging.basicConfig(level=logging.DEBUG)
+
+DEFAULT_MAX_ENTRIES = 100_000
+
+DEFAULT_CACHE_PATH = os.environ.get("WORKER_PROTOTYPE_RESULT_CACHE")
+
+_MISSING = object()
+
+# returned by lead_or_wait
+LEAD = object()
+WAIT = object()
+
+
+def memo_key(name, version, encoded_kwargs):
+    hash_obj = hashlib.blake2b(digest_size=32)
+    hash_obj.update(name.encode())
+    hash_obj.update(b"\0")
+    hash_obj.update(version.encode())
+    hash_obj.update(b"\0")
+    hash_obj.update(encoded_kwargs)
+    return hash_obj.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, path=DEFAULT_CACHE_PATH):
+        self.max_entries = max_entries
+        self.path = path
+        # key -> (expires at or None, result), least recently used first
+        self._entries = OrderedDict()
+        # key -> ids of the tasks waiting for the call that is computing it
+        self._in_flight = {}
+        # only guards the memory tier, the disk is read and written outside of it
+        self._lock = threading.Lock()
+        # a sqlite connection per thread, sqlite does its own locking between them
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def _disk(self):
+        if self.path is None:
+            return None
+        db = getattr(self._local, "db", None)
+        if db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            # readers don't wait on a writer
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT, expires_at REAL)"
+            )
+        return db
+
+    # NOTE: callers hold the lock
+    def _get_memory(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, result = entry
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return result
+
+    # returns the cached result, or default if there is none
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            result = self._get_memory(key, now)
+            if result is not _MISSING:
+                self.hits += 1
+                return result
+
+        result = self._get_disk(key, now)
+        with self._lock:
+            if result is _MISSING:
+                self.misses += 1
+                return default
+            self._set_memory(key, result[0], result[1])
+            self.hits += 1
+            return result[1]
+
+    # (expires at, result) or _MISSING
+    def _get_disk(self, key, now):
+        db = self._disk()
+        if db is None:
+            return _MISSING
+        row = db.execute(
+            "SELECT result, expires_at FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return _MISSING
+        result, expires_at = json.loads(row[0]), row[1]
+        if expires_at is not None and expires_at <= now:
+            db.execute("DELETE FROM results WHERE key = ?", (key,))
+            db.commit()
+            return _MISSING
+        return expires_at, result
+
+    def _set_memory(self, key, expires_at, result):
+        self._entries[key] = (expires_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, result, ttl=None):
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._set_memory(key, expires_at, result)
+        db = self._disk()
+        if db is None:
+            return
+        try:
+            encoded = json.dumps(result)
+        except (TypeError, ValueError):
+            return
+        db.execute(
+            "INSERT OR REPLACE INTO results (key, result, expires_at) VALUES (?, ?, ?)",
+            (key, encoded, expires_at),
+        )
+        db.commit()
+
+    # called by a task about to compute key after a cache miss
+    # returns the result if it was cached in the meantime, LEAD if the caller should compute it, otherwise
+    # id is added to the waiters of the call that is already computing it and WAIT is returned
+    def lead_or_wait(self, key, id):
+        with self._lock:
+            result = self._get_memory(key, time.time())
+            if result is not _MISSING:
+                self.hits += 1
+                return result
+            waiters = self._in_flight.get(key)
+            if waiters is None:
+                self._in_flight[key] = []
+                return LEAD
+            waiters.append(id)
+            return WAIT
+
+    # the call computing key finished, set the result first if it succeeded
+    # returns the ids that were waiting for it
+    def finish_in_flight(self, key):
+        with self._lock:
+            return self._in_flight.pop(key, None) or []
+
+    # drops expired entries from both tiers
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [
+                key
+                for key, (expires_at, _) in self._entries.items()
+                if expires_at is not None and expires_at <= now
+            ]
+            for key in expired:
+                del self._entries[key]
+        db = self._disk()
+        if db is not None:
+            db.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        db = self._disk()
+        if db is not None:
+            db.execute("DELETE FROM results")
+            db.commit()
+
+
+result_cache = ResultCache()
+
+
+def get_result_cache():
+    return result_cache
+
+
+# e.g. set_result_cache(ResultCache(path="results.db")) for a disk tier
+def set_result_cache(cache):
+    global result_cache
+    result_cache = cache
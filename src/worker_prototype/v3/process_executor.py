@@ -0,0 +1,105 @@
+# Runs task bodies in a pool of worker processes so CPU heavy tasks aren't serialized on the GIL
+# (@async_task(executor="process"))
+#
+# The task store and queue stay in this process. The body gets a snapshot of the task's children and cache,
+# child calls are answered from that snapshot and children it calls for the first time are sent back so this
+# process can create and enqueue them, exactly like a body running on a thread would have done.
+#
+# NOTE: worker processes are started with "spawn" since forking a process full of threads can deadlock.
+# The function is looked up by module and qualified name in the worker, so process tasks have to be defined
+# at the top level of an importable module.
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import importlib
+import multiprocessing
+import os
+import threading
+
+from worker_prototype.v3.thread_util import set_parent_task_id, set_process_context
+
+DEFAULT_MAX_PROCESS_WORKERS = os.cpu_count() or 1
+
+
+# state of a task body running in a worker process
+@dataclass
+class ProcessContext:
+    task_id: str
+    # child id -> (status, result, error) of the children the task already created
+    children: dict
+    cache: dict
+    # (name, version, id, kwargs, join_policy, priority) of children called for the first time
+    spawned: list = field(default_factory=list)
+    cache_updates: dict = field(default_factory=dict)
+
+
+@dataclass
+class ProcessOutcome:
+    # "success", "suspend", "task_error" (a child failed) or "error"
+    status: str
+    result: object = None
+    error: str = None
+    spawned: list = None
+    cache_updates: dict = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool(max_workers=DEFAULT_MAX_PROCESS_WORKERS):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def shutdown_process_pool(wait=True):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=wait)
+            _pool = None
+
+
+def _resolve_function(module_name, qualname):
+    obj = importlib.import_module(module_name)
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    # the module attribute is the task wrapper, we want the body
+    return getattr(obj, "__wrapped__", obj)
+
+
+# runs in the worker process
+def _run_body(module_name, qualname, task_id, kwargs, children, cache):
+    from worker_prototype.v3.task_wrapper import SuspendTaskError, TaskError
+
+    func = _resolve_function(module_name, qualname)
+    context = ProcessContext(task_id=task_id, children=children, cache=cache)
+    set_process_context(context)
+    set_parent_task_id(task_id)
+    try:
+        outcome = ProcessOutcome(status="success", result=func(**kwargs))
+    except SuspendTaskError:
+        outcome = ProcessOutcome(status="suspend")
+    except TaskError as e:
+        outcome = ProcessOutcome(status="task_error", error=str(e))
+    except Exception as e:
+        outcome = ProcessOutcome(status="error", error=str(e))
+    finally:
+        set_process_context(None)
+        set_parent_task_id(None)
+    outcome.spawned = context.spawned
+    outcome.cache_updates = context.cache_updates
+    return outcome
+
+
+# blocks the calling worker thread until the body has run in a worker process
+def run_in_process(func, task_id, kwargs, children, cache):
+    future = get_process_pool().submit(
+        _run_body, func.__module__, func.__qualname__, task_id, kwargs, children, cache
+    )
+    return future.result()
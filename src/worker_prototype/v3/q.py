@@ -1,25 +1,275 @@
-import queue
 import threading
+import time
+from collections import deque
 from dataclasses import dataclass
 
+from worker_prototype.v3.metrics import metrics_registry
+from worker_prototype.v3.timers import TimerScheduler
 
-q = queue.Queue()
-# NOTE: the python queue might already be multi-thread safe, but I'm too lazy to figure out how to use it correctly
-q_lock = threading.Lock()
+
+# priority levels, lower is more urgent
+# e.g. interactive workflows at HIGH_PRIORITY so they don't sit behind backfills queued at LOW_PRIORITY
+NUM_PRIORITY_LEVELS = 5
+HIGH_PRIORITY = 0
+DEFAULT_PRIORITY = 2
+LOW_PRIORITY = NUM_PRIORITY_LEVELS - 1
+
+# a message that waited this many seconds is served as if it was one level more urgent, and so on
+DEFAULT_AGING_INTERVAL = 10.0
+
+# parents woken up by their children are queued this many levels more urgent than their own priority so
+# workflows that are already under way finish before new ones of the same priority start, 0 turns it off
+DEFAULT_RESUME_BOOST = 1
 
 
 @dataclass
 class QueueMessage:
     id: str = None
+    priority: int = DEFAULT_PRIORITY
+
+
+def validate_priority(priority):
+    if not isinstance(priority, int) or not HIGH_PRIORITY <= priority <= LOW_PRIORITY:
+        raise ValueError(
+            f"priority must be an int from {HIGH_PRIORITY} to {LOW_PRIORITY}, got {priority!r}"
+        )
+
+
+def create_message(id, priority=DEFAULT_PRIORITY):
+    validate_priority(priority)
+    return QueueMessage(id=id, priority=priority)
+
+
+# Priority queue of messages that consumers can block on, a FIFO per priority level.
+# Producers notify a condition variable on every put so a waiting worker wakes up as soon as a message
+# is published instead of polling. It's also the only lock around the messages (no extra global lock).
+#
+# Messages are coalesced per task id: at most one message for a task is queued or running at a time.
+# - putting an id that is already queued is a no-op
+# - putting an id that is currently running marks it dirty and it is re-queued once, when the consumer
+#   calls task_done, so a notification that arrives mid-run isn't lost
+# This matters for parents with many children, each child completion would otherwise cause a full replay.
+# A put for a queued or dirty id with a more urgent priority moves the message up.
+#
+# The most urgent level is served first. To keep a steady stream of urgent messages from starving the
+# others, a message's level is lowered by one for every aging_interval seconds it has been waiting.
+class TaskQueue:
+    def __init__(
+        self,
+        num_levels=NUM_PRIORITY_LEVELS,
+        aging_interval=DEFAULT_AGING_INTERVAL,
+    ):
+        # (queued at, message) per level
+        # NOTE: a message moved to a more urgent level leaves a stale entry behind, it's skipped when reached
+        self._levels = [deque() for _ in range(num_levels)]
+        self._aging_interval = aging_interval
+        self._cond = threading.Condition()
+        self._closed = False
+        # id -> the queued message
+        self._queued = {}
+        self._running = set()
+        self._dirty = {}
+        # changes whenever a message is queued, handed out or done, see idle_generation
+        self._generation = 0
+        self.coalesced_count = 0
+
+    def _append(self, message):
+        self._queued[message.id] = message
+        self._levels[message.priority].append((time.monotonic(), message))
+        self._generation += 1
+        self._cond.notify()
+
+    def put(self, message):
+        with self._cond:
+            queued = self._queued.get(message.id)
+            if queued is not None:
+                self.coalesced_count += 1
+                if message.priority < queued.priority:
+                    self._append(message)
+                return
+            if message.id in self._running:
+                self.coalesced_count += 1
+                dirty = self._dirty.get(message.id)
+                if dirty is None or message.priority < dirty.priority:
+                    self._dirty[message.id] = message
+                return
+            self._append(message)
+
+    def put_many(self, messages):
+        for message in messages:
+            self.put(message)
+
+    # blocks until a message is available
+    # returns None if the timeout expires or the queue is closed
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                popped = self._pop()
+                if popped is not None:
+                    queued_at, message = popped
+                    self._running.add(message.id)
+                    self._generation += 1
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+        queue_wait_seconds.observe(time.monotonic() - queued_at)
+        return message
+
+    # (queued at, message) of the oldest message of the level with the most urgent aged priority
+    # None if there are no messages
+    def _pop(self):
+        now = time.monotonic()
+        best_level = None
+        best_priority = None
+        for level, messages in enumerate(self._levels):
+            # drop stale entries of messages that moved to another level or were already handed out
+            while (
+                messages and self._queued.get(messages[0][1].id) is not messages[0][1]
+            ):
+                messages.popleft()
+            if not messages:
+                continue
+            priority = level
+            if self._aging_interval:
+                priority -= (now - messages[0][0]) / self._aging_interval
+            if best_priority is None or priority < best_priority:
+                best_level = level
+                best_priority = priority
+        if best_level is None:
+            return None
+        queued_at, message = self._levels[best_level].popleft()
+        del self._queued[message.id]
+        return queued_at, message
+
+    # consumers must call this once they are done with a message they got
+    def task_done(self, id):
+        with self._cond:
+            self._running.discard(id)
+            self._generation += 1
+            message = self._dirty.pop(id, None)
+            if message is not None:
+                self._append(message)
+
+    # wakes every waiting consumer and stops handing out messages
+    # messages can still be put and are kept until the queue is re-opened
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def qsize(self):
+        with self._cond:
+            return len(self._queued)
+
+    # number of queued messages per level
+    def level_sizes(self):
+        with self._cond:
+            sizes = [0] * len(self._levels)
+            for message in self._queued.values():
+                sizes[message.priority] += 1
+            return sizes
 
+    def empty(self):
+        return self.qsize() == 0
 
-def create_message(id):
-    return QueueMessage(id=id)
+    def running_count(self):
+        with self._cond:
+            return len(self._running)
 
+    # None if any message is queued or running, otherwise a number that changes as soon as one is put
+    # two equal numbers mean the queue stayed idle in between, see worker_pool.run_until_complete
+    def idle_generation(self):
+        with self._cond:
+            if self._queued or self._running:
+                return None
+            return self._generation
 
-def enqueue_id(id):
+
+queue_wait_seconds = metrics_registry.histogram(
+    "v3_queue_wait_seconds", "Time messages spent queued before a worker got them"
+)
+
+q = TaskQueue()
+resume_boost = DEFAULT_RESUME_BOOST
+
+
+def get_queue():
+    return q
+
+
+# swap the queue used by enqueue_id and by worker pools created afterwards
+# e.g. set_queue(RedisTaskQueue()) to share the queue between worker processes
+def set_queue(task_queue):
+    global q
+    q = task_queue
+
+
+def set_resume_boost(levels):
+    global resume_boost
+    resume_boost = levels
+
+
+# delayed messages are put on whatever queue is current when they are due
+timers = TimerScheduler(dispatch=lambda messages: q.put_many(messages))
+
+metrics_registry.gauge(
+    "v3_queue_depth", "Messages waiting in the current queue"
+).set_function(lambda: q.qsize())
+metrics_registry.gauge(
+    "v3_timers_pending", "Delayed messages waiting for their time"
+).set_function(lambda: timers.pending_count)
+
+
+# monotonic deadline for a run_at (time.time() value) or delay in seconds, None to put the message now
+def _deadline(run_at, delay):
+    if run_at is not None and delay is not None:
+        raise ValueError("only one of run_at and delay can be specified")
+    if run_at is not None:
+        return time.monotonic() + (run_at - time.time())
+    if delay is not None:
+        return time.monotonic() + delay
+    return None
+
+
+def enqueue_id(id, priority=DEFAULT_PRIORITY, run_at=None, delay=None):
     if id is None:
         raise ValueError("id must be specified")
-    message = create_message(id)
-    with q_lock:
+    message = create_message(id, priority)
+    deadline = _deadline(run_at, delay)
+    if deadline is None:
         q.put(message)
+    else:
+        timers.schedule(message, deadline)
+
+
+def enqueue_ids(ids, priority=DEFAULT_PRIORITY, run_at=None, delay=None):
+    if any(id is None for id in ids):
+        raise ValueError("id must be specified")
+    messages = [create_message(id, priority) for id in ids]
+    deadline = _deadline(run_at, delay)
+    if deadline is None:
+        q.put_many(messages)
+    else:
+        for message in messages:
+            timers.schedule(message, deadline)
+
+
+# wakes up a parent whose children finished, boosted by resume_boost levels
+def enqueue_resume(id, priority=DEFAULT_PRIORITY):
+    enqueue_id(id, max(HIGH_PRIORITY, priority - resume_boost))
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+
+from redis import WatchError
+
+from worker_prototype.v0.queue.redis_queue import ReliableQueue
+from worker_prototype.v3.q import create_message
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+# Redis backed drop-in for worker_prototype.v3.q.TaskQueue so several worker processes can share a queue
+# use it with set_queue(RedisTaskQueue()) before creating the worker pool
+#
+# - messages are moved into a per-process processing list when dequeued and only removed by task_done,
+#   a background thread keeps this process's heartbeat alive and puts messages held by dead processes
+#   back on the queue
+# - like TaskQueue an id is only queued once, puts for an id that is already queued are dropped
+#   NOTE: unlike TaskQueue a put for an id that is currently running isn't deferred, it's queued again
+# - a put adds the id to the queued set and the list in one MULTI transaction, so a crash can't leave an id
+#   in the set without a list entry (which would drop every later put for it), claims aren't transactions
+#   but recover the same way as a crashed worker, see get
+#   NOTE: WATCH based rather than Lua so it also runs on fakeredis
+# - NOTE: message priorities are ignored, it's a single FIFO
+class RedisTaskQueue:
+    def __init__(
+        self,
+        name="v3",
+        namespace="queue",
+        worker_id=None,
+        connection=None,
+        heartbeat_ttl=30,
+        # how long a single blocking pop waits, this bounds how long close() takes to be noticed
+        block_timeout=1,
+    ):
+        self._queue = ReliableQueue(
+            name,
+            namespace=namespace,
+            worker_id=worker_id,
+            connection=connection,
+            heartbeat_ttl=heartbeat_ttl,
+        )
+        self._db = self._queue._db
+        self._queued_key = f"{self._queue.key}:queued"
+        self._block_timeout = block_timeout
+        self._closed = False
+        self._keep_alive_thread = None
+        self._keep_alive_stop = threading.Event()
+        self._keep_alive_lock = threading.Lock()
+        # messages handed out by get and not finished yet
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self.coalesced_count = 0
+
+    @property
+    def worker_id(self):
+        return self._queue.worker_id
+
+    def put(self, message):
+        self.put_many([message])
+
+    def put_many(self, messages):
+        ids = list(dict.fromkeys(message.id for message in messages))
+        if not ids:
+            return
+        new_ids = self._enqueue_new(ids)
+        self.coalesced_count += len(messages) - len(new_ids)
+
+    # adds the ids that aren't queued yet to the set and the list in one transaction, returns them
+    def _enqueue_new(self, ids):
+        batch_size = self._queue.batch_size
+        with self._db.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self._queued_key)
+                    queued = pipe.smismember(self._queued_key, ids)
+                    new_ids = [
+                        id for id, is_queued in zip(ids, queued) if not is_queued
+                    ]
+                    if not new_ids:
+                        pipe.unwatch()
+                        return new_ids
+                    pipe.multi()
+                    pipe.sadd(self._queued_key, *new_ids)
+                    for i in range(0, len(new_ids), batch_size):
+                        pipe.rpush(self._queue.key, *new_ids[i : i + batch_size])
+                    pipe.execute()
+                    return new_ids
+                except WatchError:
+                    continue
+
+    # heartbeats and orphan recovery run on a daemon thread, so a task that runs longer than heartbeat_ttl
+    # isn't mistaken for an orphan
+    def _start_keep_alive(self):
+        with self._keep_alive_lock:
+            if self._keep_alive_thread is not None:
+                return
+            self._queue.heartbeat()
+            self._keep_alive_stop.clear()
+            self._keep_alive_thread = threading.Thread(
+                target=self._keep_alive, name="v3-redis-heartbeat", daemon=True
+            )
+            self._keep_alive_thread.start()
+
+    def _keep_alive(self):
+        while not self._keep_alive_stop.wait(self._queue.heartbeat_ttl / 3):
+            try:
+                self._queue.heartbeat()
+                self.requeue_orphans()
+            except Exception:
+                logging.exception("Failed to refresh the queue heartbeat")
+
+    def _stop_keep_alive(self):
+        with self._keep_alive_lock:
+            thread = self._keep_alive_thread
+            self._keep_alive_thread = None
+            self._keep_alive_stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    # blocks until a message is available
+    # returns None if the timeout expires or the queue is closed
+    # NOTE: a claim is the BLMOVE into the processing list and then an SREM from the queued set, 2 round trips
+    # and no retries however many workers wait on the queue. A put in between is dropped like a put for a
+    # queued id, it's about to run anyway. A crash in between leaves the id in the set, requeue_orphans puts
+    # it back on the list, which makes the two agree again
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._start_keep_alive()
+        while not self._closed:
+            block_timeout = self._block_timeout
+            if deadline is not None:
+                block_timeout = min(block_timeout, deadline - time.monotonic())
+            if block_timeout > 0:
+                id = self._queue.dequeue(timeout=block_timeout)
+            else:
+                # 0 would block forever
+                id = self._db.lmove(
+                    self._queue.key, self._queue.processing_key, "LEFT", "RIGHT"
+                )
+            if id is not None:
+                with self._in_flight_lock:
+                    self._in_flight += 1
+                self._db.srem(self._queued_key, id)
+                return create_message(id.decode() if isinstance(id, bytes) else id)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+        return None
+
+    def task_done(self, id):
+        self._queue.ack(id)
+        with self._in_flight_lock:
+            self._in_flight -= 1
+            stop = self._closed and self._in_flight == 0
+        if stop:
+            self._stop_keep_alive()
+
+    # puts messages held by dead workers back on the queue
+    def requeue_orphans(self):
+        requeued = self._queue.requeue_orphans(queued_key=self._queued_key)
+        if requeued:
+            logging.debug(f"Requeued {len(requeued)} orphaned messages")
+        return len(requeued)
+
+    # stops handing out messages, the heartbeat keeps going until the messages already handed out are done
+    # so another process doesn't requeue them while a worker pool is still draining
+    def close(self):
+        with self._in_flight_lock:
+            self._closed = True
+            stop = self._in_flight == 0
+        if stop:
+            self._stop_keep_alive()
+
+    def open(self):
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def qsize(self):
+        return self._queue.size()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    # messages this process has dequeued but not finished
+    def running_count(self):
+        return self._db.llen(self._queue.processing_key)
+
+    def clear(self):
+        self._db.delete(self._queued_key)
+        self._queue.clear()
@@ -0,0 +1,148 @@
+# Retention for finished workflows
+# Nothing else ever removes tasks from the store, so without this a long running worker grows without bound.
+# A task tree can be removed once its top level task has succeeded or failed and every task in it has finished,
+# at that point nothing can replay any of them.
+from collections import Counter, deque
+from dataclasses import dataclass
+import logging
+import threading
+import time
+
+from worker_prototype.v3.db import (
+    evict_tasks,
+    finished_top_level_tasks,
+    get_finished_descendant_ids,
+    task_db,
+)
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+@dataclass
+class RetentionPolicy:
+    # seconds after a top level task finished before its whole tree is removed, None keeps them forever
+    ttl: float = None
+    # maximum number of tasks in the store, the oldest finished trees are removed first to stay under it
+    max_entries: int = None
+    # remove the descendants of a finished top level task right away, only its own result/error is kept
+    top_level_results_only: bool = False
+
+
+# ids someone still needs to read, their trees are kept until they are unpinned (e.g. by run_until_complete)
+# counted, so the same id can be pinned more than once
+pinned_ids = Counter()
+pinned_ids_lock = threading.Lock()
+
+
+def pin_tasks(ids):
+    with pinned_ids_lock:
+        pinned_ids.update(ids)
+
+
+def unpin_tasks(ids):
+    with pinned_ids_lock:
+        pinned_ids.subtract(ids)
+        for id in ids:
+            if pinned_ids[id] <= 0:
+                del pinned_ids[id]
+
+
+def _is_pinned(ids):
+    with pinned_ids_lock:
+        return any(id in pinned_ids for id in ids)
+
+
+def _evict_tree(id, keep_top_level):
+    descendant_ids = get_finished_descendant_ids(id)
+    if descendant_ids is None:
+        return None
+    if pinned_ids and _is_pinned(descendant_ids + [id]):
+        return None
+    if keep_top_level:
+        task = task_db.get(id)
+        if task is not None:
+            task.data = None
+            task.cache = None
+            task.journal = None
+            task.children = None
+        return evict_tasks(descendant_ids)
+    return evict_tasks(descendant_ids + [id])
+
+
+class TaskSweeper:
+    def __init__(self, policy, interval=1.0):
+        self.policy = policy
+        self.interval = interval
+        # (finished at, id) of finished top level tasks that are still in the store, oldest first
+        self._finished = deque()
+        # finished top level tasks that still have their descendants in the store
+        self._unstripped = []
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.evicted_count = 0
+
+    # one pass over the finished top level tasks, returns the number of tasks removed
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        policy = self.policy
+        evicted = 0
+
+        while finished_top_level_tasks:
+            entry = finished_top_level_tasks.popleft()
+            self._finished.append(entry)
+            if policy.top_level_results_only:
+                self._unstripped.append(entry[1])
+
+        if policy.top_level_results_only:
+            still_unstripped = []
+            for id in self._unstripped:
+                removed = _evict_tree(id, keep_top_level=True)
+                if removed is None:
+                    still_unstripped.append(id)
+                else:
+                    evicted += removed
+            self._unstripped = still_unstripped
+
+        # finished trees that can't be removed yet because some task in them is still running
+        retry = []
+        while self._finished:
+            finished_at, id = self._finished[0]
+            expired = policy.ttl is not None and now - finished_at >= policy.ttl
+            over_capacity = (
+                policy.max_entries is not None and len(task_db) > policy.max_entries
+            )
+            if not expired and not over_capacity:
+                break
+            self._finished.popleft()
+            removed = _evict_tree(id, keep_top_level=False)
+            if removed is None:
+                retry.append((finished_at, id))
+            else:
+                evicted += removed
+        # they are still the oldest
+        self._finished.extendleft(reversed(retry))
+
+        if evicted:
+            logging.debug(f"Evicted {evicted} finished tasks, {len(task_db)} left")
+        self.evicted_count += evicted
+        return evicted
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Task sweep failed")
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="v3-task-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop_event.set()
+        if wait and self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,18 @@
+# The task store used by the task wrapper and the workers, a module with the functions of
+# worker_prototype.v3.db (the default, tasks are kept in memory)
+# e.g. sql_db.init_db(url), set_store(sql_db) and set_queue(SqlTaskQueue()) before creating the worker pool
+# to keep workflows across restarts
+# NOTE: TaskSweeper and batched tasks only work with the in-memory store
+from worker_prototype.v3 import db
+
+store = db
+
+
+def get_store():
+    return store
+
+
+# swap the store used by tasks submitted and run afterwards
+def set_store(task_store):
+    global store
+    store = task_store
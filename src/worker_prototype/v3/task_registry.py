@@ -1,23 +1,53 @@
 # task registry
-from worker_prototype.v3.db import get_task
-
+import logging
 import threading
 
-from worker_prototype.v3.thread_util import set_task_id
+from worker_prototype.v3.errors import InvalidTaskIdError
+from worker_prototype.v3.store import get_store
+from worker_prototype.v3.thread_util import set_parent_task_id, set_task_id
 
 
 class FunctionRegistry:
     def __init__(self):
         self._registry = {}
+        # names of the functions in _registry
+        self._names = set()
+        # name -> (func, LazyFuncVersion) for a function whose version hasn't been computed yet
+        self._lazy = {}
+        self._lock = threading.Lock()
 
+    # version can be a string or a LazyFuncVersion, lazy versions are only computed when the function is looked up
+    # NOTE: a duplicate (name, version) raises here, a lazy version is computed right away if another function
+    # already uses the name so a duplicate can't only show up in a worker
     def register(self, func, name, version):
+        with self._lock:
+            if isinstance(version, str):
+                self._resolve(name)
+                self._add(func, name, version)
+            elif name in self._lazy or name in self._names:
+                self._resolve(name)
+                self._add(func, name, version.get())
+            else:
+                self._lazy[name] = (func, version)
+
+    def _add(self, func, name, version):
         if (name, version) in self._registry:
             raise ValueError(
                 f"Function {name} with version {version} already registered"
             )
         self._registry[(name, version)] = func
+        self._names.add(name)
+
+    def _resolve(self, name):
+        lazy = self._lazy.pop(name, None)
+        if lazy is not None:
+            func, lazy_version = lazy
+            self._add(func, name, lazy_version.get())
 
     def get(self, name, version):
+        if (name, version) not in self._registry:
+            with self._lock:
+                self._resolve(name)
         return self._registry[(name, version)]
 
 
@@ -25,9 +55,18 @@ function_registry = FunctionRegistry()
 
 
 def function_runner(id):
-    task = get_task(id)
+    try:
+        task = get_store().get_task(id)
+    except InvalidTaskIdError:
+        # e.g. a stale wake-up for a workflow that already finished and was evicted
+        logging.debug(f"Task {id} not found, skipping")
+        return
     name = task.name
     version = task.version
     func = function_registry.get(name, version)
+    # worker threads are long-lived so start every run from a clean thread context
+    set_parent_task_id(None)
     set_task_id(id)
+    # NOTE: an async task runs its body on a loop of its own here, use worker_prototype.v3.async_worker to run
+    # many of them at once
     func(**task.data)
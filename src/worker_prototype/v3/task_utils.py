@@ -1,9 +1,9 @@
-from worker_prototype.v3.db import get_task
 from worker_prototype.v3.errors import InvalidTaskStatusError
+from worker_prototype.v3.store import get_store
 
 
 def validate_task_status(id, expected_status_list, no_error=False):
-    task = get_task(id)
+    task = get_store().get_task(id)
     if task.status not in expected_status_list:
         if no_error:
             return False
@@ -1,30 +1,34 @@
+import asyncio
 import functools
 import hashlib
+import inspect
 import json
 import logging
-import cloudpickle
-
-from worker_prototype.v3.db import (
-    TaskStatus,
-    create_task,
-    get_task,
-    task_exists,
-    set_task_status,
-    set_task_result,
-    set_task_error,
-    create_top_level_task,
-    get_task_cache,
-    set_task_cache,
-    check_exists_task_cache,
+import time
+
+from worker_prototype.v3.db import JoinPolicy, TaskStatus, JournalEntry
+from worker_prototype.v3.errors import InvalidTaskIdError
+from worker_prototype.v3.func_version import LazyFuncVersion
+from worker_prototype.v3.limits import TaskLimiter
+from worker_prototype.v3.memo import LEAD, WAIT, get_result_cache, memo_key
+from worker_prototype.v3.metrics import metrics_registry
+from worker_prototype.v3.process_executor import run_in_process
+from worker_prototype.v3.q import (
+    DEFAULT_PRIORITY,
+    enqueue_id,
+    enqueue_resume,
+    validate_priority,
 )
-from worker_prototype.v3.q import enqueue_id
+from worker_prototype.v3.store import get_store
 from worker_prototype.v3.task_registry import function_registry
-from worker_prototype.v3.task_utils import validate_task_status
+from worker_prototype.v3.tracing import get_tracer
 from worker_prototype.v3.thread_util import (
     get_parent_task_id,
     set_parent_task_id,
     get_task_id,
     set_task_id,
+    next_call_index,
+    get_process_context,
 )
 
 logging.basicConfig(level=logging.DEBUG)
@@ -38,6 +42,33 @@ class SuspendTaskError(TaskError):
     pass
 
 
+# an unexpected error raised by a task body that ran in a worker process
+class ProcessTaskError(Exception):
+    pass
+
+
+EXECUTORS = ("thread", "process")
+
+_NOT_CACHED = object()
+
+task_runs = metrics_registry.counter(
+    "v3_task_runs_total", "Runs of task bodies, including replays", ["task"]
+)
+task_replays = metrics_registry.counter(
+    "v3_task_replays_total",
+    "Runs of task bodies that had already created children",
+    ["task"],
+)
+task_outcomes = metrics_registry.counter(
+    "v3_task_outcomes_total",
+    "How runs of task bodies ended: suspend, success or fail",
+    ["task", "outcome"],
+)
+task_run_seconds = metrics_registry.histogram(
+    "v3_task_run_seconds", "Time spent running task bodies", ["task"]
+)
+
+
 def hash_values(*values):
     # NOTE: is this too slow/memory intensive?
     hash_obj = hashlib.sha256()
@@ -67,50 +98,265 @@ def get_func_name(func, name):
 # I think realistically we should require a version and have the test suite warn if the cloudpickle hash changes
 # like how jest requires you to re-snapshot values if they change
 # I'm not sure how reliable it will be but I also don't like purely relying on humans to update it manually
+# NOTE: the hash is computed lazily and cached on disk, see worker_prototype.v3.func_version
 def get_func_version(func, version):
-    if version is None:
-        try:
-            version = hash_values(cloudpickle.dumps(func))
-        except Exception as e:
-            version = "unknown"
-    return version
+    return LazyFuncVersion(func, version).get()
+
+
+# single canonical encoding of task arguments, used both to check they are JSON serializable and to hash them
+# sorting the keys makes the encoding (and so the task id) independent of argument order
+_canonical_encoder = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+
+
+def encode_kwargs(kwargs):
+    try:
+        return _canonical_encoder.encode(kwargs).encode()
+    except (TypeError, ValueError):
+        raise TypeError("All arguments must be JSON serializable")
+
+
+# task ids are a hash of name, version, parent task id and the encoded arguments
+# the hash state for the (name, version) prefix is computed once per function and copied for every call
+# NOTE: blake2b is at least as fast as sha256 here and doesn't depend on openssl
+class TaskIdHasher:
+    def __init__(self, name, version):
+        self._prefix = hashlib.blake2b(digest_size=32)
+        self._prefix.update(name.encode())
+        self._prefix.update(b"\0")
+        self._prefix.update(version.encode())
+        self._prefix.update(b"\0")
+
+    def task_id(self, parent_task_id, encoded_kwargs):
+        hash_obj = self._prefix.copy()
+        if parent_task_id is not None:
+            hash_obj.update(parent_task_id.encode())
+        hash_obj.update(b"\0")
+        hash_obj.update(encoded_kwargs)
+        return hash_obj.hexdigest()
 
 
 def generate_task_id(func, name, version, parent_task_id, kwargs):
-    # Hash all the individual hashes together to form the final task ID
-    task_id = hash_values(name, version, parent_task_id, kwargs)
+    return TaskIdHasher(name, version).task_id(parent_task_id, encode_kwargs(kwargs))
+
 
-    return task_id
+# re-enqueue the parent of a finished task if its join policy says it can make progress
+# NOTE: without this the parent would be replayed once per finished child just to suspend again
+def notify_parent(task, failed=False):
+    if task.parent_id is None:
+        return
+    if get_store().complete_child(task.parent_id, failed=failed):
+        try:
+            parent = get_store().get_task(task.parent_id)
+        except InvalidTaskIdError:
+            # evicted by the sweeper in the meantime, it had finished so there's nothing to resume
+            return
+        enqueue_resume(parent.id, parent.priority)
+
+
+# children without a priority of their own inherit their parent's
+def start_child_task(
+    name,
+    version,
+    parent_id,
+    id,
+    data,
+    join_policy,
+    priority=None,
+    enqueue=enqueue_id,
+):
+    if priority is None:
+        priority = get_store().get_task(parent_id).priority
+    task = get_store().create_task(
+        name=name,
+        version=version,
+        parent_id=parent_id,
+        id=id,
+        data=data,
+        join_policy=join_policy,
+        priority=priority,
+    )
+    with task.lock:
+        # PENDING before it's queued, a worker in another process can claim it from a shared queue right away
+        get_store().set_task_status(id, TaskStatus.PENDING)
+        enqueue(id, priority)
+
+
+# a pure child whose key isn't cached, only the first of these for a key is queued, the ones created while it
+# runs wait for its result (see finish_pure_waiters)
+# returns the result if it was cached in the meantime, _NOT_CACHED otherwise
+def start_pure_child_task(
+    key, name, version, parent_id, id, data, join_policy, priority, enqueue
+):
+    cached = _NOT_CACHED
+
+    # called with the child's lock held, so a leader finishing right away waits until the call is set up
+    def lead_or_wait(id, priority):
+        nonlocal cached
+        outcome = get_result_cache().lead_or_wait(key, id)
+        if outcome is LEAD:
+            enqueue(id, priority)
+        elif outcome is not WAIT:
+            cached = outcome
+
+    start_child_task(
+        name,
+        version,
+        parent_id,
+        id,
+        data,
+        join_policy,
+        priority,
+        enqueue=lead_or_wait,
+    )
+    if cached is not _NOT_CACHED:
+        with get_store().get_task(id).lock:
+            get_store().set_task_result(id, result=cached)
+        # the parent is running and gets the result right away, nothing to wake up
+        get_store().complete_child(parent_id)
+    return cached
+
+
+# finishes the tasks that waited on a pure call with the same key, or queues them to compute it themselves if
+# it failed
+def finish_pure_waiters(key, result=None, failed=False):
+    for id in get_result_cache().finish_in_flight(key):
+        task = get_store().get_task(id)
+        if failed:
+            enqueue_id(id, task.priority)
+            continue
+        with task.lock:
+            get_store().set_task_result(id, result=result)
+        notify_parent(task)
+
+
+# runs the body of the task in a worker process, returns or raises like the body would have on this thread
+def run_body_in_process(task, func, kwargs):
+    children = {
+        child.id: (child.status, child.result, child.error)
+        for child in get_store().get_children(task.id)
+    }
+    outcome = run_in_process(func, task.id, kwargs, children, dict(task.cache or {}))
+
+    for key, value in outcome.cache_updates.items():
+        get_store().set_task_cache(task.id, key, value)
+    for name, version, id, data, join_policy, priority in outcome.spawned:
+        if not get_store().task_exists(id):
+            start_child_task(name, version, task.id, id, data, join_policy, priority)
+
+    if outcome.status == "success":
+        return outcome.result
+    if outcome.status == "suspend":
+        raise SuspendTaskError(f"Task {task.id} is waiting on its children.")
+    if outcome.status == "task_error":
+        raise TaskError(outcome.error)
+    raise ProcessTaskError(outcome.error)
+
+
+def in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
 
 
 # NOTE: I lock the task (and would mimic w/ a row level db lock) but perhaps that behavior isn't perfect
+# the lock only guards status changes, the running status is what stops a task from running twice at once
 def async_task(
     retries=0,
     name=None,
     version=None,
     id_generator=generate_task_id,
+    join_policy=JoinPolicy.FAIL_FAST,
+    # "process" runs the body in a worker process, for CPU bound tasks
+    executor="thread",
+    # queue priority, lower runs first (see worker_prototype.v3.q)
+    # None runs top level tasks at DEFAULT_PRIORITY and children at their parent's priority
+    priority=None,
+    # most bodies of this task running at once in this process
+    max_concurrency=None,
+    # most bodies of this task started per second/minute/hour in this process, e.g. "100/s"
+    rate=None,
+    # called with (id, priority) instead of enqueue_id to schedule new children, see worker_prototype.v3.batching
+    enqueue_child=enqueue_id,
+    # the result only depends on the arguments, so it's shared by every workflow (see worker_prototype.v3.memo)
+    pure=False,
+    # seconds a pure task's result is cached for, None keeps it until it's evicted
+    ttl=None,
 ):
+    if executor not in EXECUTORS:
+        raise ValueError(f"executor must be one of {EXECUTORS}, got {executor!r}")
+    if priority is not None:
+        validate_priority(priority)
+
     def decorator_task(func):
+        # async def bodies run on an event loop, see worker_prototype.v3.async_worker
+        is_async = inspect.iscoroutinefunction(func)
+        if is_async and executor == "process":
+            raise ValueError("async tasks can't run in a worker process")
         # register the function
         function_name = get_func_name(func, name)
-        function_version = get_func_version(func, version)
+        # looked up once, labels() is the expensive part of recording
+        runs_metric = task_runs.labels(function_name)
+        replays_metric = task_replays.labels(function_name)
+        suspends_metric = task_outcomes.labels(function_name, "suspend")
+        successes_metric = task_outcomes.labels(function_name, "success")
+        failures_metric = task_outcomes.labels(function_name, "fail")
+        run_seconds_metric = task_run_seconds.labels(function_name)
+        limiter = None
+        if max_concurrency is not None or rate is not None:
+            limiter = TaskLimiter(max_concurrency=max_concurrency, rate=rate)
+        # NOTE: computing the version pickles the function so it's deferred until the task is first used
+        lazy_version = LazyFuncVersion(func, version)
         func.name = function_name
-        func.version = function_version
-
-        @functools.wraps(func)
-        def wrapper_task(**kwargs):
+        task_id_hasher = None
+
+        def get_task_id_hasher():
+            nonlocal task_id_hasher
+            if task_id_hasher is None:
+                task_id_hasher = TaskIdHasher(function_name, lazy_version.get())
+            return task_id_hasher
+
+        # everything but running the body
+        # returns (task, None) if the caller should run the body for the task, otherwise (None, value) where
+        # value is what the call returns
+        def start_call(kwargs):
             logging.debug(f"Running task {function_name} with kwargs {kwargs}")
-            # Ensure arguments are JSON serializable
-            try:
-                json.dumps(kwargs)
-            except TypeError:
-                raise TypeError("All arguments must be JSON serializable")
-
+            store = get_store()
             parent_task_id = get_parent_task_id()
             thread_task_id = get_task_id()
             # NOTE: feels like a hack - prevents subtasks from using this task id
             set_task_id(None)
 
+            # set when we are a child call in a body running in a worker process, see run_body_in_process
+            process_context = get_process_context()
+
+            call_index = None
+            if (
+                thread_task_id is None
+                and parent_task_id is not None
+                and process_context is None
+            ):
+                # we are a child call in a replay of the parent's body, calls that already finished are
+                # answered from the parent's journal so a replay doesn't pay for the id and lookup again
+                call_index = next_call_index()
+                entry = store.get_journal_entry(parent_task_id, call_index)
+                if entry is not None:
+                    # comparing the call is enough to check the body is still deterministic
+                    if entry.name == function_name and entry.kwargs == kwargs:
+                        if entry.error is not None:
+                            raise TaskError(
+                                f"Task {entry.child_id} failed with error {entry.error}"
+                            )
+                        return None, entry.result
+                    logging.warning(
+                        f"Task {parent_task_id} made a different call at position {call_index} than in a previous run, is it deterministic?"
+                    )
+
+            # Ensure arguments are JSON serializable, the encoding is reused for the task id
+            encoded_kwargs = encode_kwargs(kwargs)
+            function_version = lazy_version.get()
+
             if thread_task_id is not None:
                 logging.debug(
                     f"Thread task id is {thread_task_id} so we are in the function runner"
@@ -120,24 +366,64 @@ def async_task(
                 logging.debug(
                     f"Thread task id is not set so we are running for the first time"
                 )
-                task_id = id_generator(
-                    func=func,
-                    name=function_name,
-                    version=function_version,
-                    parent_task_id=parent_task_id,
-                    kwargs=kwargs,
-                )
+                if id_generator is generate_task_id:
+                    task_id = get_task_id_hasher().task_id(
+                        parent_task_id, encoded_kwargs
+                    )
+                else:
+                    task_id = id_generator(
+                        func=func,
+                        name=function_name,
+                        version=function_version,
+                        parent_task_id=parent_task_id,
+                        kwargs=kwargs,
+                    )
 
-            if parent_task_id is not None:
+            if parent_task_id is not None and process_context is not None:
+                # the store lives in the parent process, answer from the snapshot of the children
+                child = process_context.children.get(task_id)
+                if child is None:
+                    process_context.spawned.append(
+                        (
+                            function_name,
+                            function_version,
+                            task_id,
+                            kwargs,
+                            join_policy,
+                            priority,
+                        )
+                    )
+                    process_context.children[task_id] = (TaskStatus.PENDING, None, None)
+                    raise SuspendTaskError(f"Task {task_id} is enqueued.")
+                status, result, error = child
+                if status == TaskStatus.SUCCESS:
+                    return None, result
+                if status == TaskStatus.FAILED:
+                    raise TaskError(f"Task {task_id} failed with error {error}")
+                raise SuspendTaskError(f"Task {task_id} is still pending.")
+
+            elif parent_task_id is not None:
                 # we are within another task
 
-                if task_exists(task_id):
-                    task = get_task(task_id)
+                if store.task_exists(task_id):
+                    task = store.get_task(task_id)
 
                     with task.lock:
                         if task:
+                            if task.status in [TaskStatus.SUCCESS, TaskStatus.FAILED]:
+                                store.record_journal_entry(
+                                    parent_task_id,
+                                    call_index,
+                                    JournalEntry(
+                                        name=function_name,
+                                        kwargs=kwargs,
+                                        child_id=task_id,
+                                        result=task.result,
+                                        error=task.error,
+                                    ),
+                                )
                             if task.status == TaskStatus.SUCCESS:
-                                return task.result
+                                return None, task.result
                             if task.status == TaskStatus.FAILED:
                                 raise TaskError(
                                     f"Task {task_id} failed with error {task.error}"
@@ -149,100 +435,247 @@ def async_task(
                                     f"Task {task_id} is still pending."
                                 )
                 else:
-                    task = create_task(
-                        name=function_name,
-                        version=function_version,
-                        parent_id=parent_task_id,
-                        id=task_id,
-                        data=kwargs,
-                    )
-                    with task.lock:
-                        enqueue_id(task_id)
-                        set_task_status(task_id, TaskStatus.PENDING)
-                        raise SuspendTaskError(f"Task {task_id} is enqueued.")
-
-            else:
-                if task_exists(task_id):
-                    task = get_task(task_id)
-                    with task.lock:
-                        # TODO: probably more validation possible in this function
-                        if not validate_task_status(
+                    result = _NOT_CACHED
+                    if pure:
+                        key = memo_key(function_name, function_version, encoded_kwargs)
+                        result = get_result_cache().get(key, _NOT_CACHED)
+                        if result is _NOT_CACHED:
+                            result = start_pure_child_task(
+                                key,
+                                function_name,
+                                function_version,
+                                parent_task_id,
+                                task_id,
+                                kwargs,
+                                join_policy,
+                                priority,
+                                enqueue=enqueue_child,
+                            )
+                    else:
+                        start_child_task(
+                            function_name,
+                            function_version,
+                            parent_task_id,
                             task_id,
-                            [
-                                TaskStatus.PENDING,
-                                TaskStatus.RETRYING,
-                                TaskStatus.CREATED,
-                            ],
-                            no_error=True,
-                        ):
-                            # we probably already succeeded or failed
-                            return
-                        # In case of being the main (not within another task)
-                        set_task_status(task_id, TaskStatus.RUNNING)
-
-                        try:
-                            set_parent_task_id(task_id)
-                            # TODO: add retry logic (for now we can just allow people to wrap their function in a retry decorator)
-                            result = func(**kwargs)
-                            set_parent_task_id(None)
-                            set_task_status(task_id, TaskStatus.SUCCESS)
-                            set_task_result(task_id, result=result)
-
-                            logging.debug(f"Task {task_id} succeeded! Info {task}")
-
-                            # re-enqueue parent task
-                            if task.parent_id is not None:
-                                enqueue_id(task.parent_id)
-                            return
-
-                        except SuspendTaskError:
-                            # Handle suspend - save the state or requeue, as needed.
-                            set_task_status(task_id, TaskStatus.PENDING)
-
-                            # this means a sub-task of this task is still running
-                            return
-
-                        except TaskError as e:
-                            # Handle subtask error
-                            set_task_status(task_id, TaskStatus.FAILED)
-
-                            error_string = f"Task {task_id} failed becasue subtask failed with error {e}"
-
-                            set_task_error(task_id, error=error_string)
-
-                            logging.debug(f"Task {task_id} failed! Info {task}")
-
-                            # re-enqueue parent task
-                            if task.parent_id is not None:
-                                enqueue_id(task.parent_id)
-                            return
+                            kwargs,
+                            join_policy,
+                            priority,
+                            enqueue=enqueue_child,
+                        )
+                    if result is not _NOT_CACHED:
+                        # answered from the cache, the journal answers it on replays
+                        store.record_journal_entry(
+                            parent_task_id,
+                            call_index,
+                            JournalEntry(
+                                name=function_name,
+                                kwargs=kwargs,
+                                child_id=task_id,
+                                result=result,
+                            ),
+                        )
+                        return None, result
+                    raise SuspendTaskError(f"Task {task_id} is enqueued.")
 
-                        except Exception as e:
-                            # Handle unexpected error
-                            # NOTE: we could also handle retry logic here
-
-                            set_task_status(task_id, TaskStatus.FAILED)
-
-                            error_string = f"Task {task_id} failed with error {e}"
-                            set_task_error(task_id, error=error_string)
-
-                            logging.debug(f"Task {task_id} failed! Info {task}")
-
-                            # re-enqueue parent task
-                            if task.parent_id is not None:
-                                enqueue_id(task.parent_id)
-                            return
+            else:
+                exists = store.task_exists(task_id)
+                if exists and thread_task_id is None:
+                    # submitted again from outside a worker, it's already queued or finished so the
+                    # queue runs it like the first submission
+                    return None, task_id
+                elif exists:
+                    # moves it to RUNNING so no other worker runs it at the same time, the lock is only held
+                    # for status changes, not while the body runs, so a parent and its children never wait on
+                    # each other's (striped) locks
+                    task = store.claim_task(task_id)
+                    if task is None:
+                        # already finished, or another worker is running it and it runs again once that one
+                        # is done
+                        return None, None
+                    if limiter is not None and not limiter.try_acquire(
+                        task_id, task.priority
+                    ):
+                        # over the limit, the limiter queues it again when it can run
+                        store.suspend_task(task_id)
+                        return None, None
+                    return task, None
                 else:
-                    create_top_level_task(
+                    top_level_priority = (
+                        DEFAULT_PRIORITY if priority is None else priority
+                    )
+                    store.create_top_level_task(
                         name=function_name,
                         version=function_version,
                         id=task_id,
                         data=kwargs,
+                        join_policy=join_policy,
+                        priority=top_level_priority,
                     )
-                    enqueue_id(task_id)
-                    return
+                    if pure:
+                        key = memo_key(function_name, function_version, encoded_kwargs)
+                        result = get_result_cache().get(key, _NOT_CACHED)
+                        if result is _NOT_CACHED:
+                            result = get_result_cache().lead_or_wait(key, task_id)
+                        if result is WAIT:
+                            return None, task_id
+                        if result is not LEAD:
+                            store.set_task_result(task_id, result=result)
+                            return None, task_id
+                    enqueue_id(task_id, top_level_priority)
+                    # submitting a top level task returns its id, e.g. for run_until_complete
+                    return None, task_id
+
+        def pure_key(task):
+            return memo_key(task.name, task.version, encode_kwargs(task.data))
+
+        # counts a run of the body that is about to start
+        # returns when it started and whether it's a replay
+        def start_run(task):
+            runs_metric.inc()
+            replay = task.children is not None
+            if replay:
+                replays_metric.inc()
+            return time.perf_counter(), replay
+
+        # records how a run of the body ended, error is the exception it raised if any
+        def finish_run(task, started, replay, result=None, error=None):
+            task_id = task.id
+            duration = time.perf_counter() - started
+            run_seconds_metric.observe(duration)
+            if limiter is not None:
+                limiter.release()
+            if isinstance(error, SuspendTaskError):
+                suspends_metric.inc()
+                get_tracer().record(task, "suspend", duration, replay)
+                # Handle suspend - save the state or requeue, as needed.
+                if get_store().suspend_task(task_id):
+                    # another worker tried to run it in the meantime
+                    enqueue_id(task_id, task.priority)
+
+                # this means a sub-task of this task is still running
+                return
+
+            if error is not None:
+                failures_metric.inc()
+                get_tracer().record(task, "fail", duration, replay, error=str(error))
+
+            if isinstance(error, TaskError):
+                # Handle subtask error
+                error_string = (
+                    f"Task {task_id} failed becasue subtask failed with error {error}"
+                )
 
-        function_registry.register(wrapper_task, function_name, function_version)
+                with task.lock:
+                    get_store().set_task_error(task_id, error=error_string)
+                if pure:
+                    finish_pure_waiters(pure_key(task), failed=True)
+
+                logging.debug(f"Task {task_id} failed! Info {task}")
+
+                # re-enqueue parent task
+                notify_parent(task, failed=True)
+                return
+
+            if error is not None:
+                # Handle unexpected error
+                # NOTE: we could also handle retry logic here
+                error_string = f"Task {task_id} failed with error {error}"
+
+                with task.lock:
+                    get_store().set_task_error(task_id, error=error_string)
+                if pure:
+                    finish_pure_waiters(pure_key(task), failed=True)
+
+                logging.debug(f"Task {task_id} failed! Info {task}")
+
+                # re-enqueue parent task
+                notify_parent(task, failed=True)
+                return
+
+            successes_metric.inc()
+            get_tracer().record(task, "success", duration, replay)
+            with task.lock:
+                get_store().set_task_result(task_id, result=result)
+
+            if pure:
+                key = pure_key(task)
+                get_result_cache().set(key, result, ttl=ttl)
+                finish_pure_waiters(key, result)
+
+            logging.debug(f"Task {task_id} succeeded! Info {task}")
+
+            # re-enqueue parent task
+            notify_parent(task)
+
+        if is_async:
+            # NOTE: child calls never wait on anything, they return, fail or suspend right away like the
+            # synchronous ones, only the body of a running task awaits
+            async def run_body(task, kwargs):
+                started, replay = start_run(task)
+                try:
+                    set_parent_task_id(task.id)
+                    try:
+                        result = await func(**kwargs)
+                    finally:
+                        set_parent_task_id(None)
+                except Exception as e:
+                    finish_run(task, started, replay, error=e)
+                    return
+                finish_run(task, started, replay, result=result)
+
+            async def run_task(kwargs):
+                task, value = start_call(kwargs)
+                if task is None:
+                    return value
+                await run_body(task, kwargs)
+
+            # not an async def itself so it can be called from synchronous code like a synchronous task:
+            # submitting creates and queues the task and returns its id, a child call from a synchronous body
+            # returns, fails or suspends right away and a worker thread runs the body on a loop of its own
+            # on an event loop (an async body or the async worker) the call returns a coroutine to await
+            @functools.wraps(func)
+            def wrapper_task(**kwargs):
+                submitting = get_task_id() is None and get_parent_task_id() is None
+                if not submitting and in_event_loop():
+                    return run_task(kwargs)
+                task, value = start_call(kwargs)
+                if task is None:
+                    return value
+                return asyncio.run(run_body(task, kwargs))
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper_task(**kwargs):
+                task, value = start_call(kwargs)
+                if task is None:
+                    return value
+                started, replay = start_run(task)
+                try:
+                    set_parent_task_id(task.id)
+                    # TODO: add retry logic (for now we can just allow people to wrap their function in a retry decorator)
+                    try:
+                        if executor == "process":
+                            result = run_body_in_process(task, func, kwargs)
+                        else:
+                            result = func(**kwargs)
+                    finally:
+                        # worker threads are reused so don't leak this into the next task
+                        set_parent_task_id(None)
+                except Exception as e:
+                    finish_run(task, started, replay, error=e)
+                    return
+                finish_run(task, started, replay, result=result)
+
+        # NOTE: set on the wrapper, anything attached to func ends up in its pickle and so in its version
+        wrapper_task.get_version = lazy_version.get
+        wrapper_task.limiter = limiter
+        # the wrapper of an async def body is a plain function, workers check this instead
+        wrapper_task.is_async = is_async
+        # an explicit version is registered as is, so a duplicate fails right here
+        function_registry.register(
+            wrapper_task, function_name, lazy_version if version is None else version
+        )
 
         return wrapper_task
 
@@ -277,18 +710,72 @@ def run_in_parallel(tasks):
         return results
 
 
+# awaitable version of run_in_parallel for async task bodies, takes a list of functions returning awaitables
+# NOTE: the awaitables run concurrently, so helpers that do their own I/O before calling a task overlap too
+async def run_in_parallel_async(tasks):
+    outcomes = await asyncio.gather(*(task() for task in tasks), return_exceptions=True)
+
+    suspend_exception = None
+    fail_exception = None
+    other_exception = None
+
+    results = []
+
+    for outcome in outcomes:
+        if isinstance(outcome, SuspendTaskError):
+            suspend_exception = outcome
+        elif isinstance(outcome, TaskError):
+            fail_exception = outcome
+        elif isinstance(outcome, BaseException):
+            other_exception = outcome
+        else:
+            results.append(outcome)
+
+    if other_exception is not None:
+        raise other_exception
+    elif fail_exception is not None:
+        raise fail_exception
+    elif suspend_exception is not None:
+        raise suspend_exception
+    else:
+        return results
+
+
 # NOTE: this is like a local version of the task decorator, not sure if there's any useful shared logic
 def task_cache(key):
     def decorator_task_cache(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                task_id = get_parent_task_id()
+
+                if get_store().check_exists_task_cache(task_id, key):
+                    return get_store().get_task_cache(task_id, key)
+                value = await func(*args, **kwargs)
+                get_store().set_task_cache(task_id, key, value)
+                return value
+
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             task_id = get_parent_task_id()
 
-            if check_exists_task_cache(task_id, key):
-                return get_task_cache(task_id, key)
+            process_context = get_process_context()
+            if process_context is not None:
+                # running in a worker process, new values are copied back by run_body_in_process
+                if key not in process_context.cache:
+                    value = func(*args, **kwargs)
+                    process_context.cache[key] = value
+                    process_context.cache_updates[key] = value
+                return process_context.cache[key]
+
+            if get_store().check_exists_task_cache(task_id, key):
+                return get_store().get_task_cache(task_id, key)
             else:
                 value = func(*args, **kwargs)
-                set_task_cache(task_id, key, value)
+                get_store().set_task_cache(task_id, key, value)
                 return value
 
         return wrapper
@@ -1,21 +1,48 @@
-import threading
+from contextvars import ContextVar
+import itertools
 
 ### Saving and retrieving the parent task ID and current task ID
 
-thread_local_data = threading.local()
+# NOTE: these are context variables instead of thread locals so task bodies running as asyncio tasks on one
+# thread each see their own values. A thread starts with an empty context, so worker threads behave as before.
+_parent_task_id = ContextVar("parent_task_id", default=None)
+_task_id = ContextVar("task_id", default=None)
+# shared by every coroutine a body starts (asyncio copies the context for each) so they number calls together
+_call_counter = ContextVar("call_counter", default=None)
+_process_context = ContextVar("process_context", default=None)
 
 
 def set_parent_task_id(task_id):
-    thread_local_data.parent_task_id = task_id
+    _parent_task_id.set(task_id)
+    # every run of a task body numbers its child calls from 0
+    _call_counter.set(itertools.count())
 
 
 def get_parent_task_id():
-    return getattr(thread_local_data, "parent_task_id", None)
+    return _parent_task_id.get()
 
 
 def set_task_id(task_id):
-    thread_local_data.task_id = task_id
+    _task_id.set(task_id)
 
 
 def get_task_id():
-    return getattr(thread_local_data, "task_id", None)
+    return _task_id.get()
+
+
+# position of the next child call within the running task body
+def next_call_index():
+    counter = _call_counter.get()
+    if counter is None:
+        counter = itertools.count()
+        _call_counter.set(counter)
+    return next(counter)
+
+
+# set while a task body runs in a worker process, see worker_prototype.v3.process_executor
+def set_process_context(context):
+    _process_context.set(context)
+
+
+def get_process_context():
+    return _process_context.get()
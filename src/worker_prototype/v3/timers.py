@@ -0,0 +1,114 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+logging.basicConfig(level=logging.DEBUG)
+
+# timers are grouped into buckets this many seconds wide and fire at the end of their bucket
+DEFAULT_RESOLUTION = 0.01
+
+
+# Holds items until their deadline and then hands them to dispatch, used for delayed messages.
+#
+# Timers are kept in buckets of `resolution` seconds: a dict of bucket -> items plus a heap of the buckets
+# that have items. Adding a timer to a bucket that already exists is an append, only a new bucket pays
+# for a heap push, so millions of timers with nearby deadlines are cheap to add.
+# A single daemon thread sleeps on a condition until the earliest bucket is due (or an earlier timer is
+# added), it never polls, so an idle scheduler doesn't use any CPU.
+class TimerScheduler:
+    def __init__(self, dispatch, resolution=DEFAULT_RESOLUTION):
+        if resolution <= 0:
+            raise ValueError("resolution must be positive")
+        # called with the list of due items, outside the lock
+        self._dispatch = dispatch
+        self._resolution = resolution
+        self._buckets = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._pending = 0
+        # due items still being handed to dispatch, they count as pending until it returns
+        self._dispatching = 0
+
+    @property
+    def pending_count(self):
+        with self._cond:
+            return self._pending + self._dispatching
+
+    # deadline is a time.monotonic() value
+    def schedule(self, item, deadline):
+        # round up so a timer never fires early
+        bucket = math.ceil(deadline / self._resolution)
+        with self._cond:
+            items = self._buckets.get(bucket)
+            if items is None:
+                items = self._buckets[bucket] = []
+                heapq.heappush(self._heap, bucket)
+                # the dispatcher may be sleeping until a later bucket
+                if self._heap[0] == bucket:
+                    self._cond.notify()
+            items.append(item)
+            self._pending += 1
+            # a dispatcher that is stopping but hasn't exited yet keeps going
+            self._stopped = False
+            if self._thread is None:
+                self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="v3-timers", daemon=True)
+        self._thread.start()
+
+    # pops every bucket that is due, waits until the next one is if there are none
+    def _next_due(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                remaining = self._heap[0] * self._resolution - now
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                due = []
+                while self._heap and self._heap[0] * self._resolution <= now:
+                    due.extend(self._buckets.pop(heapq.heappop(self._heap)))
+                self._pending -= len(due)
+                self._dispatching = len(due)
+                return due
+            return None
+
+    def _run(self):
+        while True:
+            due = self._next_due()
+            if due is None:
+                with self._cond:
+                    if self._stopped:
+                        self._thread = None
+                        return
+                continue
+            try:
+                self._dispatch(due)
+            except Exception:
+                logging.exception(f"Failed to dispatch {len(due)} timers")
+            finally:
+                with self._cond:
+                    self._dispatching = 0
+
+    # pending timers are kept and fire once another timer starts the scheduler again
+    def stop(self, wait=True, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if wait and thread is not None:
+            thread.join(timeout)
+
+    def clear(self):
+        with self._cond:
+            self._buckets.clear()
+            self._heap.clear()
+            self._pending = 0
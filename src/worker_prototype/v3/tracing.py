@@ -0,0 +1,243 @@
+# Spans for every run of a task body, for looking at how a workflow tree actually ran
+#
+# Each run (the first one and every replay) is a span with the task and parent ids, wall clock start/end and
+# how it ended (suspend, success or fail). Spans go into a fixed size ring buffer, once it's full the oldest
+# are dropped. Sampling is decided per workflow from the id of its top level task, so a sampled workflow
+# is recorded completely and the rest cost close to nothing.
+#
+# export_chrome_trace writes a file for chrome://tracing or ui.perfetto.dev, export_otlp_json writes the
+# OpenTelemetry JSON format. In the OTLP export every task also gets a span covering all its runs, so
+# the runs of a task are grouped under it and tasks are nested under their parent task.
+from collections import deque
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+from worker_prototype.v3.db import task_db
+
+DEFAULT_CAPACITY = 65536
+DEFAULT_SAMPLE_RATE = 1.0
+
+
+@dataclass(slots=True)
+class Span:
+    trace_id: str
+    task_id: str
+    parent_id: str
+    name: str
+    # time.time_ns()
+    start: int
+    end: int
+    # suspend, success or fail
+    outcome: str
+    # the task had already created children when the run started, so it replayed its body
+    replay: bool
+    thread_id: int
+    error: str = None
+
+
+# id of the top level task of the workflow the task belongs to
+# NOTE: tasks know their root since they were created, the walk up is only for ones that don't (e.g. loaded
+# from another store), if an ancestor was already evicted the oldest one still in the store is used
+def find_root_id(task):
+    if task.parent_id is None:
+        return task.id
+    if task.root_id is not None:
+        return task.root_id
+    while task.parent_id is not None:
+        parent = task_db.get(task.parent_id)
+        if parent is None:
+            return task.parent_id
+        task = parent
+    return task.id
+
+
+class Tracer:
+    def __init__(self, capacity=DEFAULT_CAPACITY, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        # NOTE: appends to a bounded deque are atomic, so recording doesn't take a lock
+        # spans are kept as tuples in Span field order, building the dataclass is left to spans()
+        self._spans = deque(maxlen=capacity)
+        self._threshold = int(sample_rate * 0xFFFFFFFF)
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    # the same answer for a workflow in every process
+    def sampled(self, trace_id):
+        return zlib.crc32(trace_id.encode()) <= self._threshold
+
+    def record(self, task, outcome, duration, replay=False, error=None):
+        if not self.enabled:
+            return
+        trace_id = find_root_id(task)
+        if not self.sampled(trace_id):
+            return
+        end = time.time_ns()
+        self._spans.append(
+            (
+                trace_id,
+                task.id,
+                task.parent_id,
+                task.name,
+                end - int(duration * 1e9),
+                end,
+                outcome,
+                replay,
+                threading.get_ident(),
+                error,
+            )
+        )
+
+    # snapshot of the recorded spans, oldest first
+    def spans(self):
+        return [Span(*span) for span in list(self._spans)]
+
+    def clear(self):
+        self._spans.clear()
+
+
+tracer = Tracer()
+
+
+def get_tracer():
+    return tracer
+
+
+# e.g. set_tracer(Tracer(sample_rate=0.01)), or Tracer(sample_rate=0) to turn tracing off
+def set_tracer(new_tracer):
+    global tracer
+    tracer = new_tracer
+
+
+def export_chrome_trace(path, spans=None):
+    if spans is None:
+        spans = tracer.spans()
+    pid = os.getpid()
+    events = [
+        {
+            "name": span.name,
+            "cat": "replay" if span.replay else "run",
+            "ph": "X",
+            "ts": span.start / 1000,
+            "dur": (span.end - span.start) / 1000,
+            "pid": pid,
+            "tid": span.thread_id,
+            "args": {
+                "task_id": span.task_id,
+                "parent_id": span.parent_id,
+                "trace_id": span.trace_id,
+                "outcome": span.outcome,
+                "error": span.error,
+            },
+        }
+        for span in spans
+    ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return len(events)
+
+
+def _hex_id(value, size):
+    return hashlib.blake2b(value.encode(), digest_size=size).hexdigest()
+
+
+def _attributes(values):
+    attributes = []
+    for key, value in values.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            attributes.append({"key": key, "value": {"boolValue": value}})
+        else:
+            attributes.append({"key": key, "value": {"stringValue": str(value)}})
+    return attributes
+
+
+# OTLP status codes
+_STATUS_OK = 1
+_STATUS_ERROR = 2
+
+
+def export_otlp_json(path, spans=None, service_name="worker_prototype"):
+    if spans is None:
+        spans = tracer.spans()
+
+    # one span per task around its runs, parented to the span of its parent task
+    tasks = {}
+    for span in spans:
+        task = tasks.get(span.task_id)
+        if task is None:
+            tasks[span.task_id] = task = {
+                "first": span,
+                "start": span.start,
+                "end": span.end,
+            }
+        task["start"] = min(task["start"], span.start)
+        task["end"] = max(task["end"], span.end)
+        task["last"] = span
+
+    otlp_spans = []
+    for task_id, task in tasks.items():
+        first, last = task["first"], task["last"]
+        otlp_spans.append(
+            {
+                "traceId": _hex_id(first.trace_id, 16),
+                "spanId": _hex_id(task_id, 8),
+                "parentSpanId": _hex_id(first.parent_id, 8) if first.parent_id else "",
+                "name": first.name,
+                "kind": 1,
+                "startTimeUnixNano": str(task["start"]),
+                "endTimeUnixNano": str(task["end"]),
+                "attributes": _attributes(
+                    {"task.id": task_id, "task.outcome": last.outcome}
+                ),
+                "status": {
+                    "code": _STATUS_ERROR if last.outcome == "fail" else _STATUS_OK
+                },
+            }
+        )
+    for index, span in enumerate(spans):
+        otlp_spans.append(
+            {
+                "traceId": _hex_id(span.trace_id, 16),
+                "spanId": _hex_id(f"{span.task_id}:{span.start}:{index}", 8),
+                "parentSpanId": _hex_id(span.task_id, 8),
+                "name": f"{span.name} {'replay' if span.replay else 'run'}",
+                "kind": 1,
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end),
+                "attributes": _attributes(
+                    {
+                        "task.id": span.task_id,
+                        "task.outcome": span.outcome,
+                        "task.replay": span.replay,
+                        "thread.id": span.thread_id,
+                        "exception.message": span.error,
+                    }
+                ),
+                "status": {
+                    "code": _STATUS_ERROR if span.outcome == "fail" else _STATUS_OK,
+                    "message": span.error or "",
+                },
+            }
+        )
+
+    document = {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": _attributes({"service.name": service_name})},
+                "scopeSpans": [
+                    {"scope": {"name": "worker_prototype.v3"}, "spans": otlp_spans}
+                ],
+            }
+        ]
+    }
+    with open(path, "w") as f:
+        json.dump(document, f)
+    return len(otlp_spans)
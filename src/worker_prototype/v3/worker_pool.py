@@ -0,0 +1,196 @@
+from collections import deque
+import logging
+import threading
+import time
+
+from worker_prototype.v3.db import TaskStatus
+from worker_prototype.v3.errors import StalledTasksError
+from worker_prototype.v3.metrics import metrics_registry
+from worker_prototype.v3.q import get_queue, timers
+from worker_prototype.v3.retention import pin_tasks, unpin_tasks
+from worker_prototype.v3.store import get_store
+from worker_prototype.v3.task_registry import function_runner
+from worker_prototype.v3.task_wrapper import TaskError
+
+logging.basicConfig(level=logging.DEBUG)
+
+DEFAULT_NUM_WORKERS = 8
+# how often run_until_complete checks on the tasks
+DEFAULT_POLL_INTERVAL = 0.005
+
+workers_total = metrics_registry.gauge("v3_workers", "Worker threads started")
+workers_busy = metrics_registry.gauge(
+    "v3_workers_busy", "Worker threads running a task"
+)
+# rate() of this over v3_workers is the utilization
+worker_busy_seconds = metrics_registry.counter(
+    "v3_worker_busy_seconds_total", "Time worker threads spent running tasks"
+)
+
+
+# A fixed set of long-lived worker threads that pull messages off the queue and run them.
+# This replaces starting a new thread for every message, so the number of threads (and their memory)
+# stays flat no matter how deep the queue gets.
+class WorkerPool:
+    def __init__(
+        self, num_workers=DEFAULT_NUM_WORKERS, runner=function_runner, task_queue=None
+    ):
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+        self.num_workers = num_workers
+        self._runner = runner
+        self._queue = task_queue if task_queue is not None else get_queue()
+        self._threads = []
+        self._busy_lock = threading.Lock()
+        self._busy = 0
+
+    @property
+    def busy_count(self):
+        with self._busy_lock:
+            return self._busy
+
+    @property
+    def is_running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    @property
+    def task_queue(self):
+        return self._queue
+
+    def start(self):
+        if self.is_running:
+            raise RuntimeError("Worker pool is already running")
+        self._queue.open()
+        self._threads = [
+            threading.Thread(
+                target=self._worker_loop, name=f"v3-worker-{i}", daemon=False
+            )
+            for i in range(self.num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logging.debug(f"Started worker pool with {self.num_workers} workers")
+
+    # workers finish the message they are currently running before exiting
+    # NOTE: this closes the queue, so pools sharing a queue are stopped together
+    def stop(self, wait=True, timeout=None):
+        self._queue.close()
+        if wait:
+            for thread in self._threads:
+                thread.join(timeout)
+        logging.debug("Stopped worker pool")
+
+    def _worker_loop(self):
+        workers_total.inc()
+        try:
+            self._run_messages()
+        finally:
+            workers_total.dec()
+
+    def _run_messages(self):
+        while True:
+            # blocks until a message is published, None means the queue was closed
+            message = self._queue.get()
+            if message is None:
+                return
+
+            with self._busy_lock:
+                self._busy += 1
+            workers_busy.inc()
+            started = time.perf_counter()
+            try:
+                self._runner(id=message.id)
+            except Exception:
+                # a broken task shouldn't take a worker down with it
+                logging.exception(f"Worker failed to run task {message.id}")
+            finally:
+                self._queue.task_done(message.id)
+                worker_busy_seconds.inc(time.perf_counter() - started)
+                workers_busy.dec()
+                with self._busy_lock:
+                    self._busy -= 1
+
+
+# nothing is queued, being run by any worker or waiting on a timer, so no task can make progress
+# NOTE: only sees this process, with a queue shared between processes (e.g. RedisTaskQueue) there is no
+# way to tell whether workers elsewhere are still busy
+def is_quiescent(task_queue):
+    generation = task_queue.idle_generation()
+    if generation is None:
+        return False
+    # a timer that fires puts a message, and scheduling one takes a running task, either changes the generation
+    if timers.pending_count:
+        return False
+    return task_queue.idle_generation() == generation
+
+
+def task_outcome(task):
+    if task.status == TaskStatus.FAILED:
+        return TaskError(task.error)
+    return task.result
+
+
+# Runs the workers until the submitted top level tasks are finished and nothing else is left to do, then
+# shuts them down, for batch jobs that should exit as soon as their work is done.
+# Returns {id: result}, the result of a failed task is a TaskError with its error.
+# Raises StalledTasksError if the queue goes quiet before they all finish (e.g. a message was lost) and
+# TimeoutError after timeout seconds, the workers are stopped either way.
+# Starts a WorkerPool of num_workers if no worker (WorkerPool or AsyncWorker) is passed in.
+def run_until_complete(
+    ids,
+    worker=None,
+    num_workers=DEFAULT_NUM_WORKERS,
+    timeout=None,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+):
+    if worker is None:
+        worker = WorkerPool(num_workers=num_workers)
+    task_queue = worker.task_queue
+    if not hasattr(task_queue, "idle_generation"):
+        raise ValueError(
+            f"run_until_complete needs an in-process TaskQueue, got {type(task_queue).__name__}"
+        )
+    ids = list(ids)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    # tasks are checked in submission order and each poll only looks at the first unfinished one, the ones
+    # after it may finish first so they are pinned until they are recorded, or a TaskSweeper could evict them
+    remaining = deque(ids)
+    results = {}
+    pin_tasks(ids)
+    try:
+        store = get_store()
+        missing = [id for id in ids if id is None or not store.task_exists(id)]
+        if missing:
+            raise ValueError(
+                f"run_until_complete got {len(missing)} ids that aren't submitted tasks, e.g. {missing[0]!r}"
+            )
+        if not worker.is_running:
+            worker.start()
+        try:
+            while True:
+                # checked first, nothing finishes once the queue is quiet
+                quiescent = is_quiescent(task_queue)
+                while remaining:
+                    task = store.get_task(remaining[0])
+                    if not store.is_finished(task):
+                        break
+                    results[task.id] = task_outcome(task)
+                    remaining.popleft()
+                    unpin_tasks([task.id])
+                if quiescent:
+                    if remaining:
+                        raise StalledTasksError(
+                            f"{len(remaining)} tasks can't finish, the first is {remaining[0]}"
+                        )
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError(
+                        f"{len(remaining)} tasks still running after {timeout}s"
+                    )
+                time.sleep(poll_interval)
+        finally:
+            worker.stop()
+    finally:
+        unpin_tasks(remaining)
+    logging.debug(f"Ran {len(results)} tasks to completion")
+    return {id: results[id] for id in ids}
@@ -0,0 +1,13 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# the function version cache is saved at exit, keep it out of the home directory
+# NOTE: has to be set before worker_prototype is imported, the path is read at import time
+_version_cache_dir = tempfile.mkdtemp(prefix="worker_prototype_tests_")
+atexit.register(shutil.rmtree, _version_cache_dir, ignore_errors=True)
+os.environ.setdefault(
+    "WORKER_PROTOTYPE_VERSION_CACHE",
+    os.path.join(_version_cache_dir, "func_versions.json"),
+)
@@ -0,0 +1,59 @@
+import json
+import logging
+
+import pytest
+
+from worker_prototype.bench import micro
+
+
+def results(**benchmarks):
+    return {
+        "meta": {"scale": 1.0},
+        "results": {
+            name: {"number": number, "median_ns": median_ns, "noise": noise}
+            for name, (number, median_ns, noise) in benchmarks.items()
+        },
+    }
+
+
+def test_compare_allows_more_for_noisy_benchmarks():
+    baseline = results(quiet=(100, 100.0, 0.0), noisy=(100, 100.0, 0.05))
+    current = results(quiet=(100, 120.0, 0.0), noisy=(100, 120.0, 0.05))
+    comparison = micro.compare(baseline, current, threshold=0.15)
+
+    before, after, ratio, allowed, regressed = comparison["quiet"]
+    assert (before, after, regressed) == (100.0, 120.0, True)
+    assert ratio == pytest.approx(1.2)
+    assert allowed == pytest.approx(1.15)
+    # 2 * (5% + 5%) on top of the threshold
+    assert comparison["noisy"][3] == pytest.approx(1.35)
+    assert not comparison["noisy"][4]
+
+
+def test_compare_skips_new_benchmarks_and_old_baselines_count_as_noiseless():
+    baseline = results(old=(100, 100.0, 0.0))
+    del baseline["results"]["old"]["noise"]
+    current = results(old=(100, 110.0, 0.02), new=(100, 1000.0, 0.0))
+    comparison = micro.compare(baseline, current, threshold=0.15)
+    assert set(comparison) == {"old"}
+    assert comparison["old"][3] == pytest.approx(1.19)
+    assert not comparison["old"][4]
+
+
+def test_mismatched_finds_benchmarks_run_at_another_scale():
+    baseline = results(a=(100, 1.0, 0.0), b=(100, 1.0, 0.0))
+    current = results(a=(100, 1.0, 0.0), b=(50, 1.0, 0.0), c=(10, 1.0, 0.0))
+    assert micro.mismatched(baseline, current) == ["b"]
+
+
+def test_main_refuses_a_baseline_run_at_another_scale(tmp_path, capsys):
+    path = tmp_path / "baseline.json"
+    path.write_text(json.dumps(results(hash_values=(1, 1.0, 0.0))))
+    try:
+        code = micro.main(
+            ["hash_values", "--repeat", "1", "--scale", "0.01", "--baseline", str(path)]
+        )
+    finally:
+        logging.disable(logging.NOTSET)
+    assert code == 2
+    assert "hash_values ran a different number" in capsys.readouterr().out
@@ -0,0 +1,64 @@
+import asyncio
+
+from worker_prototype.v3 import db
+from worker_prototype.v3.async_worker import AsyncWorker
+from worker_prototype.v3.db import TaskStatus
+from worker_prototype.v3.task_wrapper import (
+    async_task,
+    run_in_parallel,
+    run_in_parallel_async,
+)
+from worker_prototype.v3.worker_pool import WorkerPool, run_until_complete
+
+
+@async_task(version="1")
+async def async_leaf(i):
+    await asyncio.sleep(0.01)
+    return i + 1
+
+
+@async_task(version="1")
+async def async_fan_out(n):
+    results = await run_in_parallel_async(
+        [lambda i=i: async_leaf(i=i) for i in range(n)]
+    )
+    return sum(results)
+
+
+def test_submitting_from_sync_code_returns_the_id():
+    id = async_fan_out(n=3)
+    assert isinstance(id, str)
+    assert db.get_task(id).status == TaskStatus.CREATED
+    # submitting again is a no-op that returns the same id
+    assert async_fan_out(n=3) == id
+
+
+def test_async_workflow_runs_on_the_async_worker():
+    ids = [async_fan_out(n=n) for n in (5, 10)]
+    results = run_until_complete(ids, worker=AsyncWorker(), timeout=10)
+    assert results == {ids[0]: 15, ids[1]: 55}
+
+
+def test_async_workflow_runs_on_the_worker_pool():
+    id = async_fan_out(n=4)
+    assert run_until_complete([id], worker=WorkerPool(num_workers=2), timeout=10) == {
+        id: 10
+    }
+
+
+@async_task(version="1")
+def sync_parent_of_async(n):
+    # a synchronous body calling async tasks gets their results, not coroutines
+    return sum(run_in_parallel([lambda i=i: async_leaf(i=i) for i in range(n)]))
+
+
+def test_sync_parent_with_async_children_on_the_worker_pool():
+    id = sync_parent_of_async(n=3)
+    assert run_until_complete([id], worker=WorkerPool(num_workers=2), timeout=10) == {
+        id: 6
+    }
+
+
+def test_sync_parent_with_async_children_on_the_async_worker():
+    id = sync_parent_of_async(n=4)
+    assert run_until_complete([id], worker=AsyncWorker(), timeout=10) == {id: 10}
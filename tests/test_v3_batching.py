@@ -0,0 +1,98 @@
+import time
+
+from worker_prototype.v3 import db, q
+from worker_prototype.v3.batching import batched_task
+from worker_prototype.v3.task_wrapper import TaskError, async_task, run_in_parallel
+from worker_prototype.v3.worker_pool import WorkerPool, run_until_complete
+
+batch_sizes = []
+
+
+@batched_task(max_batch_size=5, batch_window=5)
+def doubled(calls):
+    batch_sizes.append(len(calls))
+    return [call["i"] * 2 for call in calls]
+
+
+@batched_task(max_batch_size=100, batch_window=0.05)
+def checked(calls):
+    batch_sizes.append(len(calls))
+    return [
+        ValueError(f"bad key {call['key']}") if call["key"] < 0 else call["key"]
+        for call in calls
+    ]
+
+
+@batched_task(batch_window=0.01)
+def drops_a_result(calls):
+    return [1] * (len(calls) - 1)
+
+
+@async_task(version="1")
+def sum_doubled(n):
+    return sum(run_in_parallel([lambda i=i: doubled(i=i) for i in range(n)]))
+
+
+@async_task(version="1")
+def sum_checked(keys):
+    return sum(run_in_parallel([lambda key=key: checked(key=key) for key in keys]))
+
+
+@async_task(version="1")
+def call_drops_a_result(n):
+    return run_in_parallel([lambda i=i: drops_a_result(i=i) for i in range(n)])
+
+
+def test_a_full_batch_runs_without_waiting_for_the_window():
+    batch_sizes.clear()
+    started = time.monotonic()
+    id = sum_doubled(n=10)
+    # run_until_complete would wait for the queue to be quiet, so also for the window timers
+    pool = WorkerPool(num_workers=2)
+    pool.start()
+    try:
+        while not db.is_finished(db.get_task(id)):
+            assert time.monotonic() - started < 5
+            time.sleep(0.01)
+    finally:
+        pool.stop()
+        q.timers.clear()
+    assert db.get_task(id).result == sum(i * 2 for i in range(10))
+    assert batch_sizes == [5, 5]
+
+
+def test_a_batch_runs_once_its_window_is_over():
+    batch_sizes.clear()
+    started = time.monotonic()
+    id = sum_checked(keys=[1, 2, 3])
+    results = run_until_complete([id], num_workers=2, timeout=10)
+    assert results[id] == 6
+    assert batch_sizes == [3]
+    assert time.monotonic() - started >= 0.05
+
+
+def test_an_exception_fails_only_its_own_call():
+    batch_sizes.clear()
+    ok, failed = sum_checked(keys=[4, 5]), sum_checked(keys=[6, -1])
+    results = run_until_complete([ok, failed], num_workers=2, timeout=10)
+    assert results[ok] == 9
+    assert isinstance(results[failed], TaskError)
+    assert "bad key -1" in str(results[failed])
+    assert sum(batch_sizes) == 4
+
+
+def test_a_wrong_number_of_results_fails_every_call():
+    id = call_drops_a_result(n=3)
+    results = run_until_complete([id], num_workers=2, timeout=10)
+    assert isinstance(results[id], TaskError)
+    assert "returned 2 results for 3 calls" in str(results[id])
+
+
+def test_a_top_level_call_runs_as_a_batch_of_one():
+    batch_sizes.clear()
+    batch_count = doubled.batcher.batch_count
+    id = doubled(i=21)
+    results = run_until_complete([id], num_workers=1, timeout=10)
+    assert results[id] == 42
+    assert batch_sizes == [1]
+    assert doubled.batcher.batch_count == batch_count
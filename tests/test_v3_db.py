@@ -0,0 +1,48 @@
+import json
+import pickle
+import threading
+
+import pytest
+
+from worker_prototype.v3 import db
+from worker_prototype.v3.db import JournalEntry, Task, TaskStatus
+
+
+def test_task_status_round_trips_through_its_number():
+    for status in TaskStatus:
+        assert TaskStatus(int(status)) is status
+        assert pickle.loads(pickle.dumps(status)) is status
+    assert json.dumps({"status": TaskStatus.SUCCESS}) == '{"status": 4}'
+    assert str(TaskStatus.FAILED) == "TaskStatus.FAILED"
+    assert f"{TaskStatus.RUNNING}" == "TaskStatus.RUNNING"
+
+
+def test_tasks_are_slotted_records():
+    task = db.create_top_level_task("slotted", "1", {"i": 1})
+    assert not hasattr(task, "__dict__")
+    with pytest.raises(AttributeError):
+        task.extra = 1
+    assert (task.cache, task.journal, task.children) == (None, None, None)
+    assert task.name is db.create_top_level_task("slotted", "1", {"i": 2}).name
+
+    copy = pickle.loads(pickle.dumps(task))
+    assert copy == task
+    assert copy.status is TaskStatus.CREATED
+    entry = JournalEntry(name="c", kwargs={}, child_id="x", result=1)
+    assert not hasattr(entry, "__dict__")
+
+
+def test_the_lock_is_shared_by_every_record_of_a_task():
+    task = Task(id="a", name="n", version="1", status=TaskStatus.CREATED)
+    same = Task(id="a", name="n", version="1", status=TaskStatus.SUCCESS)
+    assert task.lock is same.lock
+    assert task.lock is task.lock
+    assert isinstance(task.lock, type(threading.Lock()))
+    with task.lock:
+        assert not same.lock.acquire(blocking=False)
+    assert same.lock.acquire(blocking=False)
+    same.lock.release()
+
+    # striped, not one lock for every task
+    others = [Task(id=str(i), name="n", version="1", status=0) for i in range(100)]
+    assert len({id(other.lock) for other in others}) > 1
@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+
+from worker_prototype.v3 import func_version
+from worker_prototype.v3.func_version import (
+    LazyFuncVersion,
+    VersionCache,
+    compute_func_version,
+)
+from worker_prototype.v3.task_registry import FunctionRegistry
+
+
+def first():
+    return 1
+
+
+def second():
+    return 2
+
+
+@pytest.fixture
+def computed(monkeypatch):
+    computed = []
+
+    def fake_compute_func_version(func):
+        computed.append(func)
+        return func.__name__
+
+    monkeypatch.setattr(func_version, "compute_func_version", fake_compute_func_version)
+    return computed
+
+
+def test_lazy_version_is_computed_once_on_first_use(computed):
+    lazy = LazyFuncVersion(first)
+    assert not lazy.resolved
+    assert computed == []
+
+    threads = [threading.Thread(target=lazy.get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert lazy.get() == "first"
+    assert lazy.resolved
+    assert computed == [first]
+
+
+def test_explicit_version_is_never_computed(computed):
+    lazy = LazyFuncVersion(first, "1")
+    assert lazy.resolved
+    assert lazy.get() == "1"
+    assert computed == []
+
+
+def test_versions_are_cached_on_disk(tmp_path):
+    path = str(tmp_path / "cache" / "func_versions.json")
+    cache = VersionCache(path)
+    version = compute_func_version(first, cache=cache)
+    assert compute_func_version(first, cache=cache) == version
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.save()
+
+    # a new process reads it instead of pickling the function
+    reloaded = VersionCache(path)
+    assert compute_func_version(first, cache=reloaded) == version
+    assert compute_func_version(second, cache=reloaded) != version
+    assert (reloaded.hits, reloaded.misses) == (1, 1)
+
+
+def test_an_unreadable_cache_file_counts_as_empty(tmp_path):
+    path = tmp_path / "func_versions.json"
+    path.write_text("not json")
+    cache = VersionCache(str(path))
+    assert cache.get("key") is None
+    # nothing changed so nothing is written
+    cache.save()
+    assert path.read_text() == "not json"
+
+
+def test_functions_without_a_module_file_are_not_cached(tmp_path):
+    namespace = {"__name__": "not_an_imported_module"}
+    exec("def generated():\n    return 1\n", namespace)
+    cache = VersionCache(str(tmp_path / "func_versions.json"))
+    compute_func_version(namespace["generated"], cache=cache)
+    compute_func_version(namespace["generated"], cache=cache)
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.save()
+    assert not (tmp_path / "func_versions.json").exists()
+
+
+def test_registry_computes_lazy_versions_when_a_name_is_shared(computed):
+    registry = FunctionRegistry()
+    registry.register(first, "task", LazyFuncVersion(first))
+    assert computed == []
+
+    # another function under the same name resolves both
+    registry.register(second, "task", LazyFuncVersion(second))
+    assert computed == [first, second]
+    assert registry.get("task", "first") is first
+    assert registry.get("task", "second") is second
+
+
+def test_registry_computes_a_lazy_version_when_it_is_looked_up(computed):
+    registry = FunctionRegistry()
+    registry.register(first, "task", LazyFuncVersion(first))
+    assert registry.get("task", "first") is first
+    assert computed == [first]
+    with pytest.raises(KeyError):
+        registry.get("task", "other")
+
+
+def test_registry_rejects_a_duplicate_name_and_version(computed):
+    registry = FunctionRegistry()
+    registry.register(first, "explicit", "1")
+    with pytest.raises(ValueError):
+        registry.register(second, "explicit", "1")
+
+    registry.register(first, "lazy", LazyFuncVersion(first))
+    with pytest.raises(ValueError):
+        registry.register(second, "lazy", LazyFuncVersion(second, "first"))
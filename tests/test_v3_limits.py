@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from worker_prototype.v3 import q
+from worker_prototype.v3.limits import TaskLimiter, TokenBucket, parse_rate
+from worker_prototype.v3.q import TaskQueue, get_queue, set_queue
+from worker_prototype.v3.task_wrapper import async_task
+from worker_prototype.v3.worker_pool import run_until_complete
+
+
+@pytest.fixture
+def task_queue():
+    previous = get_queue()
+    task_queue = TaskQueue()
+    set_queue(task_queue)
+    yield task_queue
+    q.timers.clear()
+    set_queue(previous)
+
+
+def test_parse_rate():
+    assert parse_rate("100/s") == (100, 1)
+    assert parse_rate(" 2.5 / m ") == (2.5, 60)
+    with pytest.raises(ValueError):
+        parse_rate("0/s")
+    with pytest.raises(ValueError):
+        parse_rate("10 per second")
+
+
+def test_token_bucket_spreads_callers_out_at_the_rate():
+    bucket = TokenBucket(10, 1)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits[0] == 0
+    assert waits[1:] == pytest.approx([0.1, 0.2, 0.3], abs=0.01)
+
+
+def test_over_max_concurrency_waits_for_a_release(task_queue):
+    limiter = TaskLimiter(max_concurrency=1)
+    assert limiter.try_acquire("a", 2)
+    assert not limiter.try_acquire("b", 2)
+    assert task_queue.qsize() == 0
+
+    limiter.release()
+    assert task_queue.get(timeout=1).id == "b"
+    assert limiter.try_acquire("b", 2)
+    assert limiter.running_count == 1
+    assert limiter.deferred_count == 1
+
+
+def test_over_the_rate_is_queued_again_when_its_token_is_due(task_queue):
+    limiter = TaskLimiter(rate="10/s")
+    assert limiter.try_acquire("a", 2)
+    started = time.monotonic()
+    assert not limiter.try_acquire("b", 2)
+    assert task_queue.get(timeout=1).id == "b"
+    assert time.monotonic() - started >= 0.08
+    assert limiter.try_acquire("b", 2)
+
+
+running = 0
+most_running = 0
+running_lock = threading.Lock()
+
+
+@async_task(version="1", max_concurrency=2)
+def limited(i):
+    global running, most_running
+    with running_lock:
+        running += 1
+        most_running = max(most_running, running)
+    time.sleep(0.02)
+    with running_lock:
+        running -= 1
+    return i
+
+
+def test_max_concurrency_holds_across_workers():
+    ids = [limited(i=i) for i in range(10)]
+    results = run_until_complete(ids, num_workers=6, timeout=10)
+    assert list(results.values()) == list(range(10))
+    assert most_running <= 2
+
+
+def test_early_wake_up_keeps_waiting_for_its_token(task_queue):
+    limiter = TaskLimiter(rate="10/s")
+    assert limiter.try_acquire("a", 2)
+    assert not limiter.try_acquire("b", 2)
+    # e.g. a child of b finished and queued it again before its token is due
+    assert not limiter.try_acquire("b", 2)
+    assert limiter.deferred_count == 2
+
+    # the early wake-up didn't take another token
+    assert limiter._bucket.reserve() == pytest.approx(0.2, abs=0.02)
+
+    time.sleep(0.12)
+    assert limiter.try_acquire("b", 2)
@@ -0,0 +1,97 @@
+from collections import Counter
+import threading
+import time
+
+import pytest
+
+from worker_prototype.v3.memo import (
+    LEAD,
+    WAIT,
+    ResultCache,
+    get_result_cache,
+    set_result_cache,
+)
+from worker_prototype.v3.task_wrapper import TaskError, async_task
+from worker_prototype.v3.worker_pool import run_until_complete
+
+runs = Counter()
+runs_lock = threading.Lock()
+
+
+@pytest.fixture(autouse=True)
+def result_cache():
+    previous = get_result_cache()
+    cache = ResultCache()
+    set_result_cache(cache)
+    yield cache
+    set_result_cache(previous)
+
+
+@async_task(version="1", pure=True)
+def slow_lookup(key):
+    with runs_lock:
+        runs[f"slow-{key}"] += 1
+    time.sleep(0.05)
+    return key * 2
+
+
+@async_task(version="1")
+def lookup_workflow(workflow, num_keys):
+    return [slow_lookup(key=key) for key in range(num_keys)]
+
+
+def test_concurrent_calls_wait_for_the_first_computation():
+    ids = [lookup_workflow(workflow=i, num_keys=5) for i in range(10)]
+    results = run_until_complete(ids, num_workers=8, timeout=30)
+
+    assert all(result == [0, 2, 4, 6, 8] for result in results.values())
+    assert [runs[f"slow-{key}"] for key in range(5)] == [1] * 5
+
+
+@async_task(version="1", pure=True)
+def fails_once(key):
+    with runs_lock:
+        runs[f"fails-once-{key}"] += 1
+        first = runs[f"fails-once-{key}"] == 1
+    time.sleep(0.05)
+    if first:
+        raise ValueError("first call fails")
+    return key
+
+
+@async_task(version="1")
+def fails_once_workflow(workflow):
+    return fails_once(key=1)
+
+
+def test_waiters_compute_it_themselves_when_the_first_call_fails():
+    ids = [fails_once_workflow(workflow=i) for i in range(3)]
+    results = run_until_complete(ids, num_workers=4, timeout=30)
+
+    outcomes = list(results.values())
+    failed = [result for result in outcomes if isinstance(result, TaskError)]
+    succeeded = [result for result in outcomes if not isinstance(result, TaskError)]
+    assert (len(failed), succeeded) == (1, [1, 1])
+
+
+def test_lead_or_wait(result_cache):
+    assert result_cache.lead_or_wait("k", "a") is LEAD
+    assert result_cache.lead_or_wait("k", "b") is WAIT
+    assert result_cache.lead_or_wait("k", "c") is WAIT
+    result_cache.set("k", 1)
+    assert result_cache.finish_in_flight("k") == ["b", "c"]
+    assert result_cache.lead_or_wait("k", "d") == 1
+    assert result_cache.finish_in_flight("k") == []
+
+
+def test_disk_tier_is_shared_between_threads(tmp_path):
+    path = str(tmp_path / "results.db")
+    writer = ResultCache(path=path)
+    thread = threading.Thread(target=lambda: writer.set("k", {"a": 1}, ttl=60))
+    thread.start()
+    thread.join()
+
+    reader = ResultCache(path=path)
+    assert reader.get("k") == {"a": 1}
+    assert reader.get("missing", "default") == "default"
+    assert (reader.hits, reader.misses) == (1, 1)
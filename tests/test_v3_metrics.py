@@ -0,0 +1,60 @@
+import urllib.request
+
+import pytest
+
+from worker_prototype.v3.metrics import MetricsRegistry, start_http_server
+
+
+def test_counters_and_gauges_render_one_line_per_label_values():
+    registry = MetricsRegistry()
+    runs = registry.counter("runs_total", "Runs", ["task"])
+    runs.labels("a").inc()
+    runs.labels("a").inc(2)
+    runs.labels('b "quoted"\n').inc()
+    depth = registry.gauge("depth", "Queue depth")
+    depth.set_function(lambda: 7)
+
+    assert registry.render().splitlines() == [
+        "# HELP runs_total Runs",
+        "# TYPE runs_total counter",
+        'runs_total{task="a"} 3',
+        'runs_total{task="b \\"quoted\\"\\n"} 1',
+        "# HELP depth Queue depth",
+        "# TYPE depth gauge",
+        "depth 7",
+    ]
+    with pytest.raises(ValueError):
+        runs.labels("a", "b")
+    with pytest.raises(ValueError):
+        registry.counter("runs_total", "Runs again")
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    seconds = registry.histogram("seconds", "Run time", ["task"], buckets=[1, 0.1])
+    child = seconds.labels("a")
+    for value in (0.05, 0.1, 0.5, 3):
+        child.observe(value)
+
+    assert (child.count, child.sum) == (4, 3.65)
+    assert registry.render().splitlines()[2:] == [
+        'seconds_bucket{task="a",le="0.1"} 2',
+        'seconds_bucket{task="a",le="1"} 3',
+        'seconds_bucket{task="a",le="+Inf"} 4',
+        'seconds_sum{task="a"} 3.65',
+        'seconds_count{task="a"} 4',
+    ]
+
+
+def test_http_server_serves_the_registry():
+    registry = MetricsRegistry()
+    registry.counter("served_total", "Served").inc()
+    server = start_http_server(port=0, registry=registry)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "served_total 1\n" in response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from worker_prototype.v3.db import TaskStatus
+from worker_prototype.v3.process_executor import _run_body, shutdown_process_pool
+from worker_prototype.v3.task_wrapper import TaskError, async_task, run_in_parallel
+from worker_prototype.v3.worker_pool import run_until_complete
+
+
+@pytest.fixture(scope="module", autouse=True)
+def process_pool():
+    yield
+    shutdown_process_pool()
+
+
+@async_task(version="1")
+def square(i):
+    return i * i
+
+
+# NOTE: process tasks are looked up by module and name in the worker process, so they live at the top level
+@async_task(version="1", executor="process")
+def sum_of_squares(n):
+    return sum(run_in_parallel([lambda i=i: square(i=i) for i in range(n)]))
+
+
+@async_task(version="1", executor="process")
+def pid_of_worker():
+    return os.getpid()
+
+
+@async_task(version="1", executor="process")
+def fails_in_process(n):
+    raise ValueError(f"bad n {n}")
+
+
+def test_body_runs_in_another_process():
+    id = pid_of_worker()
+    results = run_until_complete([id], num_workers=1, timeout=60)
+    assert results[id] != os.getpid()
+
+
+def test_children_of_a_process_task_are_created_here():
+    id = sum_of_squares(n=4)
+    results = run_until_complete([id], num_workers=2, timeout=60)
+    assert results[id] == 0 + 1 + 4 + 9
+
+
+def test_an_exception_in_the_worker_process_fails_the_task():
+    id = fails_in_process(n=3)
+    results = run_until_complete([id], num_workers=1, timeout=60)
+    assert isinstance(results[id], TaskError)
+    assert "bad n 3" in str(results[id])
+
+
+def test_new_children_are_sent_back_and_answered_from_the_snapshot():
+    args = (__name__, "sum_of_squares", "parent", {"n": 3})
+    outcome = _run_body(*args, children={}, cache={})
+    assert outcome.status == "suspend"
+    assert [(name, kwargs) for name, _, _, kwargs, _, _ in outcome.spawned] == [
+        (square.name, {"i": i}) for i in range(3)
+    ]
+
+    ids = [id for _, _, id, _, _, _ in outcome.spawned]
+    children = {id: (TaskStatus.SUCCESS, i * i, None) for i, id in enumerate(ids)}
+    outcome = _run_body(*args, children=children, cache={})
+    assert (outcome.status, outcome.result, outcome.spawned) == ("success", 5, [])
+
+    children[ids[1]] = (TaskStatus.FAILED, None, "boom")
+    outcome = _run_body(*args, children=children, cache={})
+    assert outcome.status == "task_error"
+    assert "boom" in outcome.error
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from worker_prototype.v3.q import TaskQueue, create_message
+from worker_prototype.v3.timers import TimerScheduler
+
+
+def test_put_coalesces_queued_ids():
+    queue = TaskQueue()
+    queue.put(create_message("x"))
+    queue.put_many([create_message("x"), create_message("y")])
+    assert queue.qsize() == 2
+    assert queue.coalesced_count == 1
+
+
+def test_put_while_running_is_queued_again_once_done():
+    queue = TaskQueue()
+    queue.put(create_message("x", 3))
+    message = queue.get(timeout=1)
+    queue.put(create_message("x", 3))
+    queue.put(create_message("x", 1))
+    queue.put(create_message("x", 2))
+    assert queue.qsize() == 0
+    assert queue.coalesced_count == 3
+
+    queue.task_done(message.id)
+    again = queue.get(timeout=1)
+    assert (again.id, again.priority) == ("x", 1)
+    queue.task_done(again.id)
+    assert queue.get(timeout=0) is None
+    assert queue.running_count() == 0
+
+
+def test_more_urgent_put_moves_the_message_up():
+    queue = TaskQueue()
+    queue.put(create_message("x", 4))
+    queue.put(create_message("y", 3))
+    queue.put(create_message("x", 0))
+    queue.put(create_message("x", 2))
+    assert queue.level_sizes() == [1, 0, 0, 1, 0]
+
+    assert queue.get(timeout=1).id == "x"
+    assert queue.get(timeout=1).id == "y"
+    # the entry x left behind at level 4 is skipped
+    assert queue.get(timeout=0) is None
+
+
+def test_waiting_messages_age_into_more_urgent_levels():
+    queue = TaskQueue(aging_interval=0.01)
+    queue.put(create_message("old", 4))
+    time.sleep(0.1)
+    queue.put(create_message("new", 0))
+    assert queue.get(timeout=1).id == "old"
+
+    queue = TaskQueue(aging_interval=0)
+    queue.put(create_message("old", 4))
+    time.sleep(0.1)
+    queue.put(create_message("new", 0))
+    assert queue.get(timeout=1).id == "new"
+
+
+def test_close_wakes_consumers_and_keeps_messages():
+    queue = TaskQueue()
+    results = []
+    consumer = threading.Thread(target=lambda: results.append(queue.get()))
+    consumer.start()
+    time.sleep(0.05)
+    queue.close()
+    consumer.join(1)
+    assert results == [None]
+
+    queue.put(create_message("x"))
+    assert queue.get(timeout=0) is None
+    queue.open()
+    assert queue.get(timeout=1).id == "x"
+
+
+def test_idle_generation_changes_when_work_happens():
+    queue = TaskQueue()
+    generation = queue.idle_generation()
+    assert generation is not None
+    queue.put(create_message("x"))
+    assert queue.idle_generation() is None
+    queue.get(timeout=1)
+    assert queue.idle_generation() is None
+    queue.task_done("x")
+    assert queue.idle_generation() not in (None, generation)
+
+
+def test_timers_fire_in_deadline_order():
+    dispatched = []
+    done = threading.Event()
+
+    def dispatch(items):
+        dispatched.extend(items)
+        if len(dispatched) == 4:
+            done.set()
+
+    timers = TimerScheduler(dispatch, resolution=0.005)
+    now = time.monotonic()
+    timers.schedule("c", now + 0.09)
+    timers.schedule("a", now + 0.01)
+    timers.schedule("d", now + 0.12)
+    timers.schedule("b", now + 0.05)
+    assert timers.pending_count == 4
+    try:
+        assert done.wait(2)
+    finally:
+        timers.stop()
+    assert dispatched == ["a", "b", "c", "d"]
+    assert timers.pending_count == 0
+
+
+def test_timers_never_fire_early():
+    fired = {}
+    done = threading.Event()
+
+    def dispatch(items):
+        for item in items:
+            fired[item] = time.monotonic()
+        done.set()
+
+    timers = TimerScheduler(dispatch, resolution=0.05)
+    deadline = time.monotonic() + 0.07
+    timers.schedule("x", deadline)
+    try:
+        assert done.wait(2)
+    finally:
+        timers.stop()
+    assert fired["x"] >= deadline
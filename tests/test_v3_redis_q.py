@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from worker_prototype.v3.q import create_message
+from worker_prototype.v3.redis_q import RedisTaskQueue
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_queue(server, worker_id, heartbeat_ttl=30):
+    queue = RedisTaskQueue(
+        connection=fakeredis.FakeRedis(server=server),
+        worker_id=worker_id,
+        heartbeat_ttl=heartbeat_ttl,
+        block_timeout=0.1,
+    )
+    return queue
+
+
+def queued_ids(queue):
+    return {id.decode() for id in queue._db.smembers(queue._queued_key)}
+
+
+def test_put_get_ack(server):
+    queue = make_queue(server, "a")
+    queue.put(create_message("x"))
+    queue.put(create_message("x"))
+    queue.put_many([create_message("y"), create_message("z"), create_message("y")])
+    assert queue.qsize() == 3
+    assert queue.coalesced_count == 2
+    assert queued_ids(queue) == {"x", "y", "z"}
+
+    message = queue.get(timeout=1)
+    assert message.id == "x"
+    assert queue.running_count() == 1
+    assert queued_ids(queue) == {"y", "z"}
+
+    # a running id can be queued again
+    queue.put(create_message("x"))
+    assert queue.qsize() == 3
+
+    queue.task_done("x")
+    assert queue.running_count() == 0
+    assert [queue.get(timeout=1).id for _ in range(3)] == ["y", "z", "x"]
+    assert queue.get(timeout=0.2) is None
+    queue.close()
+
+
+def test_get_returns_none_once_closed(server):
+    queue = make_queue(server, "a")
+    queue.close()
+    queue.put(create_message("x"))
+    assert queue.get(timeout=1) is None
+    queue.open()
+    assert queue.get(timeout=1).id == "x"
+    queue.close()
+
+
+def test_orphans_of_a_dead_worker_are_requeued(server):
+    dead = make_queue(server, "dead", heartbeat_ttl=1)
+    alive = make_queue(server, "alive")
+    dead.put_many([create_message("x"), create_message("y")])
+    assert dead.get(timeout=1).id == "x"
+    # the process dies: nothing refreshes its heartbeat any more
+    dead._stop_keep_alive()
+
+    assert alive.requeue_orphans() == 0
+    time.sleep(1.2)
+    assert alive.requeue_orphans() == 1
+    assert dead.running_count() == 0
+    assert queued_ids(alive) == {"x", "y"}
+    # the requeued id is coalesced like any queued one
+    alive.put(create_message("x"))
+    assert alive.qsize() == 2
+    assert [alive.get(timeout=1).id for _ in range(2)] == ["x", "y"]
+    alive.close()
+
+
+def test_long_running_task_is_not_an_orphan(server):
+    worker = make_queue(server, "worker", heartbeat_ttl=1)
+    other = make_queue(server, "other")
+    worker.put(create_message("slow"))
+    assert worker.get(timeout=1).id == "slow"
+    # runs for longer than the heartbeat ttl, the background heartbeat keeps it alive
+    time.sleep(2.5)
+    assert other.requeue_orphans() == 0
+    assert worker.running_count() == 1
+    worker.task_done("slow")
+    worker.close()
+
+
+def test_closing_keeps_the_heartbeat_until_in_flight_messages_are_done(server):
+    worker = make_queue(server, "worker", heartbeat_ttl=1)
+    other = make_queue(server, "other")
+    worker.put(create_message("slow"))
+    assert worker.get(timeout=1).id == "slow"
+    # e.g. WorkerPool.stop, which waits for the running task afterwards
+    worker.close()
+    time.sleep(1.5)
+    assert other.requeue_orphans() == 0
+
+    worker.task_done("slow")
+    assert worker._keep_alive_thread is None
+
+
+def test_a_crash_between_the_move_and_the_srem_is_repaired(server):
+    dead = make_queue(server, "dead", heartbeat_ttl=1)
+    alive = make_queue(server, "alive")
+    dead.put(create_message("x"))
+    dead._queue.heartbeat()
+    # the first half of a claim, the process dies before removing it from the queued set
+    dead._db.lmove(dead._queue.key, dead._queue.processing_key, "LEFT", "RIGHT")
+    alive.put(create_message("x"))
+    assert alive.qsize() == 0
+
+    time.sleep(1.2)
+    assert alive.requeue_orphans() == 1
+    assert queued_ids(alive) == {"x"}
+    assert alive.get(timeout=1).id == "x"
+    assert queued_ids(alive) == set()
+    alive.task_done("x")
+    alive.close()
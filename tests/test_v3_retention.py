@@ -0,0 +1,34 @@
+from worker_prototype.v3 import db
+from worker_prototype.v3.retention import RetentionPolicy, TaskSweeper
+from worker_prototype.v3.task_wrapper import notify_parent
+
+
+def test_tree_is_kept_until_every_finished_child_notified_its_parent():
+    db.finished_top_level_tasks.clear()
+    parent = db.create_top_level_task("parent", "1", {"test": "retention"})
+    failed = db.create_task("child", "1", {"i": 0}, parent_id=parent.id)
+    slow = db.create_task("child", "1", {"i": 1}, parent_id=parent.id)
+
+    db.set_task_error(failed.id, "boom")
+    notify_parent(failed, failed=True)
+    db.set_task_error(parent.id, "a child failed")
+    # finished, but the worker hasn't called notify_parent yet
+    db.set_task_result(slow.id, 1)
+
+    sweeper = TaskSweeper(RetentionPolicy(ttl=0))
+    assert sweeper.sweep() == 0
+    assert db.task_exists(parent.id)
+
+    notify_parent(slow)
+    assert sweeper.sweep() == 3
+    assert not db.task_exists(parent.id)
+
+
+def test_notifying_an_evicted_parent_is_a_no_op():
+    parent = db.create_top_level_task("parent", "1", {"test": "evicted"})
+    child = db.create_task("child", "1", {"i": 0}, parent_id=parent.id)
+    db.evict_tasks([parent.id])
+
+    assert db.complete_child(parent.id) is False
+    db.set_task_result(child.id, 1)
+    notify_parent(child)
@@ -0,0 +1,263 @@
+import inspect
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from worker_prototype.v3 import db, sql_db
+from worker_prototype.v3.db import JournalEntry, TaskStatus
+from worker_prototype.v3.q import create_message, get_queue, set_queue
+from worker_prototype.v3.sql_db import SqlTaskQueue
+from worker_prototype.v3.store import get_store, set_store
+from worker_prototype.v3.task_wrapper import async_task, run_in_parallel
+from worker_prototype.v3.worker_pool import WorkerPool
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path):
+    sql_db.init_db(f"sqlite:///{tmp_path / 'tasks.db'}")
+    yield
+    sql_db.get_engine().dispose()
+    sql_db._claimed_tasks.clear()
+
+
+def claim_all(claim, num_threads=8):
+    claimed = []
+    lock = threading.Lock()
+
+    def claimer():
+        while True:
+            id = claim()
+            if id is None:
+                return
+            with lock:
+                claimed.append(id)
+
+    threads = [threading.Thread(target=claimer) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return claimed
+
+
+def test_claim_moves_the_task_to_running():
+    id = sql_db.create_top_level_task("t", "1", {}).id
+    assert sql_db.enqueue_task(id) == 1
+    task = sql_db.claim_next_task("w")
+    assert (task.id, task.status) == (id, TaskStatus.RUNNING)
+    assert sql_db.queued_count() == 0
+    assert sql_db.claim_next_task("w") is None
+
+    # another message for it marks it to run again once this run suspends
+    assert sql_db.claim_task(id) is None
+    assert sql_db.suspend_task(id) is True
+    assert sql_db.get_task(id).status == TaskStatus.PENDING
+    assert sql_db.claim_task(id).status == TaskStatus.RUNNING
+    assert sql_db.suspend_task(id) is False
+
+
+def test_queued_wake_ups_of_finished_tasks_are_dropped():
+    done = sql_db.create_top_level_task("t", "1", {"i": 0}).id
+    sql_db.set_task_result(done, 1)
+    pending = sql_db.create_top_level_task("t", "1", {"i": 1}).id
+    sql_db.enqueue_tasks([done, pending])
+    assert sql_db.claim_next_task().id == pending
+    assert sql_db.get_task(done).status == TaskStatus.SUCCESS
+    assert sql_db.queued_count() == 0
+
+
+def test_concurrent_claims_take_each_task_once():
+    ids = [sql_db.create_top_level_task("t", "1", {"i": i}).id for i in range(200)]
+    sql_db.enqueue_tasks(ids)
+
+    def claim():
+        task = sql_db.claim_next_task()
+        return None if task is None else task.id
+
+    claimed = claim_all(claim)
+    assert sorted(claimed) == sorted(ids)
+
+
+def create_tasks(*keys):
+    return [sql_db.create_top_level_task("t", "1", {"key": key}).id for key in keys]
+
+
+def test_queue_coalesces_and_orders_by_priority():
+    x, y = create_tasks("x", "y")
+    queue = SqlTaskQueue(worker_id="a")
+    queue.put_many([create_message(x, 2), create_message(y, 2)])
+    queue.put(create_message(x, 2))
+    queue.put(create_message(y, 0))
+    assert queue.qsize() == 2
+    assert queue.coalesced_count == 2
+
+    assert queue.get(timeout=1).id == y
+    assert queue.get(timeout=1).id == x
+    assert queue.get(timeout=0.1) is None
+    assert queue.running_count() == 2
+    # the runner gets the claimed task without claiming it again
+    assert sql_db.claim_task(x).status == TaskStatus.RUNNING
+
+
+def test_put_while_running_is_claimed_once_the_run_suspends():
+    [x] = create_tasks("x")
+    queue = SqlTaskQueue(worker_id="a", poll_interval=0.01)
+    queue.put(create_message(x, 3))
+    assert queue.get(timeout=1).id == x
+    assert sql_db.claim_task(x) is not None
+    queue.put(create_message(x, 1))
+    assert queue.qsize() == 1
+    assert queue.get(timeout=0.1) is None
+
+    assert sql_db.suspend_task(x) is False
+    queue.task_done(x)
+    again = queue.get(timeout=1)
+    assert (again.id, again.priority) == (x, 1)
+    assert queue.qsize() == 0
+
+
+def test_claims_of_a_dead_worker_can_be_requeued():
+    [x] = create_tasks("x")
+    dead = SqlTaskQueue(worker_id="dead")
+    dead.put(create_message(x))
+    assert dead.get(timeout=1).id == x
+    sql_db._claimed_tasks.clear()
+
+    other = SqlTaskQueue(worker_id="other")
+    assert other.get(timeout=0.1) is None
+    assert other.requeue_claimed("dead") == 1
+    assert sql_db.get_task(x).status == TaskStatus.PENDING
+    assert other.get(timeout=1).id == x
+
+
+def test_get_returns_none_once_closed():
+    queue = SqlTaskQueue(poll_interval=0.01)
+    threading.Timer(0.05, queue.close).start()
+    assert queue.get() is None
+
+
+def test_a_put_from_this_process_wakes_a_waiting_get():
+    [x] = create_tasks("x")
+    queue = SqlTaskQueue(poll_interval=10)
+    threading.Timer(0.05, lambda: queue.put(create_message(x))).start()
+    started = time.monotonic()
+    assert queue.get(timeout=5).id == x
+    assert time.monotonic() - started < 1
+
+
+def test_concurrent_queue_gets_take_each_message_once():
+    ids = create_tasks(*range(200))
+    SqlTaskQueue().put_many([create_message(id) for id in ids])
+    queues = [SqlTaskQueue(poll_interval=0.01) for _ in range(8)]
+
+    def claim():
+        message = queues[threading.get_ident() % len(queues)].get(timeout=0.05)
+        return None if message is None else message.id
+
+    claimed = claim_all(claim)
+    assert sorted(claimed) == sorted(ids)
+
+
+@async_task(version="1")
+def sql_leaf(i):
+    time.sleep(0.005)
+    return i * 2
+
+
+@async_task(version="1")
+def sql_fan_out(n):
+    return sum(run_in_parallel([lambda i=i: sql_leaf(i=i) for i in range(n)]))
+
+
+# runs a worker pool on a new queue until the task finished or seconds passed
+def run_workers(id, seconds):
+    queue = SqlTaskQueue(poll_interval=0.01)
+    set_queue(queue)
+    pool = WorkerPool(num_workers=2, task_queue=queue)
+    pool.start()
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if sql_db.is_finished(sql_db.get_task(id)):
+                break
+            time.sleep(0.01)
+    finally:
+        pool.stop()
+
+
+def test_workflow_survives_a_restart(tmp_path):
+    previous_store, previous_queue = get_store(), get_queue()
+    set_store(sql_db)
+    try:
+        set_queue(SqlTaskQueue())
+        id = sql_fan_out(n=40)
+        run_workers(id, 0.05)
+        assert sql_db.get_task(id).status != TaskStatus.SUCCESS
+
+        # a new process on the same database
+        sql_db.get_engine().dispose()
+        sql_db._claimed_tasks.clear()
+        sql_db.init_db(f"sqlite:///{tmp_path / 'tasks.db'}")
+        run_workers(id, 10)
+    finally:
+        set_store(previous_store)
+        set_queue(previous_queue)
+
+    task = sql_db.get_task(id)
+    assert task.status == TaskStatus.SUCCESS
+    assert task.result == sum(i * 2 for i in range(40))
+    assert sql_db.queued_count() == 0
+
+
+def public_functions(module):
+    return {
+        name: inspect.signature(function)
+        for name, function in vars(module).items()
+        if inspect.isfunction(function)
+        and function.__module__ == module.__name__
+        and not name.startswith("_")
+    }
+
+
+def test_sql_db_matches_the_in_memory_store_interface():
+    memory_functions = public_functions(db)
+    sql_functions = public_functions(sql_db)
+    missing = set(memory_functions) - set(sql_functions)
+    assert not missing
+    for name, signature in memory_functions.items():
+        assert sql_functions[name] == signature, name
+
+
+def test_priority_journal_children_and_eviction():
+    parent = sql_db.create_top_level_task("p", "1", {}, priority=1)
+    children = [
+        sql_db.create_task("c", "1", {"i": i}, parent_id=parent.id) for i in range(3)
+    ]
+    assert sql_db.get_task(parent.id).priority == 1
+    assert [c.id for c in sql_db.get_children(parent.id)] == [c.id for c in children]
+    assert set(sql_db.get_tasks([parent.id, "missing"])) == {parent.id}
+
+    entry = JournalEntry(name="c", kwargs={"i": 0}, child_id=children[0].id)
+    sql_db.record_journal_entry(parent.id, 0, entry)
+    entry.result = 4
+    sql_db.record_journal_entry(parent.id, 0, entry)
+    assert sql_db.get_journal_entry(parent.id, 0) == entry
+    assert sql_db.get_journal_entry(parent.id, 1) is None
+
+    assert sql_db.get_finished_descendant_ids(parent.id) is None
+    for child in children:
+        sql_db.set_task_result(child.id, 1)
+    # kept until the children have notified the parent
+    assert sql_db.get_finished_descendant_ids(parent.id) is None
+    for child in children:
+        sql_db.complete_child(parent.id)
+    assert sorted(sql_db.get_finished_descendant_ids(parent.id)) == sorted(
+        c.id for c in children
+    )
+
+    assert sql_db.evict_tasks([parent.id] + [c.id for c in children]) == 4
+    assert sql_db.get_journal_entry(parent.id, 0) is None
+    assert sql_db.memory_report()["tasks"] == 0
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+from worker_prototype.v3.task_wrapper import (
+    TaskIdHasher,
+    encode_kwargs,
+    generate_task_id,
+)
+
+
+def test_ids_only_depend_on_the_call():
+    hasher = TaskIdHasher("task", "1")
+    id = hasher.task_id("parent", encode_kwargs({"a": 1, "b": [1, 2]}))
+    assert id == hasher.task_id("parent", encode_kwargs({"b": [1, 2], "a": 1}))
+    assert id == TaskIdHasher("task", "1").task_id(
+        "parent", encode_kwargs({"a": 1, "b": [1, 2]})
+    )
+    assert id == generate_task_id(None, "task", "1", "parent", {"b": [1, 2], "a": 1})
+
+    assert id != hasher.task_id("other", encode_kwargs({"a": 1, "b": [1, 2]}))
+    assert id != hasher.task_id(None, encode_kwargs({"a": 1, "b": [1, 2]}))
+    assert id != hasher.task_id("parent", encode_kwargs({"a": 2, "b": [1, 2]}))
+    assert id != TaskIdHasher("task", "2").task_id(
+        "parent", encode_kwargs({"a": 1, "b": [1, 2]})
+    )
+
+
+def test_ids_are_the_same_in_another_process():
+    code = (
+        "from worker_prototype.v3.task_wrapper import generate_task_id\n"
+        "print(generate_task_id(None, 'task', '1', 'parent', {'a': 1}))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.strip() == generate_task_id(None, "task", "1", "parent", {"a": 1})
+
+
+def test_moving_characters_between_parts_changes_the_id():
+    kwargs = encode_kwargs({})
+    assert TaskIdHasher("ab", "c").task_id(None, kwargs) != TaskIdHasher(
+        "a", "bc"
+    ).task_id(None, kwargs)
+    assert TaskIdHasher("a", "bc").task_id("d", kwargs) != TaskIdHasher(
+        "a", "b"
+    ).task_id("cd", kwargs)
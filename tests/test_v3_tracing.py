@@ -0,0 +1,53 @@
+import pytest
+
+from worker_prototype.v3 import db
+from worker_prototype.v3.task_wrapper import async_task, run_in_parallel
+from worker_prototype.v3.tracing import Tracer, find_root_id, get_tracer, set_tracer
+from worker_prototype.v3.worker_pool import run_until_complete
+
+
+@pytest.fixture
+def tracer():
+    previous = get_tracer()
+    tracer = Tracer()
+    set_tracer(tracer)
+    yield tracer
+    set_tracer(previous)
+
+
+def test_tasks_know_their_root_from_creation():
+    root = db.create_top_level_task("root", "1", {"test": "tracing"})
+    child = db.create_task("child", "1", {}, parent_id=root.id)
+    grandchild = db.create_task("grandchild", "1", {}, parent_id=child.id)
+    assert (root.root_id, child.root_id, grandchild.root_id) == (None, root.id, root.id)
+
+    # no walk up the store, so it still works once the ancestors are gone
+    db.evict_tasks([root.id, child.id])
+    assert find_root_id(grandchild) == root.id
+    assert find_root_id(root) == root.id
+
+
+@async_task(version="1")
+def traced_leaf(i):
+    return i
+
+
+@async_task(version="1")
+def traced_middle(i):
+    return sum(
+        run_in_parallel([lambda j=j: traced_leaf(i=i * 10 + j) for j in range(3)])
+    )
+
+
+@async_task(version="1")
+def traced_root(n):
+    return sum(run_in_parallel([lambda i=i: traced_middle(i=i) for i in range(n)]))
+
+
+def test_every_span_of_a_workflow_has_its_root_as_trace_id(tracer):
+    id = traced_root(n=3)
+    run_until_complete([id], num_workers=2, timeout=10)
+    spans = [span for span in tracer.spans() if span.trace_id == id]
+    # 1 root, 3 middle and 9 leaf tasks
+    assert len({span.task_id for span in spans}) == 13
+    assert {span.trace_id for span in tracer.spans()} == {id}
@@ -0,0 +1,137 @@
+from collections import Counter
+import threading
+import time
+
+import pytest
+
+from worker_prototype.v3 import db
+from worker_prototype.v3.db import JoinPolicy
+from worker_prototype.v3.errors import StalledTasksError
+from worker_prototype.v3.q import enqueue_id
+from worker_prototype.v3.retention import RetentionPolicy, TaskSweeper, pinned_ids
+from worker_prototype.v3.task_wrapper import TaskError, async_task, run_in_parallel
+from worker_prototype.v3.worker_pool import run_until_complete
+
+runs = Counter()
+runs_lock = threading.Lock()
+
+
+def count_run(name):
+    with runs_lock:
+        runs[name] += 1
+
+
+def make_parent(join_policy, num_children):
+    parent = db.create_top_level_task("parent", "1", {}, join_policy=join_policy)
+    for i in range(num_children):
+        db.create_task("child", "1", {"i": i}, parent_id=parent.id)
+    return parent
+
+
+def test_all_join_wakes_the_parent_once_every_child_finished():
+    parent = make_parent(JoinPolicy.ALL, 3)
+    assert db.complete_child(parent.id) is False
+    assert db.complete_child(parent.id, failed=True) is False
+    assert db.complete_child(parent.id) is True
+    assert db.get_task(parent.id).outstanding_children == 0
+
+
+def test_fail_fast_join_wakes_the_parent_on_the_first_failure():
+    parent = make_parent(JoinPolicy.FAIL_FAST, 3)
+    assert db.complete_child(parent.id) is False
+    assert db.complete_child(parent.id, failed=True) is True
+    assert db.complete_child(parent.id) is True
+
+
+@async_task(version="1")
+def leaf(i):
+    count_run(f"leaf-{i}")
+    if i < 0:
+        raise ValueError("negative")
+    return i
+
+
+@async_task(version="1", join_policy=JoinPolicy.ALL)
+def fan_out_all(start, n):
+    count_run(f"all-{start}")
+    return sum(run_in_parallel([lambda i=i: leaf(i=i) for i in range(start, n)]))
+
+
+@async_task(version="1")
+def fan_out_fail_fast(start, n):
+    count_run(f"fail-fast-{start}")
+    return sum(run_in_parallel([lambda i=i: leaf(i=i) for i in range(start, n)]))
+
+
+def test_parents_are_only_woken_when_their_join_policy_allows():
+    ids = [fan_out_all(start=100, n=150), fan_out_fail_fast(start=-1, n=50)]
+    results = run_until_complete(ids, num_workers=4, timeout=10)
+
+    assert results[ids[0]] == sum(range(100, 150))
+    # one run that creates the children and one once they all finished
+    assert runs["all-100"] == 2
+    assert isinstance(results[ids[1]], TaskError)
+    assert runs["fail-fast--1"] <= 2
+
+
+@async_task(version="1")
+def step(i):
+    count_run(f"step-{i}")
+    return i * 10
+
+
+@async_task(version="1")
+def serial(n):
+    count_run(f"serial-{n}")
+    return [step(i=i) for i in range(n)]
+
+
+def test_replays_answer_finished_calls_from_the_journal():
+    id = serial(n=3)
+    assert run_until_complete([id], num_workers=2, timeout=10) == {id: [0, 10, 20]}
+
+    # a run per step that suspended on it, plus the one that finished
+    assert runs["serial-3"] == 4
+    assert all(runs[f"step-{i}"] == 1 for i in range(3))
+    for i in range(3):
+        entry = db.get_journal_entry(id, i)
+        assert (entry.name, entry.kwargs, entry.result) == (step.name, {"i": i}, i * 10)
+
+
+def test_run_until_complete_waits_for_delayed_messages():
+    task = db.create_top_level_task(
+        leaf.name, leaf.get_version(), {"i": 7}, id="delayed"
+    )
+    enqueue_id(task.id, delay=0.2)
+    assert run_until_complete([task.id], num_workers=1, timeout=10) == {task.id: 7}
+
+
+def test_run_until_complete_reports_tasks_that_can_never_finish():
+    # created but its message was never queued
+    task = db.create_top_level_task(leaf.name, leaf.get_version(), {"i": 8}, id="lost")
+    with pytest.raises(StalledTasksError):
+        run_until_complete([task.id], num_workers=1, timeout=10)
+
+
+def test_run_until_complete_rejects_unknown_ids():
+    with pytest.raises(ValueError):
+        run_until_complete(["missing"], num_workers=1, timeout=10)
+
+
+@async_task(version="1")
+def sleepy(i, seconds):
+    time.sleep(seconds)
+    return i
+
+
+def test_run_until_complete_keeps_finished_tasks_from_the_sweeper():
+    # the later ones finish first and would be evicted right away if nothing pinned them
+    ids = [sleepy(i=0, seconds=0.2)] + [sleepy(i=i, seconds=0) for i in range(1, 20)]
+    sweeper = TaskSweeper(RetentionPolicy(ttl=0), interval=0.001)
+    sweeper.start()
+    try:
+        results = run_until_complete(ids, num_workers=4, timeout=10)
+    finally:
+        sweeper.stop()
+    assert list(results.values()) == list(range(20))
+    assert not pinned_ids